@@ -0,0 +1,292 @@
+"""Micro-benchmarks for the CPU-bound paths, no network involved
+
+    python benchmarks.py                      # run everything
+    python benchmarks.py -k json              # names containing 'json'
+    python benchmarks.py --save base.json     # keep the results
+    python benchmarks.py --compare base.json  # flag regressions
+
+Allocations are counted with tracemalloc where it is available. 2.7 has
+no way to count them, so there the column is left out rather than
+estimated.
+"""
+
+import argparse
+import datetime
+import json
+import platform
+import sys
+import time
+
+import parse
+from parse import dates, parsejson
+
+try:
+    import tracemalloc
+except ImportError:
+    tracemalloc = None
+
+BENCHMARKS = []
+
+MIN_SAMPLE_TIME = 0.2
+SAMPLES = 5
+REGRESSION_THRESHOLD = 0.1
+
+BENCH_CLASS_NAME = 'BenchObject'
+
+def benchmark(name):
+    """Register `setup`, which returns the operation to time"""
+    def decorator(setup):
+        BENCHMARKS.append((name, setup))
+        return setup
+    return decorator
+
+def build_result(i):
+    return {
+        'objectId': 'obj%07d' % (i),
+        'createdAt': '2014-03-01T12:00:00.000Z',
+        'updatedAt': '2014-03-02T12:00:00.000Z',
+        'index': i,
+        'score': i * 1.5,
+        'name': u'object %d' % (i),
+        'tags': ['a', 'b', 'c'],
+        'active': i % 2 == 0,
+        'when': {'__type': 'Date', 'iso': '2014-03-03T12:00:00.000Z'},
+        'owner': {'__type': 'Pointer', 'className': '_User',
+            'objectId': 'user%06d' % (i)},
+        'location': {'__type': 'GeoPoint', 'latitude': 40.0,
+            'longitude': -30.0},
+    }
+
+def build_object(i):
+    obj = parse.Object(BENCH_CLASS_NAME)
+    obj['index'] = i
+    obj['name'] = u'object %d' % (i)
+    obj['tags'] = ['a', 'b', 'c']
+    obj['when'] = datetime.datetime(2014, 3, 3, 12)
+    obj['owner'] = parse.Object('_User', 'user%06d' % (i))
+    return obj
+
+@benchmark('parsejson.load_results_1000')
+def bench_load_results():
+    text = json.dumps({'results': [build_result(i) for i in range(1000)]})
+    return lambda: parsejson.load(text, class_name=BENCH_CLASS_NAME)
+
+class StubResponse(object):
+    def __init__(self, text):
+        self.text = text
+
+@benchmark('Query.find_1000_read_two_keys')
+def bench_find_read_two_keys():
+    query = parse.Query(BENCH_CLASS_NAME)
+    response = StubResponse(json.dumps({'results': [build_result(i)
+        for i in range(1000)]}))
+    return lambda: [(obj['index'], obj['when'])
+        for obj in query.handle_find_result(response)]
+
+@benchmark('Query.find_1000_read_two_keys_lazy')
+def bench_lazy_find_read_two_keys():
+    query = parse.Query(BENCH_CLASS_NAME)
+    response = StubResponse(json.dumps({'results': [build_result(i)
+        for i in range(1000)]}))
+    return lambda: [(obj['index'], obj['when'])
+        for obj in query.handle_lazy_find_result(response)]
+
+@benchmark('parsejson.dump_batch_50')
+def bench_dump_batch():
+    objs = [build_object(i) for i in range(50)]
+    batch = {'requests': [obj.build_batch_save_data() for obj in objs]}
+    return lambda: parsejson.dump(batch)
+
+@benchmark('Object.setitem_churn')
+def bench_object_churn():
+    keys = ['key%d' % (i) for i in range(10)]
+
+    def run():
+        obj = parse.Object(BENCH_CLASS_NAME)
+        for i, key in enumerate(keys):
+            obj[key] = i
+        return obj
+    return run
+
+@benchmark('Query.build_query_data')
+def bench_build_query_data():
+    query = parse.Query(BENCH_CLASS_NAME)
+    query.gte('index', 10)
+    query.lt('index', 1000)
+    query.eq('active', True)
+    query.contained_in('tags', 'a', 'b')
+    query.order('index', True)
+    query.limit = 100
+    return query.build_query_data
+
+@benchmark('Object.build_batch_save_args_50')
+def bench_build_batch_save_args():
+    objs = [build_object(i) for i in range(50)]
+    return lambda: parse.Object.build_batch_save_args(objs=objs)
+
+def build_date_strings(count=1000):
+    start = datetime.datetime(2014, 3, 1, 12)
+    return [(start + datetime.timedelta(seconds=i * 7.001)).strftime(
+        parse.DATETIME_FORMAT)[:-4] + 'Z' for i in range(count)]
+
+@benchmark('dates.strptime_1000')
+def bench_strptime():
+    strings = build_date_strings()
+    strptime = datetime.datetime.strptime
+    return lambda: [strptime(s, parse.DATETIME_FORMAT) for s in strings]
+
+@benchmark('dates.parse_date_1000')
+def bench_parse_date():
+    strings = build_date_strings()
+
+    def run():
+        # every string is new, as for results with distinct timestamps
+        dates.parsed.clear()
+        return [dates.parse_date(s) for s in strings]
+    return run
+
+@benchmark('dates.parse_date_1000_memo')
+def bench_parse_date_memo():
+    strings = build_date_strings()
+    return lambda: [dates.parse_date(s) for s in strings]
+
+@benchmark('dates.strftime_1000')
+def bench_strftime():
+    values = [dates.parse_date(s) for s in build_date_strings()]
+    return lambda: [v.strftime(parse.DATETIME_FORMAT) for v in values]
+
+@benchmark('dates.format_date_1000')
+def bench_format_date():
+    values = [dates.parse_date(s) for s in build_date_strings()]
+
+    def run():
+        dates.formatted.clear()
+        return [dates.format_date(v) for v in values]
+    return run
+
+def count_allocations(fn, loops):
+    """Allocations made by `loops` calls of `fn`, None without tracemalloc"""
+    if tracemalloc is None:
+        return None
+
+    tracemalloc.start()
+    before = tracemalloc.take_snapshot()
+    for _ in range(loops):
+        fn()
+    after = tracemalloc.take_snapshot()
+    tracemalloc.stop()
+    return sum(stat.count_diff for stat in
+        after.compare_to(before, 'lineno') if stat.count_diff > 0)
+
+def calibrate(fn):
+    """Loops per sample so each sample runs for `MIN_SAMPLE_TIME`"""
+    loops = 1
+    while True:
+        start = time.time()
+        for _ in range(loops):
+            fn()
+        if time.time() - start >= MIN_SAMPLE_TIME / 10:
+            return max(1, int(loops * MIN_SAMPLE_TIME /
+                (time.time() - start)))
+        loops *= 2
+
+def run_benchmark(name, setup, samples=SAMPLES):
+    fn = setup()
+    loops = calibrate(fn)
+
+    rates = []
+    for _ in range(samples):
+        start = time.time()
+        for _ in range(loops):
+            fn()
+        rates.append(loops / (time.time() - start))
+
+    rates.sort()
+    allocation_loops = min(loops, 100)
+    allocations = count_allocations(fn, allocation_loops)
+
+    return {
+        'ops_per_sec': rates[len(rates) // 2],
+        'best_ops_per_sec': rates[-1],
+        'spread': (rates[-1] - rates[0]) / rates[len(rates) // 2],
+        'allocations_per_op': allocations / float(allocation_loops)
+            if allocations is not None else None,
+        'loops': loops,
+        'samples': samples
+    }
+
+def run(pattern=None, samples=SAMPLES):
+    results = {}
+    for name, setup in BENCHMARKS:
+        if pattern and pattern not in name:
+            continue
+        results[name] = run_benchmark(name, setup, samples)
+        print_result(name, results[name])
+
+    return {
+        'python': platform.python_version(),
+        'implementation': platform.python_implementation(),
+        'platform': platform.platform(),
+        'allocations': 'tracemalloc' if tracemalloc else None,
+        'timestamp': datetime.datetime.utcnow().isoformat(),
+        'results': results
+    }
+
+def print_result(name, result):
+    line = '%-36s %12.1f ops/s  +/-%4.1f%%' % (name, result['ops_per_sec'],
+        result['spread'] * 50)
+    if result['allocations_per_op'] is not None:
+        line += '  %8.1f allocs/op' % (result['allocations_per_op'])
+    print line
+
+def compare(baseline, current, threshold=REGRESSION_THRESHOLD):
+    """Returns the names slower than `baseline` by more than `threshold`"""
+    regressions = []
+    print
+    print '%-36s %12s %12s %8s' % ('benchmark', 'baseline', 'current',
+        'change')
+
+    for name, result in sorted(current['results'].items()):
+        before = baseline['results'].get(name)
+        if before is None:
+            continue
+
+        change = result['ops_per_sec'] / before['ops_per_sec'] - 1
+        flag = ''
+        if change < -threshold:
+            flag = '  REGRESSION'
+            regressions.append(name)
+
+        print '%-36s %12.1f %12.1f %+7.1f%%%s' % (name,
+            before['ops_per_sec'], result['ops_per_sec'], change * 100, flag)
+
+    return regressions
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('-k', dest='pattern',
+        help="only run benchmarks whose name contains this")
+    parser.add_argument('--samples', type=int, default=SAMPLES)
+    parser.add_argument('--save', help="write results as JSON to this path")
+    parser.add_argument('--compare', help="JSON results to compare with")
+    parser.add_argument('--threshold', type=float,
+        default=REGRESSION_THRESHOLD,
+        help="slowdown, as a fraction, counted as a regression")
+    args = parser.parse_args(argv)
+
+    results = run(args.pattern, args.samples)
+
+    if args.save:
+        with open(args.save, 'w') as f:
+            json.dump(results, f, indent=2, sort_keys=True)
+
+    if args.compare:
+        with open(args.compare) as f:
+            baseline = json.load(f)
+        if compare(baseline, results, args.threshold):
+            return 1
+
+    return 0
+
+if __name__ == '__main__':
+    sys.exit(main())
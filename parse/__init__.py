@@ -15,7 +15,19 @@ __licence__ = 'BSD'
 __copyright__ = 'Copyright (c) 2013-2014 Paul Malyschko'
 __all__ = ['set_application', 'Object', 'User', 'Query', 'Relation',
     'ACL', 'Role', 'File', 'Analytics', 'Push', 'Installation', 'Cloud',
-    'GeoPoint', 'ParseException', 'DATETIME_MAX', 'DATETIME_FORMAT',
+    'GeoPoint', 'ParseException', 'configure_pool', 'pool_stats',
+    'configure_dns_cache', 'configure_executor', 'wait_all', 'as_completed',
+    'Future', 'CancelledError', 'TimeoutError', 'UnfetchedKeyError',
+    'ScanError', 'UnsupportedQueryError',
+    'RetryPolicy', 'RetryBudget', 'set_retry_policy', 'retry_stats',
+    'set_rate_limit', 'rate_limit_stats', 'configure_coalescing',
+    'coalescing_stats', 'reset_after_fork',
+    'add_timing_hook', 'remove_timing_hook', 'Tracer', 'add_tracer',
+    'remove_tracer', 'ChromeTraceExporter', 'mount', 'unmount',
+    'configure_date_cache', 'configure_query_cache', 'clear_query_cache',
+    'query_cache_stats', 'configure_object_cache', 'clear_object_cache',
+    'object_cache_stats',
+    'DATETIME_MAX', 'DATETIME_FORMAT',
     'CLASS_TYPE_USER', 'CLASS_TYPE_ROLE', 'CLASS_TYPE_INSTALLATION']
 
 
@@ -24,18 +36,37 @@ from .constants import (DATETIME_MAX, DATETIME_FORMAT, CLASS_TYPE_USER,
     CLASS_TYPE_ROLE, CLASS_TYPE_INSTALLATION)
 from .models import (Object, User, Query, Relation, ACL, Role, File, Analytics,
     Push, Installation, Cloud, GeoPoint)
-from .exceptions import ParseException
+from .cache import (configure_query_cache, clear_query_cache,
+    query_cache_stats, configure_object_cache, clear_object_cache,
+    object_cache_stats)
+from .dates import configure_date_cache
+from .exceptions import (ParseException, CancelledError, TimeoutError,
+    UnfetchedKeyError, ScanError, UnsupportedQueryError)
+from .utils import (configure_pool, pool_stats, configure_dns_cache,
+    configure_executor, wait_all, as_completed, RetryPolicy, RetryBudget,
+    set_retry_policy, retry_stats, set_rate_limit, rate_limit_stats,
+    configure_coalescing, coalescing_stats, reset_after_fork,
+    add_timing_hook, remove_timing_hook, mount, unmount)
+from .tracing import Tracer, add_tracer, remove_tracer, ChromeTraceExporter
+from .packages.requests import Future
 
 application = None
 
-def set_application(name, app_id=None, rest_api_key=None, master_key=None):
-    """Set the Parse application details"""
+def set_application(name, app_id=None, rest_api_key=None, master_key=None,
+    api_base_url=None):
+    """Set the Parse application details
+
+    `api_base_url` points the application at another server, such as a
+    `parse.server.LocalServer`, and an empty string points it back at the
+    Parse API. Details left as None keep their earlier values.
+    """
     global application
 
     kwargs = {
         'app_id': app_id,
         'rest_api_key': rest_api_key,
-        'master_key': master_key
+        'master_key': master_key,
+        'api_base_url': api_base_url
     }
 
     if name not in constants.APPLICATIONS:
@@ -52,4 +83,6 @@ def set_application(name, app_id=None, rest_api_key=None, master_key=None):
     constants.APPLICATION_NAME = name
     constants.APPLICATION_ID = app['app_id']
     constants.REST_API_KEY = app['rest_api_key']
-    constants.MASTER_KEY = app['master_key']
+    constants.MASTER_KEY = app.get('master_key')
+    constants.API_BASE_URL = app.get('api_base_url') or \
+        constants.API_DEFAULT_BASE_URL
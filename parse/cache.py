@@ -0,0 +1,387 @@
+"""In-process caching of query results and objects
+
+Both caches are off until configured. `configure_query_cache` has
+`Query.find` and `count` keep response bodies for a few seconds, dropping
+a class's results as soon as this process writes to it.
+`configure_object_cache` has `Query.get` and `Object.refresh` read objects
+already fetched, by any query, and kept up to date by saves. Writes made
+elsewhere are only seen once entries expire, so `ttl` bounds how stale a
+result can be.
+"""
+
+import collections
+import threading
+import time
+
+from .exceptions import ParseException
+
+QUERY_CACHE_MAX_BYTES = 16 * 1024 * 1024
+QUERY_CACHE_TTL = 5
+# roughly what an entry costs besides its key and body
+QUERY_CACHE_ENTRY_BYTES = 200
+
+OBJECT_CACHE_MAX_ENTRIES = 10000
+OBJECT_CACHE_TTL = 60
+OBJECT_CACHE_NEGATIVE_TTL = 1
+
+def build_key(class_name, name, headers):
+    """`name` within a class, for the application and ACL context that
+    `headers` send a request as"""
+    headers = headers or {}
+    return (headers.get('X-Parse-Application-Id'), class_name, name,
+        headers.get('X-Parse-Master-Key') is not None,
+        headers.get('X-Parse-Session-Token'))
+
+def request_headers(response):
+    """The headers a response was requested with, None when unknown"""
+    return getattr(getattr(response, 'request', None), 'headers', None)
+
+class CachedResponse(object):
+    """Stands in for the response a cached body came from"""
+
+    status_code = 200
+
+    def __init__(self, text):
+        self.text = text
+
+    def __repr__(self):
+        return '<CachedResponse [%d bytes]>' % (len(self.text))
+
+    def close(self):
+        pass
+
+class QueryCache(object):
+    """Response bodies by query, expiring after a per-class TTL
+
+    Entries are keyed on the application, class, encoded query and whether
+    the master key or a session token was sent, since those change what
+    the ACLs let through. The least recently used go first once the keys
+    and bodies come to more than `max_bytes`.
+
+    :param max_bytes: memory held before evicting
+    :param ttl: seconds results are used for
+    :param ttls: class name to seconds for classes that differ, 0 to
+        leave a class uncached
+    """
+
+    def __init__(self, max_bytes=QUERY_CACHE_MAX_BYTES, ttl=QUERY_CACHE_TTL,
+        ttls=None):
+        self.max_bytes = max_bytes
+        self.ttl = ttl
+        self.ttls = dict(ttls or {})
+        self.entries = collections.OrderedDict()
+        self.by_class = {}
+        # bumped on writes, so a result fetched across one isn't stored
+        self.generations = {}
+        self.size = 0
+        self.lock = threading.Lock()
+        self.counts = dict.fromkeys(('hits', 'misses', 'evictions',
+            'expirations', 'invalidations'), 0)
+
+    def __repr__(self):
+        return '<QueryCache [%d entries]>' % (len(self.entries))
+
+    def ttl_for(self, class_name):
+        return self.ttls.get(class_name, self.ttl)
+
+    def build_key(self, class_name, data, headers):
+        return build_key(class_name, data, headers)
+
+    def generation(self, class_name):
+        with self.lock:
+            return self.generations.get(class_name, 0)
+
+    def get(self, key):
+        """The cached body for `key`, or None"""
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is None:
+                self.counts['misses'] += 1
+                return None
+
+            text, expires = entry
+            if expires <= time.time():
+                self.remove(key)
+                self.counts['expirations'] += 1
+                self.counts['misses'] += 1
+                return None
+
+            # move to the most recently used end
+            del self.entries[key]
+            self.entries[key] = entry
+            self.counts['hits'] += 1
+            return text
+
+    def set(self, key, text, generation):
+        """Keep `text` unless the class was written to since `generation`"""
+        class_name = key[1]
+        ttl = self.ttl_for(class_name)
+        cost = self.cost(key, text)
+        if not ttl or cost > self.max_bytes:
+            return
+
+        with self.lock:
+            if self.generations.get(class_name, 0) != generation:
+                return
+
+            if key in self.entries:
+                self.remove(key)
+            self.entries[key] = (text, time.time() + ttl)
+            self.by_class.setdefault(class_name, set()).add(key)
+            self.size += cost
+
+            while self.size > self.max_bytes:
+                self.remove(next(iter(self.entries)))
+                self.counts['evictions'] += 1
+
+    def cost(self, key, text):
+        return len(key[2] or '') + len(text) + QUERY_CACHE_ENTRY_BYTES
+
+    def remove(self, key):
+        text, expires = self.entries.pop(key)
+        self.size -= self.cost(key, text)
+
+        keys = self.by_class.get(key[1])
+        if keys is not None:
+            keys.discard(key)
+            if not keys:
+                del self.by_class[key[1]]
+
+    def invalidate(self, class_name):
+        """Drop every result for `class_name`"""
+        with self.lock:
+            self.generations[class_name] = \
+                self.generations.get(class_name, 0) + 1
+
+            for key in list(self.by_class.get(class_name, ())):
+                self.remove(key)
+                self.counts['invalidations'] += 1
+
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
+            self.by_class.clear()
+            self.size = 0
+
+    def stats(self):
+        with self.lock:
+            stats = dict(self.counts)
+            stats['entries'] = len(self.entries)
+            stats['bytes'] = self.size
+            return stats
+
+QUERY_CACHE = None
+
+def configure_query_cache(max_bytes=QUERY_CACHE_MAX_BYTES,
+    ttl=QUERY_CACHE_TTL, ttls=None):
+    """Cache the results of `Query.find` and `count`, see `QueryCache`
+
+    A `max_bytes` of 0 turns the cache back off. Pass `cache=False` to a
+    find or count to skip the cache for that call.
+    """
+    global QUERY_CACHE
+
+    QUERY_CACHE = QueryCache(max_bytes, ttl, ttls) if max_bytes else None
+
+def get_query_cache():
+    return QUERY_CACHE
+
+def invalidate_class(class_name):
+    cache = QUERY_CACHE
+    if cache is not None:
+        cache.invalidate(class_name)
+
+def clear_query_cache():
+    cache = QUERY_CACHE
+    if cache is not None:
+        cache.clear()
+
+def query_cache_stats():
+    """Hits, misses, evictions, expirations and invalidations with the
+    entries and bytes held, empty when the cache is off"""
+    cache = QUERY_CACHE
+    return cache.stats() if cache is not None else {}
+
+class Missing(object):
+    """Remembers that an object was not found"""
+
+    def __init__(self, error):
+        self.message = str(error)
+        self.code = getattr(error, 'code', None)
+
+    def exception(self):
+        e = ParseException(self.message)
+        e.reason = self.message
+        e.code = self.code
+        return e
+
+class ObjectCache(object):
+    """Full objects by class and objectId, expiring after a per-class TTL
+
+    Objects are kept as the plain JSON values they arrived as and decoded
+    afresh for each caller, so changing a returned object leaves the cache
+    alone. As with `QueryCache`, entries are per application and ACL
+    context. Objects that were not found are remembered for
+    `negative_ttl` seconds, so repeated lookups of a missing id don't each
+    go to the server.
+
+    :param max_entries: objects held before the least recently used go
+    :param ttl: seconds objects are used for
+    :param ttls: class name to seconds for classes that differ, 0 to
+        leave a class uncached
+    :param negative_ttl: seconds a missing object is remembered for
+    """
+
+    def __init__(self, max_entries=OBJECT_CACHE_MAX_ENTRIES,
+        ttl=OBJECT_CACHE_TTL, ttls=None,
+        negative_ttl=OBJECT_CACHE_NEGATIVE_TTL):
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self.ttls = dict(ttls or {})
+        self.negative_ttl = negative_ttl
+        self.entries = collections.OrderedDict()
+        # (application, class, objectId) to its keys in every ACL context
+        self.by_object = {}
+        self.lock = threading.Lock()
+        self.counts = dict.fromkeys(('hits', 'negative_hits', 'misses',
+            'evictions', 'expirations', 'invalidations'), 0)
+
+    def __repr__(self):
+        return '<ObjectCache [%d entries]>' % (len(self.entries))
+
+    def ttl_for(self, class_name):
+        return self.ttls.get(class_name, self.ttl)
+
+    def build_key(self, class_name, object_id, headers):
+        return build_key(class_name, object_id, headers)
+
+    def get(self, key):
+        """The JSON for `key`, a `Missing` when it was not found, or None"""
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is None:
+                self.counts['misses'] += 1
+                return None
+
+            data, expires = entry
+            if expires <= time.time():
+                self.remove(key)
+                self.counts['expirations'] += 1
+                self.counts['misses'] += 1
+                return None
+
+            del self.entries[key]
+            self.entries[key] = entry
+            if isinstance(data, Missing):
+                self.counts['negative_hits'] += 1
+            else:
+                self.counts['hits'] += 1
+            return data
+
+    def store(self, key, data, ttl):
+        if not ttl:
+            return
+
+        with self.lock:
+            if key in self.entries:
+                del self.entries[key]
+            self.entries[key] = (data, time.time() + ttl)
+            self.by_object.setdefault(key[:3], set()).add(key)
+
+            while len(self.entries) > self.max_entries:
+                self.remove(next(iter(self.entries)))
+                self.counts['evictions'] += 1
+
+    def set(self, key, data):
+        self.store(key, data, self.ttl_for(key[1]))
+
+    def set_missing(self, key, error):
+        self.store(key, Missing(error), self.negative_ttl)
+
+    def add(self, class_name, data, headers):
+        """Keep a full object from a response, anything else, or anything
+        requested with unknown headers, is ignored"""
+        if headers is not None and isinstance(data, dict) and \
+            'objectId' in data and 'createdAt' in data and \
+            'updatedAt' in data:
+            self.set(self.build_key(class_name, data['objectId'], headers),
+                data)
+
+    def update(self, class_name, data, headers):
+        """Apply a save's values to the cached object
+
+        The object is dropped for other ACL contexts, as the save may have
+        changed who can see it. A newly created object is added.
+        """
+        key = self.build_key(class_name, data.get('objectId'), headers)
+        with self.lock:
+            entry = self.entries.get(key)
+            cached = entry[0] if entry is not None else None
+            for other in list(self.by_object.get(key[:3], ())):
+                if other != key:
+                    self.remove(other)
+
+        if isinstance(cached, dict):
+            cached = dict(cached)
+            cached.update(data)
+            data = cached
+        elif 'updatedAt' not in data and 'createdAt' in data:
+            data = dict(data, updatedAt=data['createdAt'])
+        self.add(class_name, data, headers)
+
+    def remove(self, key):
+        self.entries.pop(key)
+        keys = self.by_object.get(key[:3])
+        if keys is not None:
+            keys.discard(key)
+            if not keys:
+                del self.by_object[key[:3]]
+
+    def invalidate(self, class_name, object_id, headers):
+        """Drop an object in every ACL context"""
+        app_id = (headers or {}).get('X-Parse-Application-Id')
+        with self.lock:
+            for key in list(self.by_object.get((app_id, class_name,
+                object_id), ())):
+                self.remove(key)
+                self.counts['invalidations'] += 1
+
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
+            self.by_object.clear()
+
+    def stats(self):
+        with self.lock:
+            stats = dict(self.counts)
+            stats['entries'] = len(self.entries)
+            return stats
+
+OBJECT_CACHE = None
+
+def configure_object_cache(max_entries=OBJECT_CACHE_MAX_ENTRIES,
+    ttl=OBJECT_CACHE_TTL, ttls=None, negative_ttl=OBJECT_CACHE_NEGATIVE_TTL):
+    """Cache objects for `Query.get` and `Object.refresh`, see
+    `ObjectCache`
+
+    A `max_entries` of 0 turns the cache back off. Pass `cache=False` to a
+    get or refresh to go to the server for that call.
+    """
+    global OBJECT_CACHE
+
+    OBJECT_CACHE = ObjectCache(max_entries, ttl, ttls, negative_ttl) \
+        if max_entries else None
+
+def get_object_cache():
+    return OBJECT_CACHE
+
+def clear_object_cache():
+    cache = OBJECT_CACHE
+    if cache is not None:
+        cache.clear()
+
+def object_cache_stats():
+    """Hits, negative hits, misses, evictions, expirations and
+    invalidations with the entries held, empty when the cache is off"""
+    cache = OBJECT_CACHE
+    return cache.stats() if cache is not None else {}
@@ -4,7 +4,8 @@ from datetime import datetime, timedelta
 DATETIME_MAX = datetime.max - timedelta(microseconds=999)
 DATETIME_FORMAT = '%Y-%m-%dT%H:%M:%S.%fZ'
 
-API_BASE_URL = 'https://api.parse.com'
+API_DEFAULT_BASE_URL = 'https://api.parse.com'
+API_BASE_URL = API_DEFAULT_BASE_URL
 API_VERSION = '1'
 API_CLASSES_PATH = 'classes'
 API_BATCH_PATH = 'batch'
@@ -45,6 +46,22 @@ QUERY_DEFAULT_LIMIT = 100
 QUERY_MIN_LIMIT = 0
 QUERY_MAX_LIMIT = 1000
 QUERY_DEFAULT_SKIP = 0
+QUERY_STREAM_CHUNK_SIZE = 64 * 1024
+# returned whatever keys a query asks for
+QUERY_PROJECTION_KEYS = ('objectId', 'createdAt', 'updatedAt')
+
+ERROR_OBJECT_NOT_FOUND = 101
+
+RETRY_TOTAL = 3
+RETRY_BACKOFF_FACTOR = 0.5
+RETRY_BACKOFF_MAX = 30
+# longest Retry-After waited out, a request asked to wait longer fails
+RETRY_AFTER_MAX = 120
+RETRY_STATUSES = (429, 500, 502, 503, 504)
+RETRY_METHODS = ('GET', 'PUT', 'DELETE')
+RETRY_BUDGET_RATIO = 0.2
+RETRY_BUDGET_MIN = 10
+RETRY_BUDGET_WINDOW = 10
 
 RELATION_OPS = ('AddRelation', 'RemoveRelation')
 RELATION_ROLE_KEYS = ('users', 'roles')
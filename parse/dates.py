@@ -0,0 +1,94 @@
+"""Parse's date format, '%Y-%m-%dT%H:%M:%S.%fZ', without strptime
+
+`datetime.strptime` goes through a locale-aware regex and `strftime`
+through the C library for every call, which dominates decoding results
+with a few Date fields. The format here is fixed, so a plain regex and
+table lookups are enough.
+"""
+
+import datetime
+import re
+
+from .constants import DATETIME_FORMAT
+
+DATE_CACHE_SIZE = 4096
+
+DATE_PATTERN = re.compile(
+    r'(\d{4})-(\d\d)-(\d\d)T(\d\d):(\d\d):(\d\d)\.(\d{1,6})Z\Z')
+
+# a dict lookup is quicker than int() for the two digit fields
+TWO_DIGITS = dict(('%02d' % (i), i) for i in range(100))
+FRACTION_SCALE = (None, 100000, 10000, 1000, 100, 10, 1)
+
+parsed = {}
+formatted = {}
+cache_size = DATE_CACHE_SIZE
+
+def configure_date_cache(size=DATE_CACHE_SIZE):
+    """Remember up to `size` parsed and formatted dates, none when 0
+
+    Results sharing timestamps, such as objects saved in one batch, then
+    skip conversion. The memo is emptied when full, which is cheaper than
+    tracking recency and keeps lookups free of locks.
+    """
+    global cache_size
+
+    cache_size = size
+    parsed.clear()
+    formatted.clear()
+
+def parse_date(s):
+    """The naive UTC datetime for a Parse date string
+
+    Anything other than the usual 'YYYY-MM-DDTHH:MM:SS.fffZ' shape goes
+    through `strptime`, so the same strings are accepted and rejected.
+    """
+    value = parsed.get(s)
+    if value is not None:
+        return value
+
+    match = DATE_PATTERN.match(s)
+    if match is not None:
+        year, month, day, hour, minute, second, fraction = match.groups()
+        try:
+            value = datetime.datetime(int(year), TWO_DIGITS[month],
+                TWO_DIGITS[day], TWO_DIGITS[hour], TWO_DIGITS[minute],
+                TWO_DIGITS[second],
+                int(fraction) * FRACTION_SCALE[len(fraction)])
+        except ValueError:
+            pass
+
+    if value is None:
+        value = datetime.datetime.strptime(s, DATETIME_FORMAT)
+
+    if cache_size:
+        if len(parsed) >= cache_size:
+            parsed.clear()
+        parsed[s] = value
+    return value
+
+def format_date(value):
+    """The Parse date string for a datetime, as `strftime` would give"""
+    # naive and aware datetimes cannot be compared, so only memo naive ones
+    memo = cache_size and value.tzinfo is None
+    if memo:
+        s = formatted.get(value)
+        if s is not None:
+            return s
+
+    if value.tzinfo is None:
+        # isoformat leaves out a zero fraction
+        if value.microsecond:
+            s = value.isoformat() + 'Z'
+        else:
+            s = value.isoformat() + '.000000Z'
+    else:
+        s = '%04d-%02d-%02dT%02d:%02d:%02d.%06dZ' % (value.year,
+            value.month, value.day, value.hour, value.minute, value.second,
+            value.microsecond)
+
+    if memo:
+        if len(formatted) >= cache_size:
+            formatted.clear()
+        formatted[value] = s
+    return s
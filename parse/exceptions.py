@@ -3,10 +3,34 @@ Exceptions
 
 """
 
+from .packages.requests import CancelledError, TimeoutError
+
+
 class ParseException(Exception):
     """Base Exception class"""
     
     def __init__(self, *args):
         super(ParseException, self).__init__(*args)
         self.code = None
-        self.reason = None
\ No newline at end of file
+        self.reason = None
+
+
+class UnfetchedKeyError(KeyError):
+    """A key was read that the query's `keys` or `exclude_keys` left out"""
+
+
+class UnsupportedQueryError(ParseException):
+    """A query uses an operator that cannot be evaluated locally"""
+
+
+class ScanError(ParseException):
+    """Partitions of a scan still failed after being retried
+
+    `failed` holds their `parse.scan.ScanSpec`s, which keep the error and
+    the checkpoint to resume from.
+    """
+
+    def __init__(self, failed):
+        super(ScanError, self).__init__("%d partitions failed: %s" % (
+            len(failed), '; '.join(spec.error or '?' for spec in failed)))
+        self.failed = failed
@@ -0,0 +1,249 @@
+"""Latency and fault injection for resilience benchmarks
+
+    adapter = FaultInjectionAdapter([
+        Fault('/1/classes/*', latency=lognormal(0.05, 0.8)),
+        Fault('/1/batch', probability=0.05, status=503),
+        Fault('*', probability=0.01, reset=True),
+    ], seed=1)
+    parse.mount('https://api.parse.com', adapter)
+
+Requests are forwarded to a real adapter, `DefaultAdapter` by default, so
+this works against Parse or a `parse.server.LocalServer` alike.
+"""
+
+import fnmatch
+import json
+import math
+import random
+import threading
+import time
+
+from .packages import requests
+
+def constant(seconds):
+    return lambda rng: seconds
+
+def uniform(low, high):
+    return lambda rng: rng.uniform(low, high)
+
+def exponential(mean):
+    return lambda rng: rng.expovariate(1.0 / mean)
+
+def lognormal(median, sigma):
+    """Long-tailed latency: half the requests take less than `median`"""
+    return lambda rng: rng.lognormvariate(math.log(median), sigma)
+
+class Fault(object):
+    """What to do to requests whose URL path matches `pattern`
+
+    :param pattern: shell-style pattern such as '/1/classes/*'
+    :param methods: only these HTTP methods, any if None
+    :param probability: chance that the fault applies to a request
+    :param latency: seconds, or a distribution such as `lognormal`, to
+        wait before the request is sent
+    :param status: answer with this status instead of sending, such as
+        503 or 429
+    :param retry_after: Retry-After header sent with `status`
+    :param reset: fail with a connection reset instead of sending
+    :param slow_body: deliver response bodies at this many bytes a second
+    :param truncate: cut response bodies to this fraction of their length
+    """
+
+    def __init__(self, pattern='*', methods=None, probability=1.0,
+        latency=None, status=None, retry_after=None, reset=False,
+        slow_body=None, truncate=None):
+        self.pattern = pattern
+        self.methods = set(m.upper() for m in methods) if methods else None
+        self.probability = probability
+        self.latency = constant(latency) if isinstance(latency,
+            (int, float)) else latency
+        self.status = status
+        self.retry_after = retry_after
+        self.reset = reset
+        self.slow_body = slow_body
+        self.truncate = truncate
+
+    def __repr__(self):
+        return '<Fault [%s]>' % (self.pattern)
+
+    def matches(self, method, path):
+        if self.methods is not None and method not in self.methods:
+            return False
+        return fnmatch.fnmatchcase(path, self.pattern)
+
+class Plan(object):
+    """The faults drawn for one request"""
+
+    def __init__(self):
+        self.delay = 0.0
+        self.status = None
+        self.retry_after = None
+        self.reset = False
+        self.slow_body = None
+        self.truncate = None
+
+class FaultInjectionAdapter(requests.BaseAdapter):
+    """Wraps `adapter`, applying every matching `Fault` to each request
+
+    :param faults: `Fault` rules, each drawn independently per request
+    :param adapter: adapter that really sends requests
+    :param seed: seed for a reproducible sequence of faults
+    """
+
+    def __init__(self, faults=None, adapter=None, seed=None):
+        self.faults = list(faults or [])
+        self.adapter = adapter or requests.DefaultAdapter()
+        self.random = random.Random(seed)
+        self.lock = threading.Lock()
+        self.counts = dict.fromkeys(('requests', 'delayed', 'status',
+            'reset', 'slow_body', 'truncate'), 0)
+
+    def __repr__(self):
+        return '<FaultInjectionAdapter [%d faults]>' % (len(self.faults))
+
+    def add(self, fault):
+        self.faults.append(fault)
+
+    def stats(self):
+        with self.lock:
+            return dict(self.counts)
+
+    def plan(self, request):
+        method = request.method.upper()
+        path = requests.urlparse(request.url).path
+        plan = Plan()
+
+        with self.lock:
+            self.counts['requests'] += 1
+
+            for fault in self.faults:
+                if not fault.matches(method, path):
+                    continue
+                if self.random.random() >= fault.probability:
+                    continue
+
+                if fault.latency is not None:
+                    plan.delay += max(0.0, fault.latency(self.random))
+                if fault.status is not None and plan.status is None:
+                    plan.status = fault.status
+                    plan.retry_after = fault.retry_after
+                plan.reset = plan.reset or fault.reset
+                plan.slow_body = plan.slow_body or fault.slow_body
+                plan.truncate = plan.truncate or fault.truncate
+
+            for name in ('status', 'reset', 'slow_body', 'truncate'):
+                if getattr(plan, name):
+                    self.counts[name] += 1
+            if plan.delay:
+                self.counts['delayed'] += 1
+
+        return plan
+
+    def build_response(self, request, plan):
+        response = requests.Response()
+        response.status_code = plan.status
+        response.reason = 'Injected fault'
+        response.headers = requests.CaseInsensitiveDict({
+            'Content-Type': 'application/json'})
+        if plan.retry_after is not None:
+            response.headers['Retry-After'] = str(plan.retry_after)
+        response.url = request.url
+        response.request = request
+        response._content = json.dumps({'code': 1,
+            'error': 'Injected %d response' % (plan.status)})
+        response._content_consumed = True
+        return response
+
+    def injected(self, request, plan):
+        """Returns the (response, error) a request ends in without being
+        sent, or None when it should be sent"""
+        if plan.reset:
+            return (None, requests.ConnectionError(
+                "Connection reset by peer (injected)"))
+
+        if plan.status is not None:
+            response = self.build_response(request, plan)
+            try:
+                response.raise_for_status()
+            except requests.HTTPError as e:
+                return (response, e)
+            return (response, None)
+
+        return None
+
+    def distort(self, response, plan):
+        """Apply body faults, returns the extra seconds to wait"""
+        if response is None:
+            return 0
+
+        content = response.content or ''
+        if plan.truncate is not None:
+            response._content = content[:int(len(content) * plan.truncate)]
+
+        if plan.slow_body:
+            return len(content) / float(plan.slow_body)
+        return 0
+
+    def send(self, request, timeout=None, verify=True, callback=None):
+        plan = self.plan(request)
+
+        if callback:
+            return self.send_in_background(request, timeout, verify,
+                callback, plan)
+
+        if plan.delay:
+            time.sleep(plan.delay)
+
+        result = self.injected(request, plan)
+        if result is not None:
+            response, error = result
+            if error is not None:
+                raise error
+            return response
+
+        try:
+            response = self.adapter.send(request, timeout, verify)
+        except requests.HTTPError as e:
+            delay = self.distort(e.response, plan)
+            if delay:
+                time.sleep(delay)
+            raise
+
+        delay = self.distort(response, plan)
+        if delay:
+            time.sleep(delay)
+        return response
+
+    def send_in_background(self, request, timeout, verify, callback, plan):
+        """Waits happen on the scheduler thread, not a worker"""
+        future = requests.Future()
+
+        def finish(response, error):
+            delay = self.distort(response, plan)
+            if delay:
+                requests.SCHEDULER.call_later(delay, future.run, callback,
+                    response, error)
+            else:
+                future.run(callback, response, error)
+
+        def forward():
+            result = self.injected(request, plan)
+            if result is not None:
+                future.run(callback, *result)
+                return
+
+            try:
+                inner = self.adapter.send(request, timeout, verify, finish)
+            except Exception as e:
+                future.run(callback, None, e)
+            else:
+                future.waiter = inner.waiter
+
+        if plan.delay:
+            requests.SCHEDULER.call_later(plan.delay, forward)
+        else:
+            forward()
+        return future
+
+    def close(self):
+        self.adapter.close()
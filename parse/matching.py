@@ -0,0 +1,107 @@
+"""Evaluating queries against objects held as JSON
+
+The stand-in server answers finds with these, and `LocalStore.find` runs
+queries over stored objects with them. Values compare the way the API
+compares them, see `comparable`.
+"""
+
+import datetime
+import re
+
+from .dates import parse_date
+from .exceptions import UnsupportedQueryError
+
+def comparable(value):
+    """A key that compares Parse typed values the way the API does"""
+    if isinstance(value, dict):
+        kind = value.get('__type')
+        if kind == 'Date':
+            # clients may send more fraction digits than are stored
+            return parse_date(value['iso'])
+        if kind in ('Pointer', 'Object'):
+            return (value.get('className'), value.get('objectId'))
+    return value
+
+def comparable_pair(value, operand):
+    """`comparable` for both, reading createdAt and updatedAt strings as
+    dates when compared with one"""
+    value, operand = comparable(value), comparable(operand)
+    if isinstance(operand, datetime.datetime) and \
+        isinstance(value, basestring):
+        value = parse_date(value)
+    return (value, operand)
+
+def matches(obj, where, related_to=None):
+    """Whether `obj` satisfies `where`
+
+    `$relatedTo` is only supported with `related_to`, called with the
+    condition and `obj` to say whether the relation holds it.
+    """
+    for key, condition in where.items():
+        if key == '$or':
+            if not any(matches(obj, w, related_to) for w in condition):
+                return False
+        elif key == '$relatedTo':
+            if related_to is None:
+                raise UnsupportedQueryError(
+                    'unsupported query operator: %s' % (key))
+            if not related_to(condition, obj):
+                return False
+        elif isinstance(condition, dict) and \
+            any(k.startswith('$') for k in condition):
+            for op, operand in condition.items():
+                if not compare(obj, key, op, operand, condition):
+                    return False
+        elif not equals(obj.get(key), condition):
+            return False
+
+    return True
+
+def equals(value, condition):
+    if isinstance(value, list) and not isinstance(condition, list):
+        return comparable(condition) in [comparable(v) for v in value]
+    value, condition = comparable_pair(value, condition)
+    return value == condition
+
+def compare(obj, key, op, operand, condition):
+    value = obj.get(key)
+
+    if op == '$exists':
+        return (key in obj) == bool(operand)
+    if op == '$ne':
+        return not equals(value, operand)
+    if op == '$in':
+        return any(equals(value, o) for o in operand)
+    if op == '$nin':
+        return not any(equals(value, o) for o in operand)
+    if op == '$all':
+        return isinstance(value, list) and \
+            all(equals(value, o) for o in operand)
+    if op == '$regex':
+        flags = re.I if 'i' in condition.get('$options', '') else 0
+        return isinstance(value, basestring) and \
+            re.search(operand, value, flags) is not None
+    if op == '$options':
+        return True
+
+    if key not in obj:
+        return False
+
+    value, operand = comparable_pair(value, operand)
+    if op == '$lt':
+        return value < operand
+    if op == '$lte':
+        return value <= operand
+    if op == '$gt':
+        return value > operand
+    if op == '$gte':
+        return value >= operand
+
+    raise UnsupportedQueryError('unsupported query operator: %s' % (op))
+
+def sort(objs, order):
+    """Sort `objs` in place on the `order` keys, descending where they
+    start with '-', objects missing a key first when ascending"""
+    for key in reversed(order):
+        objs.sort(key=lambda obj: comparable(obj.get(key.lstrip('-'))),
+            reverse=key.startswith('-'))
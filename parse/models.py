@@ -2,29 +2,43 @@ import datetime
 import logging
 import mimetypes
 import re
+import threading
 import urllib
+import weakref
 from numbers import Number
 
+from . import constants
 from . import parsejson as json
 from . import utils
-from .constants import (DATETIME_MAX, DATETIME_FORMAT, API_BASE_URL,
-    API_VERSION, API_CLASSES_PATH, API_BATCH_PATH, API_USERS_PATH,
+from .constants import (DATETIME_MAX, API_VERSION, API_CLASSES_PATH,
+    API_BATCH_PATH, API_USERS_PATH,
     API_LOGIN_PATH, API_PASSWORD_RESET_PATH, API_ROLES_PATH,
     API_FILES_PATH, API_EVENTS_PATH, API_PUSH_PATH,
-    API_INSTALLATIONS_PATH, API_FUNCTIONS_PATH, CLASS_TYPES,
+    API_INSTALLATIONS_PATH, API_FUNCTIONS_PATH, CLASS_TYPE_USER, CLASS_TYPES,
     CLASS_PATHS, DEVICE_TYPE_IOS, DEVICE_TYPE_ANDROID,
     DEVICE_TYPE_WINRT, DEVICE_TYPE_WINPHONE, DEVICE_TYPE_DOTNET,
     DEVICE_TYPES, QUERY_OPS, QUERY_DEFAULT_LIMIT, QUERY_MIN_LIMIT,
-    QUERY_MAX_LIMIT, QUERY_DEFAULT_SKIP, RELATION_OPS, RELATION_ROLE_KEYS,
+    QUERY_MAX_LIMIT, QUERY_DEFAULT_SKIP, QUERY_STREAM_CHUNK_SIZE,
+    QUERY_PROJECTION_KEYS, ERROR_OBJECT_NOT_FOUND,
+    RELATION_OPS, RELATION_ROLE_KEYS,
     ACL_OPS, ANALYTICS_EVENTS, ANALYTICS_DIMENSION_LIMIT, PUSH_IOS_KEYS,
     PUSH_ANDROID_KEYS, RESERVED_KEYS)
-from .exceptions import ParseException
+from .cache import (CachedResponse, Missing, get_query_cache,
+    get_object_cache, invalidate_class, request_headers)
+from .dates import parse_date
+from .exceptions import ParseException, UnfetchedKeyError
+from .scan import keyset_value, ParallelScan, build_partitions
+from .tracing import traced
 from .utils import (build_headers, request, get, post, put, delete,
-    build_boolean_callback, build_integer_callback, build_object_callback,
-    build_list_callback, build_bytes_callback)
+    arequest, aget, apost, adelete, build_boolean_callback,
+    build_integer_callback, build_object_callback, build_list_callback,
+    build_bytes_callback)
 
 
 class Object(dict):
+    # set on objects returned by a query with `keys` or `exclude_keys`
+    _projection = None
+
     def __init__(self, *args, **kwargs):
         self._created_at = False
         self._updated_at = False
@@ -55,6 +69,18 @@ class Object(dict):
     def __repr__(self):
         return json.dump(self)
 
+    def __missing__(self, key):
+        projection = self._projection
+        if projection is None or not projection.is_missing(key):
+            raise KeyError(key)
+
+        if not projection.fetch_missing:
+            raise UnfetchedKeyError("'%s' was left out by the query's keys, "
+                "use Object.fetch_missing to fetch it" % (key))
+
+        projection.fetch()
+        return self[key]
+
     def __setitem__(self, key, value):
         if self.is_reserved(key):
             raise KeyError("Cannot set reserved key")
@@ -143,8 +169,7 @@ class Object(dict):
     def created_at(self):
         if self._created_at is False:
             try:
-                self._created_at = datetime.datetime.strptime(
-                    self['createdAt'], DATETIME_FORMAT)
+                self._created_at = parse_date(self['createdAt'])
             except KeyError:
                 self._created_at = None
 
@@ -154,8 +179,7 @@ class Object(dict):
     def updated_at(self):
         if self._updated_at is False:
             try:
-                self._updated_at = datetime.datetime.strptime(
-                    self['updatedAt'], DATETIME_FORMAT)
+                self._updated_at = parse_date(self['updatedAt'])
             except KeyError:
                 self._updated_at = None
 
@@ -183,7 +207,7 @@ class Object(dict):
         return Object(self.class_name, self.object_id)
 
     def build_url(self, object_id=False):
-        paths = [API_BASE_URL, API_VERSION, API_CLASSES_PATH,
+        paths = [constants.API_BASE_URL, API_VERSION, API_CLASSES_PATH,
             self.class_name]
 
         if object_id and self.object_id is not None:
@@ -192,15 +216,38 @@ class Object(dict):
         return '/'.join(paths)
 
     def build_relative_url(self, object_id=False):
-        return self.build_url(object_id).replace(API_BASE_URL, '', 1)
+        return self.build_url(object_id).replace(constants.API_BASE_URL, '', 1)
 
     def handle_save_result(self, response, **kwargs):
+        invalidate_class(self.class_name)
         self.clean()
         super(Object, self).update(json.load(response.text))
+        self.cache_saved(request_headers(response))
         return True
 
+    def cache_saved(self, headers):
+        """Bring the object cache up to date with a successful save"""
+        object_cache = get_object_cache()
+        if object_cache is None:
+            return
+
+        if self._projection is not None:
+            # only part of the object is known here
+            object_cache.invalidate(self.class_name, self.object_id,
+                headers or build_headers())
+        else:
+            object_cache.update(self.class_name, json.load_raw(
+                json.dump(self)), headers)
+
+    def uncache(self, headers):
+        object_cache = get_object_cache()
+        if object_cache is not None:
+            object_cache.invalidate(self.class_name, self.object_id,
+                headers or build_headers())
+
     def build_save_args(self, **kwargs):
         ignore_acl = kwargs.pop('ignore_acl', False)
+        background = kwargs.pop('background', False)
         callback = kwargs.pop('callback', None)
 
         saved = self.object_id is not None
@@ -213,54 +260,84 @@ class Object(dict):
         headers = build_headers(master_key=ignore_acl)
         data = json.dump(items)
 
-        if callback is not None:
+        if background:
             callback = build_boolean_callback(self.handle_save_result,
                 callback=callback, **kwargs)
 
         return (method, url, {'headers': headers, 'data': data,
             'callback': callback})
 
+    @traced('Object.save')
     def save(self, **kwargs):
         method, url, kwargs = self.build_save_args(**kwargs)
         return self.handle_save_result(request(method, url, **kwargs))
 
+    @traced('Object.save_in_background')
     def save_in_background(self, **kwargs):
-        method, url, kwargs = self.build_save_args(**kwargs)
+        method, url, kwargs = self.build_save_args(background=True, **kwargs)
         return request(method, url, **kwargs)
 
+    @traced('Object.asave')
+    def asave(self, **kwargs):
+        method, url, kwargs = self.build_save_args(background=True, **kwargs)
+        return arequest(method, url, **kwargs)
+
     def handle_refresh_result(self, response, **kwargs):
+        return self.merge_refreshed(load_object(self.class_name, response))
+
+    def merge_refreshed(self, result):
         self.clean()
-        super(Object, self).update(json.load(response.text, self.class_name))
+        super(Object, self).update(result)
         return self
 
     def build_refresh_args(self, **kwargs):
         ignore_acl = kwargs.pop('ignore_acl', False)
+        background = kwargs.pop('background', False)
         callback = kwargs.pop('callback', None)
+        kwargs.pop('cache', None)
 
         url = self.build_url(True)
         headers = build_headers(master_key=ignore_acl)
 
-        if callback is not None:
+        if background:
             callback = build_object_callback(self.handle_refresh_result,
                 callback=callback, **kwargs)
 
         return (url, {'headers': headers, 'callback': callback})
 
+    @traced('Object.refresh')
     def refresh(self, **kwargs):
+        cache = kwargs.pop('cache', True)
         url, kwargs = self.build_refresh_args(**kwargs)
-        self.handle_refresh_result(get(url, **kwargs))
+        if not cache or get_object_cache() is None:
+            self.handle_refresh_result(get(url, **kwargs))
+        else:
+            data = get_object_data(self.class_name, self.object_id, url,
+                **kwargs)
+            self.merge_refreshed(json.decode_value(data, self.class_name))
 
+    @traced('Object.refresh_in_background')
     def refresh_in_background(self, **kwargs):
-        url, kwargs = self.build_refresh_args(**kwargs)
+        url, kwargs = self.build_refresh_args(background=True, **kwargs)
         return get(url, **kwargs)
 
+    @traced('Object.arefresh')
+    def arefresh(self, **kwargs):
+        url, kwargs = self.build_refresh_args(background=True, **kwargs)
+        return aget(url, **kwargs)
+
     def fetch(self, **kwargs):
         self.refresh(**kwargs)
 
     def fetch_in_background(self, **kwargs):
         return self.refresh_in_background(**kwargs)
 
+    def afetch(self, **kwargs):
+        return self.arefresh(**kwargs)
+
     def handle_delete_result(self, response, **kwargs):
+        invalidate_class(self.class_name)
+        self.uncache(request_headers(response))
         self.clean()
         for key in ('objectId', 'createdAt', 'updatedAt'):
             if key in self:
@@ -269,64 +346,84 @@ class Object(dict):
 
     def build_delete_args(self, **kwargs):
         ignore_acl = kwargs.pop('ignore_acl', False)
+        background = kwargs.pop('background', False)
         callback = kwargs.pop('callback', None)
 
         url = self.build_url(True)
         headers = build_headers(master_key=ignore_acl)
 
-        if callback is not None:
+        if background:
             callback = build_boolean_callback(self.handle_delete_result,
                 callback=callback, **kwargs)
 
         return (url, {'headers': headers, 'callback': callback})
 
+    @traced('Object.delete')
     def delete(self, **kwargs):
         url, kwargs = self.build_delete_args(**kwargs)
         return self.handle_delete_result(delete(url, **kwargs))
 
+    @traced('Object.delete_in_background')
     def delete_in_background(self, **kwargs):
-        url, kwargs = self.build_delete_args(**kwargs)
+        url, kwargs = self.build_delete_args(background=True, **kwargs)
         return delete(url, **kwargs)
 
+    @traced('Object.adelete')
+    def adelete(self, **kwargs):
+        url, kwargs = self.build_delete_args(background=True, **kwargs)
+        return adelete(url, **kwargs)
+
+    @traced('Object.increment')
     def increment(self, key, amount=1, **kwargs):
         ignore_acl = kwargs.pop('ignore_acl', False)
         url = self.build_url(True)
         headers = build_headers(master_key=ignore_acl)
         data = json.dump({key: {'__op': 'Increment', 'amount': amount}})
         put(url, headers=headers, data=data)
+        invalidate_class(self.class_name)
+        self.uncache(headers)
         self[key] += amount
         self.clean(key=key)
 
+    @traced('Object.add_objects_to_array')
     def add_objects_to_array(self, key, objs, **kwargs):
         ignore_acl = kwargs.pop('ignore_acl', False)
         url = self.build_url(True)
         headers = build_headers(master_key=ignore_acl)
         data = json.dump({key: {'__op': 'Add', 'objects': objs}})
         put(url, headers=headers, data=data)
+        invalidate_class(self.class_name)
+        self.uncache(headers)
         self[key] = self[key] + objs
         self.clean(key=key)
 
+    @traced('Object.add_unique_objects_to_array')
     def add_unique_objects_to_array(self, key, objs, **kwargs):
         ignore_acl = kwargs.pop('ignore_acl', False)
         url = self.build_url(True)
         headers = build_headers(master_key=ignore_acl)
         data = json.dump({key: {'__op': 'AddUnique', 'objects': objs}})
         put(url, headers=headers, data=data)
+        invalidate_class(self.class_name)
+        self.uncache(headers)
         self[key] = list({obj for obj in (self[key] + objs)})
         self.clean(key=key)
 
+    @traced('Object.remove_objects_from_array')
     def remove_objects_from_array(self, key, objs, **kwargs):
         ignore_acl = kwargs.pop('ignore_acl', False)
         url = self.build_url(True)
         headers = build_headers(master_key=ignore_acl)
         data = json.dump({key: {'__op': 'Remove', 'objects': objs}})
         put(url, headers=headers, data=data)
+        invalidate_class(self.class_name)
+        self.uncache(headers)
         self[key] = [obj for obj in self[key] if obj not in objs]
         self.clean(key=key)
 
     @staticmethod
     def build_batch_url():
-        paths = [API_BASE_URL, API_VERSION, API_BATCH_PATH]
+        paths = [constants.API_BASE_URL, API_VERSION, API_BATCH_PATH]
         return '/'.join(paths)
 
     def build_batch_save_data(self):
@@ -340,11 +437,16 @@ class Object(dict):
     @staticmethod
     def handle_batch_save_result(response, **kwargs):
         objs = kwargs.pop('objs', None)
+        for class_name in set(obj.class_name for obj in objs):
+            invalidate_class(class_name)
+
+        headers = request_headers(response)
         errors = []
         for (obj, result) in zip(objs, json.load(response.text)):
             if 'success' in result:
                 obj.clean()
                 super(Object, obj).update(result['success'])
+                obj.cache_saved(headers)
             elif 'error' in result:
                 errors.append(result['error'])
             else:
@@ -357,6 +459,7 @@ class Object(dict):
     def build_batch_save_args(**kwargs):
         objs = kwargs.pop('objs', None)
         ignore_acl = kwargs.pop('ignore_acl', False)
+        background = kwargs.pop('background', False)
         callback = kwargs.pop('callback', None)
         requests = [obj.build_batch_save_data() for obj in objs]
 
@@ -364,7 +467,7 @@ class Object(dict):
         headers = build_headers(master_key=ignore_acl)
         data = json.dump({'requests': requests})
 
-        if callback is not None:
+        if background:
             callback = build_boolean_callback(
                 Object.handle_batch_save_result, objs=objs,
                 callback=callback, **kwargs)
@@ -372,16 +475,26 @@ class Object(dict):
         return (url, {'headers': headers, 'data': data, 'callback': callback})
 
     @staticmethod
+    @traced('Object.save_all')
     def save_all(objs, **kwargs):
         url, kwargs = Object.build_batch_save_args(objs=objs, **kwargs)
         return Object.handle_batch_save_result(post(url, **kwargs),
             objs=objs)
 
     @staticmethod
+    @traced('Object.save_all_in_background')
     def save_all_in_background(objs, **kwargs):
-        url, kwargs = Object.build_batch_save_args(objs=objs, **kwargs)
+        url, kwargs = Object.build_batch_save_args(objs=objs,
+            background=True, **kwargs)
         return post(url, **kwargs)
 
+    @staticmethod
+    @traced('Object.asave_all')
+    def asave_all(objs, **kwargs):
+        url, kwargs = Object.build_batch_save_args(objs=objs,
+            background=True, **kwargs)
+        return apost(url, **kwargs)
+
     def build_batch_refresh_data(self):
         return {
             'method': 'GET',
@@ -409,6 +522,7 @@ class Object(dict):
     def build_batch_refresh_args(**kwargs):
         objs = kwargs.pop('objs', None)
         ignore_acl = kwargs.pop('ignore_acl', False)
+        background = kwargs.pop('background', False)
         callback = kwargs.pop('callback', None)
         requests = [obj.build_batch_refresh_data() for obj in objs]
 
@@ -416,7 +530,7 @@ class Object(dict):
         headers = build_headers(master_key=ignore_acl)
         data = json.dump({'requests': requests})
 
-        if callback is not None:
+        if background:
             callback = build_boolean_callback(
                 Object.handle_batch_refresh_result, objs=objs,
                 callback=callback, **kwargs)
@@ -443,6 +557,40 @@ class Object(dict):
     # def fetch_all_in_background(objs, **kwargs):
     #     return self.refresh_all_in_background(objs, **kwargs)
 
+    @staticmethod
+    @traced('Object.fetch_missing')
+    def fetch_missing(objs, **kwargs):
+        """Fill in the keys a projected query left out of `objs`
+
+        One query is sent per class and `QUERY_MAX_LIMIT` objects. Keys
+        already set locally are kept.
+        """
+        partial = {}
+        for obj in objs:
+            if obj._projection is not None and obj.object_id is not None:
+                partial.setdefault(obj.class_name, {})[obj.object_id] = obj
+
+        for class_name, by_id in partial.items():
+            ids = list(by_id)
+            for i in range(0, len(ids), QUERY_MAX_LIMIT):
+                query = Query(class_name)
+                query.contained_in('objectId', *ids[i:i + QUERY_MAX_LIMIT])
+                query.limit = QUERY_MAX_LIMIT
+                for result in query.find(**kwargs):
+                    by_id[result.object_id].merge_fetched(result)
+
+        for by_id in partial.values():
+            for obj in by_id.values():
+                obj._projection = None
+
+    def merge_fetched(self, result):
+        for key, value in result.items():
+            if key not in self:
+                if isinstance(value, Relation):
+                    value.instance = self
+                    value.key = key
+                super(Object, self).__setitem__(key, value)
+
     def build_batch_delete_data(self):
         return {
             'method': 'DELETE',
@@ -453,9 +601,14 @@ class Object(dict):
     @staticmethod
     def handle_batch_delete_result(response, **kwargs):
         objs = kwargs.pop('objs', None)
+        for class_name in set(obj.class_name for obj in objs):
+            invalidate_class(class_name)
+
+        headers = request_headers(response)
         errors = []
         for (obj, result) in zip(objs, json.load(response.text)):
             if 'success' in result:
+                obj.uncache(headers)
                 obj.clean()
                 for key in ('objectId', 'createdAt', 'updatedAt'):
                     if key in obj:
@@ -472,6 +625,7 @@ class Object(dict):
     def build_batch_delete_args(**kwargs):
         objs = kwargs.pop('objs', None)
         ignore_acl = kwargs.pop('ignore_acl', False)
+        background = kwargs.pop('background', False)
         callback = kwargs.pop('callback', None)
         requests = [obj.build_batch_delete_data() for obj in objs]
 
@@ -479,7 +633,7 @@ class Object(dict):
         headers = build_headers(master_key=ignore_acl)
         data = json.dump({'requests': requests})
 
-        if callback is not None:
+        if background:
             callback = build_boolean_callback(
                 Object.handle_batch_delete_result, objs=objs,
                 callback=callback, **kwargs)
@@ -487,27 +641,37 @@ class Object(dict):
         return (url, {'headers': headers, 'data': data, 'callback': callback})
 
     @staticmethod
+    @traced('Object.delete_all')
     def delete_all(objs, **kwargs):
         url, kwargs = Object.build_batch_delete_args(objs=objs, **kwargs)
         return Object.handle_batch_delete_result(post(url, **kwargs),
             objs=objs)
 
     @staticmethod
+    @traced('Object.delete_all_in_background')
     def delete_all_in_background(objs, **kwargs):
         url, kwargs = Object.build_batch_delete_args(objs=objs,
-            **kwargs)
+            background=True, **kwargs)
         return post(url, **kwargs)
 
+    @staticmethod
+    @traced('Object.adelete_all')
+    def adelete_all(objs, **kwargs):
+        url, kwargs = Object.build_batch_delete_args(objs=objs,
+            background=True, **kwargs)
+        return apost(url, **kwargs)
+
 class User(Object):
     def __init__(self, *args, **kwargs):
-        try:
-            kwargs['username'] = args[0]
-            kwargs['password'] = args[1]
-        except KeyError:
+        if args and len(args) != 2:
             raise ValueError("User requires username and password")
 
         super(User, self).__init__('_User', **kwargs)
 
+        # set through the properties so sign up sends them
+        if args:
+            self.username, self.password = args
+
     @property
     def username(self):
         return self['username'] if 'username' in self else None
@@ -540,21 +704,20 @@ class User(Object):
         return self.session_token is not None
 
     def build_url(self, object_id=False):
-        paths = [API_BASE_URL, API_VERSION, API_USERS_PATH]
+        paths = [constants.API_BASE_URL, API_VERSION, API_USERS_PATH]
 
         if object_id and self.object_id is not None:
             paths.append(self.object_id)
 
-        print '/'.join(paths)
         return '/'.join(paths)
 
     @staticmethod
     def build_login_url(self):
-        paths = [API_BASE_URL, API_VERSION, API_LOGIN_PATH]
+        paths = [constants.API_BASE_URL, API_VERSION, API_LOGIN_PATH]
         return '/'.join(paths)
 
     def build_password_reset_url(self):
-        paths = [API_BASE_URL, API_VERSION, API_PASSWORD_RESET_PATH]
+        paths = [constants.API_BASE_URL, API_VERSION, API_PASSWORD_RESET_PATH]
         return '/'.join(paths)
 
     def sign_up(self):
@@ -563,8 +726,12 @@ class User(Object):
     def sign_up_in_background(self, **kwargs):
         return self.save_in_background(**kwargs)
 
+    def asign_up(self, **kwargs):
+        return self.asave(**kwargs)
+
     @staticmethod
     def build_login_args(user, username, password, **kwargs):
+        background = kwargs.pop('background', False)
         callback = kwargs.pop('callback', None)
 
         url = self.build_login_url()
@@ -572,7 +739,7 @@ class User(Object):
         data = urllib.urlencode({'username': username,
             'password': password})
 
-        if callback is not None:
+        if background:
             callback = build_boolean_callback(User.handle_login_result,
                 objs=user, callback=callback, **kwargs)
 
@@ -586,16 +753,18 @@ class User(Object):
         return user
 
     @staticmethod
+    @traced('User.login')
     def login(username, password):
         user = User()
         url, kwargs = User.build_login_args(user, username, password)
         return User.handle_login_result(user, get(url, **kwargs))
 
     @staticmethod
+    @traced('User.login_in_background')
     def login_in_background(username, password, **kwargs):
         user = User()
         url, kwargs = User.build_login_args(user, username, password,
-            **kwargs)
+            background=True, **kwargs)
         return get(url, **kwargs)
 
     def log_out(self):
@@ -607,13 +776,14 @@ class User(Object):
 
     @staticmethod
     def build_request_password_reset_args(email, **kwargs):
+        background = kwargs.pop('background', False)
         callback = kwargs.pop('callback', None)
 
         url = self.build_password_reset_url()
         headers = build_headers()
         data = json.dump({'email': email})
 
-        if callback is not None:
+        if background:
             callback = build_boolean_callback(
                 User.handle_request_password_reset, callback=callback,
                 **kwargs)
@@ -622,24 +792,193 @@ class User(Object):
             callback})
 
     @staticmethod
+    @traced('User.request_password_reset')
     def request_password_reset(email):
         url, kwargs = User.build_request_password_reset_args(email)
         return User.handle_request_password_reset(post(url, **kwargs))
 
     @staticmethod
+    @traced('User.request_password_reset_in_background')
     def request_password_reset_in_background(email, **kwargs):
         url, kwargs = User.build_request_password_reset_args(email,
-            **kwargs)
+            background=True, **kwargs)
         return post(url, **kwargs)
 
     @staticmethod
     def query():
         return Query(CLASS_TYPE_USER)
 
+class LazyValues(object):
+    """Keeps the JSON for a fetched object raw until each key is read
+
+    `Query.find(lazy=True)` and its variants return these. Dates,
+    pointers, geopoints, bytes and relations are built the first time
+    their key is read, so rows where only a few keys are used skip most
+    of the decoding. Everything else behaves as for `Object`.
+    """
+
+    def __init__(self, class_name, data):
+        self._created_at = False
+        self._updated_at = False
+        self.has_geopoint = False
+        self.dirty_keys = []
+        self._decode_class_name = class_name
+        # keys whose plain dict or list value is already decoded
+        self._decoded = set()
+
+        dict.__setitem__(self, '__type', 'Object')
+        dict.__setitem__(self, 'className', class_name)
+        dict.update(self, data)
+
+    def is_raw(self, key, value):
+        return type(value) in (dict, list) and key not in self._decoded
+
+    def decode(self, key, value):
+        value = json.decode_value(value, self._decode_class_name)
+        if isinstance(value, Relation):
+            value.instance = self
+            value.key = key
+
+        dict.__setitem__(self, key, value)
+        self._decoded.add(key)
+        return value
+
+    def decode_all(self):
+        for key, value in dict.items(self):
+            if self.is_raw(key, value):
+                self.decode(key, value)
+
+    def __getitem__(self, key):
+        value = dict.__getitem__(self, key)
+        if self.is_raw(key, value):
+            return self.decode(key, value)
+        return value
+
+    def __setitem__(self, key, value):
+        super(LazyValues, self).__setitem__(key, value)
+        self._decoded.add(key)
+
+    def __delitem__(self, key):
+        super(LazyValues, self).__delitem__(key)
+        self._decoded.discard(key)
+
+    def get(self, key, default=None):
+        return self[key] if key in self else default
+
+    def pop(self, key, *args):
+        if key in self:
+            self[key]
+            self._decoded.discard(key)
+        return dict.pop(self, key, *args)
+
+    def values(self):
+        self.decode_all()
+        return dict.values(self)
+
+    def items(self):
+        self.decode_all()
+        return dict.items(self)
+
+    def itervalues(self):
+        self.decode_all()
+        return dict.itervalues(self)
+
+    def iteritems(self):
+        self.decode_all()
+        return dict.iteritems(self)
+
+    def merge_refreshed(self, result):
+        result = super(LazyValues, self).merge_refreshed(result)
+        self._decoded.update(dict.keys(self))
+        return result
+
+class LazyObject(LazyValues, Object):
+    pass
+
+class LazyUser(LazyValues, User):
+    def __init__(self, data):
+        super(LazyUser, self).__init__(CLASS_TYPE_USER, data)
+
+class Projection(object):
+    """The keys a projected query fetched, shared by the objects it
+    returned so that reading a missing key can fetch them all at once"""
+
+    def __init__(self, keys=None, exclude_keys=None, fetch_missing=False):
+        self.keys = None
+        if keys:
+            self.keys = set(key.split('.')[0] for key in keys) | \
+                set(QUERY_PROJECTION_KEYS)
+        self.exclude_keys = set(exclude_keys or ())
+        self.fetch_missing = fetch_missing
+        self.objects = []
+        self.lock = threading.Lock()
+
+    def is_missing(self, key):
+        if self.keys is not None and key not in self.keys:
+            return True
+        return key in self.exclude_keys
+
+    def add(self, obj):
+        if isinstance(obj, Object) and obj.object_id is not None:
+            obj._projection = self
+            self.objects.append(weakref.ref(obj))
+
+    def fetch(self):
+        with self.lock:
+            objs = [ref() for ref in self.objects]
+            objs = [obj for obj in objs
+                if obj is not None and obj._projection is self]
+            Object.fetch_missing(objs)
+
+def load_object(class_name, response):
+    """Decode the object in a response, keeping it in the object cache"""
+    object_cache = get_object_cache()
+    if object_cache is None:
+        return json.load(response.text, class_name=class_name)
+
+    data = json.load_raw(response.text)
+    object_cache.add(class_name, data, request_headers(response))
+    return json.decode_value(data, class_name)
+
+def get_object_data(class_name, object_id, url, **kwargs):
+    """The JSON of an object from the object cache, else from `url`,
+    raising for objects recently found missing"""
+    object_cache = get_object_cache()
+    headers = kwargs.get('headers')
+    key = object_cache.build_key(class_name, object_id, headers)
+
+    data = object_cache.get(key)
+    if isinstance(data, Missing):
+        raise data.exception()
+    elif data is not None:
+        return data
+
+    try:
+        response = get(url, **kwargs)
+    except ParseException as e:
+        if e.code == ERROR_OBJECT_NOT_FOUND:
+            object_cache.set_missing(key, e)
+        raise
+
+    data = json.load_raw(response.text)
+    object_cache.add(class_name, data, headers)
+    return data
+
+def build_lazy_object(class_name, data):
+    """What `json.load` would make of `data`, but decoded on demand"""
+    if not ('objectId' in data and 'createdAt' in data and
+        'updatedAt' in data):
+        return json.decode_value(data, class_name)
+    elif class_name != CLASS_TYPE_USER:
+        return LazyObject(class_name, data)
+    else:
+        return LazyUser(data)
+
 class Query(object):
     def __init__(self, class_name):
         self._class_name = class_name
         self.ignore_acl = False
+        self.fetch_missing = False
         self.data = {}
         self._limit = QUERY_DEFAULT_LIMIT
         self._skip = QUERY_DEFAULT_SKIP
@@ -677,7 +1016,7 @@ class Query(object):
             del self.data['skip']
 
     def build_url(self, object_id=None):
-        paths = [API_BASE_URL, API_VERSION]
+        paths = [constants.API_BASE_URL, API_VERSION]
 
         try:
             paths.append(CLASS_PATHS[self.class_name])
@@ -787,6 +1126,35 @@ class Query(object):
         self.data['include'] = ','.join(data)
         return self
 
+    def keys(self, *keys, **kwargs):
+        """Only fetch these keys, reading any other raises
+        `UnfetchedKeyError`, or fetches it for every object of the page
+        when `fetch_missing` is set"""
+        self.data['keys'] = ','.join(keys)
+        self.fetch_missing = kwargs.pop('fetch_missing', self.fetch_missing)
+        return self
+
+    def exclude_keys(self, *keys, **kwargs):
+        self.data['excludeKeys'] = ','.join(keys)
+        self.fetch_missing = kwargs.pop('fetch_missing', self.fetch_missing)
+        return self
+
+    def build_projection(self):
+        if 'keys' not in self.data and 'excludeKeys' not in self.data:
+            return None
+
+        keys, exclude_keys = [[k for k in self.data.get(name, '').split(',')
+            if k] for name in ('keys', 'excludeKeys')]
+        return Projection(keys, exclude_keys, self.fetch_missing)
+
+    def project(self, objs):
+        """Mark objects found by a projected query with what is missing"""
+        projection = self.build_projection()
+        if projection is not None:
+            for obj in objs:
+                projection.add(obj)
+        return objs
+
     def related_to(self, obj, key):
         value = {
             'object': obj.object_without_data(),
@@ -803,28 +1171,44 @@ class Query(object):
 
     def build_get_args(self, object_id, **kwargs):
         ignore_acl = kwargs.pop('ignore_acl', False)
+        background = kwargs.pop('background', False)
         callback = kwargs.pop('callback', None)
+        coalesce = kwargs.pop('coalesce', None)
+        kwargs.pop('cache', None)
 
         url = self.build_url(object_id)
         headers = build_headers(master_key=ignore_acl)
 
-        if callback is not None:
+        if background:
             callback = build_object_callback(self.handle_get_result,
                 callback=callback, **kwargs)
 
-        return (url, {'headers': headers, 'callback': callback})
+        return (url, {'headers': headers, 'callback': callback, 'coalesce':
+            coalesce})
 
     def handle_get_result(self, response, **kwargs):
-        return json.load(response.text, class_name=self.class_name)
+        return load_object(self.class_name, response)
 
+    @traced('Query.get')
     def get(self, object_id, **kwargs):
+        cache = kwargs.pop('cache', True)
         url, kwargs = self.build_get_args(object_id, **kwargs)
-        return self.handle_get_result(get(url, **kwargs))
+        if not cache or get_object_cache() is None:
+            return self.handle_get_result(get(url, **kwargs))
 
+        data = get_object_data(self.class_name, object_id, url, **kwargs)
+        return json.decode_value(data, self.class_name)
+
+    @traced('Query.get_in_background')
     def get_in_background(self, object_id, **kwargs):
-        url, kwargs = self.build_get_args(object_id, **kwargs)
+        url, kwargs = self.build_get_args(object_id, background=True, **kwargs)
         return get(url, **kwargs)
 
+    @traced('Query.aget')
+    def aget(self, object_id, **kwargs):
+        url, kwargs = self.build_get_args(object_id, background=True, **kwargs)
+        return aget(url, **kwargs)
+
     def build_query_data(self):
         data = dict(self.data)
         if 'where' in data:
@@ -833,60 +1217,299 @@ class Query(object):
 
     def build_count_args(self, **kwargs):
         ignore_acl = kwargs.pop('ignore_acl', False)
+        background = kwargs.pop('background', False)
         callback = kwargs.pop('callback', None)
+        coalesce = kwargs.pop('coalesce', None)
+        kwargs.pop('cache', None)
 
         url = self.build_url()
         headers = build_headers(master_key=ignore_acl)
-        data = build_query_data()
+        data = self.build_query_data()
 
-        if callback is not None:
+        if background:
             callback = build_integer_callback(self.handle_count_result,
                 callback=callback, **kwargs)
 
         return (url, {'headers': headers, 'data': data, 'callback':
-            callback})
+            callback, 'coalesce': coalesce})
 
     def handle_count_result(self, response, **kwargs):
         result = json.load(response.text, class_name=self.class_name)
         return result['count']
 
+    def get_cached(self, url, cache=True, **kwargs):
+        """`get` through the query cache, when one is configured"""
+        query_cache = get_query_cache()
+        if not cache or query_cache is None:
+            return get(url, **kwargs)
+
+        key = query_cache.build_key(self.class_name, kwargs.get('data'),
+            kwargs.get('headers'))
+        text = query_cache.get(key)
+        if text is not None:
+            return CachedResponse(text)
+
+        generation = query_cache.generation(self.class_name)
+        response = get(url, **kwargs)
+        query_cache.set(key, response.text, generation)
+        return response
+
+    @traced('Query.count')
     def count(self, **kwargs):
+        cache = kwargs.pop('cache', True)
         self.data['count'] = 1
         url, kwargs = self.build_count_args(**kwargs)
-        return self.handle_count_result(get(url, **kwargs))
+        return self.handle_count_result(self.get_cached(url, cache,
+            **kwargs))
 
+    @traced('Query.count_in_background')
     def count_in_background(self, **kwargs):
         self.data['count'] = 1
-        url, kwargs = self.build_count_args(**kwargs)
+        url, kwargs = self.build_count_args(background=True, **kwargs)
         return get(url, **kwargs)
 
+    @traced('Query.acount')
+    def acount(self, **kwargs):
+        self.data['count'] = 1
+        url, kwargs = self.build_count_args(background=True, **kwargs)
+        return aget(url, **kwargs)
+
     def build_find_args(self, **kwargs):
         ignore_acl = kwargs.pop('ignore_acl', False)
+        background = kwargs.pop('background', False)
         callback = kwargs.pop('callback', None)
+        lazy = kwargs.pop('lazy', False)
+        coalesce = kwargs.pop('coalesce', None)
+        kwargs.pop('cache', None)
 
         url = self.build_url()
         headers = build_headers(master_key=ignore_acl)
         data = self.build_query_data()
 
-        if callback is not None:
-            callback = build_list_callback(self.handle_find_result,
-                callback=callback, **kwargs)
+        if background:
+            handler = self.handle_lazy_find_result if lazy else \
+                self.handle_find_result
+            callback = build_list_callback(handler, callback=callback,
+                **kwargs)
 
         return (url, {'headers': headers, 'data': data, 'callback':
-            callback})
+            callback, 'coalesce': coalesce})
+
+    def cache_results(self, results, response):
+        """Keep the objects a find returned in the object cache"""
+        object_cache = get_object_cache()
+        if object_cache is None or self.build_projection() is not None:
+            return
+
+        headers = request_headers(response)
+        for data in results:
+            object_cache.add(self.class_name, data, headers)
 
     def handle_find_result(self, response, **kwargs):
+        if get_object_cache() is not None:
+            # decode from the plain JSON so it can be cached as it is
+            results = json.load_raw(response.text)['results']
+            self.cache_results(results, response)
+            return self.project([json.decode_value(data, self.class_name)
+                for data in results])
+
         result = json.load(response.text, class_name=self.class_name)
-        return result['results']
+        return self.project(result['results'])
+
+    def handle_lazy_find_result(self, response, **kwargs):
+        result = json.load_raw(response.text)
+        self.cache_results(result['results'], response)
+        return self.project([build_lazy_object(self.class_name, data)
+            for data in result['results']])
 
+    @traced('Query.find')
     def find(self, **kwargs):
+        handler = self.handle_lazy_find_result if kwargs.get('lazy') else \
+            self.handle_find_result
+        cache = kwargs.pop('cache', True)
         url, kwargs = self.build_find_args(**kwargs)
-        return self.handle_find_result(get(url, **kwargs))
+        return handler(self.get_cached(url, cache, **kwargs))
 
-    def find_in_background(self, **kwargs):
+    def handle_iter_find_result(self, response, **kwargs):
+        chunks = response.iter_content(QUERY_STREAM_CHUNK_SIZE,
+            decode_unicode=True)
+        projection = self.build_projection()
+        try:
+            for obj in json.iter_results(chunks, self.class_name):
+                if projection is not None:
+                    projection.add(obj)
+                yield obj
+        finally:
+            response.close()
+
+    @traced('Query.iter_find')
+    def iter_find(self, **kwargs):
+        """Like `find`, but yields each object as it is read from the
+        response instead of holding the whole page in memory"""
         url, kwargs = self.build_find_args(**kwargs)
+        return self.handle_iter_find_result(get(url, stream=True, **kwargs))
+
+    def build_keyset_order(self):
+        """Order keys for paging, always ending in objectId"""
+        order = [k for k in self.data.get('order', '').split(',') if k]
+        order = [k for k in order if k.lstrip('-') != 'objectId'] + \
+            [k for k in order if k.lstrip('-') == 'objectId'][:1]
+
+        if not order or order[-1].lstrip('-') != 'objectId':
+            descending = order and order[-1].startswith('-')
+            order.append('-objectId' if descending else 'objectId')
+        return order
+
+    def build_keyset_where(self, order, values):
+        """The `where` for objects after `values` of the `order` keys"""
+        where = self.data.get('where', {})
+        if '$or' in where:
+            raise ValueError("Cannot page through an $or query by key")
+
+        clauses = []
+        for i, key in enumerate(order):
+            clause = dict(where)
+            for previous, value in zip(order[:i], values[:i]):
+                clause[previous.lstrip('-')] = value
+
+            name = key.lstrip('-')
+            op, inclusive = ('$lt', '$lte') if key.startswith('-') else \
+                ('$gt', '$gte')
+            condition = where.get(name)
+            if condition is not None and not (isinstance(condition, dict)
+                and all(k.startswith('$') for k in condition)):
+                # an equality constraint, nothing comes after it
+                continue
+
+            condition = dict(condition or {})
+            condition.pop(inclusive, None)
+            condition[op] = values[i]
+            clause[name] = condition
+            clauses.append(clause)
+
+        if len(clauses) == 1:
+            return clauses[0]
+        return {'$or': clauses}
+
+    def copy(self):
+        query = Query(self.class_name)
+        query.fetch_missing = self.fetch_missing
+        query.data = dict(self.data)
+        if 'where' in self.data:
+            query.data['where'] = dict(self.data['where'])
+        return query
+
+    def build_page_query(self, order, values, page_size):
+        query = self.copy()
+        for key in ('skip', 'count', 'limit'):
+            query.data.pop(key, None)
+        query.data['order'] = ','.join(order)
+        query.data['limit'] = page_size
+
+        # the cursor needs the order keys of each page's last object
+        if query.data.get('keys'):
+            keys = query.data['keys'].split(',')
+            query.data['keys'] = ','.join(keys + [k.lstrip('-')
+                for k in order if k.lstrip('-') not in keys])
+
+        if values is not None:
+            query.data['where'] = self.build_keyset_where(order, values)
+        return query
+
+    def iter_all(self, page_size=QUERY_MAX_LIMIT, read_ahead=True,
+        **kwargs):
+        """Yield every matching object, a page at a time
+
+        Pages follow on from the last object's order keys, with objectId
+        breaking ties, rather than using `skip`, which slows down as it
+        grows. The query's own `limit` and `skip` are ignored. With
+        `read_ahead` the next page is fetched in the background while this
+        one is consumed, so at most two pages are held.
+        """
+        for page in self.iter_pages(page_size, read_ahead, **kwargs):
+            for obj in page:
+                yield obj
+
+    def build_cursor(self, order, obj):
+        """The values of the `order` keys that a page ending in `obj` is
+        followed on from"""
+        return [keyset_value(obj, k.lstrip('-')) for k in order]
+
+    def iter_pages(self, page_size=QUERY_MAX_LIMIT, read_ahead=True,
+        cursor=None, **kwargs):
+        """Yield the pages of `iter_all` as lists, starting after `cursor`
+        when given, see `build_cursor`"""
+        # pages are read once, caching them would only push out results
+        kwargs.setdefault('cache', False)
+        order = self.build_keyset_order()
+        page = self.build_page_query(order, cursor, page_size).find(
+            **kwargs)
+        pending = None
+
+        try:
+            while page:
+                query = None
+                if len(page) == page_size:
+                    query = self.build_page_query(order,
+                        self.build_cursor(order, page[-1]), page_size)
+                    if read_ahead:
+                        pending = query.find_in_background(**kwargs)
+
+                yield page
+
+                page = None
+                if pending is not None:
+                    page, pending = pending.result(), None
+                elif query is not None:
+                    page = query.find(**kwargs)
+        finally:
+            if pending is not None:
+                pending.cancel()
+
+    @traced('Query.each')
+    def each(self, callback, **kwargs):
+        """Call `callback(obj)` for every matching object, see `iter_all`,
+        returns how many there were"""
+        count = 0
+        for obj in self.iter_all(**kwargs):
+            callback(obj)
+            count += 1
+        return count
+
+    @traced('Query.parallel_scan')
+    def parallel_scan(self, workers=4, key='objectId', partitions=None,
+        bounds=None, ordered=None, page_size=QUERY_MAX_LIMIT, **kwargs):
+        """Iterate every matching object with `workers` concurrent queries
+
+        The query is split into disjoint ranges of `key`: objectId by
+        leading character, numbers and dates such as createdAt evenly
+        between their lowest and highest values, or at `bounds`. Pass
+        `partitions` to choose the `Partition`s directly. Each range is
+        paged through as by `iter_pages`.
+
+        Objects come out as pages arrive unless `ordered`, by default when
+        the query has an order, in which case the ranges run together and
+        are merged on the order keys. Close the returned scan to stop early.
+        """
+        if partitions is None:
+            partitions = build_partitions(self, key, workers, bounds,
+                **kwargs)
+        if ordered is None:
+            ordered = 'order' in self.data
+
+        return ParallelScan(self, partitions, workers, ordered, page_size,
+            read_ahead=False, **kwargs)
+
+    @traced('Query.find_in_background')
+    def find_in_background(self, **kwargs):
+        url, kwargs = self.build_find_args(background=True, **kwargs)
         return get(url, **kwargs)
 
+    @traced('Query.afind')
+    def afind(self, **kwargs):
+        url, kwargs = self.build_find_args(background=True, **kwargs)
+        return aget(url, **kwargs)
+
 class Relation(object):
     def __init__(self, class_name):
         self.class_name = class_name
@@ -907,6 +1530,7 @@ class Relation(object):
 
         return self.key in RELATION_ROLE_KEYS
 
+    @traced('Relation.request_relation')
     def request_relation(self, op, *objs):
         if op not in RELATION_OPS:
             raise ValueError('%s is not a valid operation' % (op))
@@ -1025,7 +1649,7 @@ class Role(Object):
         return self['roles'] if 'roles' in self else None
 
     def build_url(self, object_id=False):
-        paths = [API_BASE_URL, API_VERSION, API_ROLES_PATH]
+        paths = [constants.API_BASE_URL, API_VERSION, API_ROLES_PATH]
 
         if object_id and self.object_id is not None:
             paths.append(self.object_id)
@@ -1069,11 +1693,13 @@ class File(object):
         return mime_type
 
     def build_url(self):
-        paths = [API_BASE_URL, API_VERSION, API_FILES_PATH, self.name]
+        paths = [constants.API_BASE_URL, API_VERSION, API_FILES_PATH,
+            self.name]
         return '/'.join(paths)
 
     def build_save_args(self, **kwargs):
         ignore_acl = kwargs.pop('ignore_acl', False)
+        background = kwargs.pop('background', False)
         callback = kwargs.pop('callback', None)
 
         url = self.build_url()
@@ -1081,7 +1707,7 @@ class File(object):
             mime_type=self.guess_mime_type())
         data = self.data
 
-        if callback is not None:
+        if background:
             callback = build_boolean_callback(self.handle_save_result,
                 callback=callback, **kwargs)
 
@@ -1093,22 +1719,30 @@ class File(object):
         self._url = result['url']
         self.mime_type = self.guess_mime_type()
 
+    @traced('File.save')
     def save(self, **kwargs):
         url, kwargs = self.build_save_args(**kwargs)
         return self.handle_save_result(post(url, **kwargs))
 
+    @traced('File.save_in_background')
     def save_in_background(self, **kwargs):
-        url, kwargs = self.build_save_args(**kwargs)
+        url, kwargs = self.build_save_args(background=True, **kwargs)
         return post(url, **kwargs)
 
+    @traced('File.asave')
+    def asave(self, **kwargs):
+        url, kwargs = self.build_save_args(background=True, **kwargs)
+        return apost(url, **kwargs)
+
     def build_get_data_args(self, **kwargs):
         ignore_acl = kwargs.pop('ignore_acl', False)
+        background = kwargs.pop('background', False)
         callback = kwargs.pop('callback', None)
 
         url = self.url
         headers = build_headers(master_key=ignore_acl, mime_type=None)
 
-        if callback is not None:
+        if background:
             callback = build_bytes_callback(self.handle_get_data_result,
                 callback=callback, **kwargs)
 
@@ -1117,6 +1751,7 @@ class File(object):
         self.mime_type = mime_type
         self._data = data
 
+    @traced('File.get_data')
     def get_data(self, **kwargs):
         if self.is_dirty() or self.is_data_available():
             raise ValueError("Hasn't been saved")
@@ -1124,21 +1759,23 @@ class File(object):
         url, kwargs = self.build_get_data_args(**kwargs)
         return self.handle_get_data_result(get(url, **kwargs))
 
+    @traced('File.get_data_in_background')
     def get_data_in_background(self, **kwargs):
         if self.is_dirty() or self.is_data_available():
             raise ValueError("Hasn't been saved")
 
-        url, kwargs = self.build_get_data_args(**kwargs)
+        url, kwargs = self.build_get_data_args(background=True, **kwargs)
         return get(url, **kwargs)
 
     def build_delete_args(self, **kwargs):
         ignore_acl = kwargs.pop('ignore_acl', False)
+        background = kwargs.pop('background', False)
         callback = kwargs.pop('callback', None)
 
         url = self.build_url()
         headers = build_headers(master_key=True)
 
-        if callback is not None:
+        if background:
             callback = build_boolean_callback(self.handle_delete_result,
                 callback=callback, **kwargs)
 
@@ -1148,21 +1785,25 @@ class File(object):
         del self.data
         return True
 
+    @traced('File.delete')
     def delete(self, **kwargs):
         url, kwargs = self.build_delete_args(**kwargs)
         return self.handle_delete_result(delete(url, **kwargs))
 
+    @traced('File.delete_in_background')
     def delete_in_background(self, **kwargs):
-        url, kwargs = self.build_delete_args(**kwargs)
+        url, kwargs = self.build_delete_args(background=True, **kwargs)
         return delete(url, **kwargs)
 
 class Analytics(object):
     @staticmethod
     def build_url(event_name):
-        paths = [API_BASE_URL, API_VERSION, API_EVENTS_PATH, event_name]
+        paths = [constants.API_BASE_URL, API_VERSION, API_EVENTS_PATH,
+            event_name]
         return '/'.join(paths)
 
     @staticmethod
+    @traced('Analytics.track_app_opened')
     def track_app_opened(at=None):
         url = Analytics.build_url('AppOpened')
         headers = build_headers()
@@ -1170,6 +1811,7 @@ class Analytics(object):
         post(url, headers=headers, data=data)
 
     @staticmethod
+    @traced('Analytics.track_event')
     def track_event(event_name, at=None, dimensions=None):
         dimensions = dimensions if dimensions is not None else {}
         url = Analytics.build_url(event_name)
@@ -1275,7 +1917,7 @@ class Push(object):
         self._query = query
 
     def build_url(self):
-        paths = [API_BASE_URL, API_VERSION, API_PUSH_PATH]
+        paths = [constants.API_BASE_URL, API_VERSION, API_PUSH_PATH]
         return '/'.join(paths)
 
     def build_send_data(self):
@@ -1291,26 +1933,34 @@ class Push(object):
         return True
 
     def build_send_args(self, **kwargs):
+        background = kwargs.pop('background', False)
         callback = kwargs.pop('callback', None)
 
         url = self.build_url()
         headers = build_headers()
         data = self.build_send_data()
 
-        if callback is not None:
+        if background:
             callback = build_boolean_callback(self.handle_send_result,
                 callback=callback, **kwargs)
 
         return (url, {'headers': headers, 'data': data, 'callback': callback})
 
+    @traced('Push.send')
     def send(self, **kwargs):
         url, kwargs = self.build_send_args(**kwargs)
         return self.handle_send_result(post(url, **kwargs))
 
+    @traced('Push.send_in_background')
     def send_in_background(self, **kwargs):
-        url, kwargs = self.build_send_args(**kwargs)
+        url, kwargs = self.build_send_args(background=True, **kwargs)
         return post(url, **kwargs)
 
+    @traced('Push.asend')
+    def asend(self, **kwargs):
+        url, kwargs = self.build_send_args(background=True, **kwargs)
+        return apost(url, **kwargs)
+
 class Installation(Object):
     def __init__(self, device_type, installation_id, device_token=None,
         badge=None, timezone=None, channels=None, **kwargs):
@@ -1397,7 +2047,7 @@ class Installation(Object):
             pass
 
     def build_url(self, object_id=False):
-        paths = [API_BASE_URL, API_VERSION, API_INSTALLATIONS_PATH]
+        paths = [constants.API_BASE_URL, API_VERSION, API_INSTALLATIONS_PATH]
 
         if object_id and self.object_id is not None:
             paths.append(self.object_id)
@@ -1411,23 +2061,27 @@ class Installation(Object):
 class Cloud(object):
     @staticmethod
     def build_url(fn):
-        paths = [API_BASE_URL, API_VERSION, API_FUNCTIONS_PATH, fn]
+        paths = [constants.API_BASE_URL, API_VERSION, API_FUNCTIONS_PATH, fn]
         return '/'.join(paths)
 
     @staticmethod
     def build_function_args(fn, params=None, **kwargs):
+        background = kwargs.pop('background', False)
         callback = kwargs.pop('callback', None)
+        # functions may write, so they are only coalesced when asked to be
+        coalesce = kwargs.pop('coalesce', False)
 
         url = Cloud.build_url(fn)
         headers = build_headers()
         params = params if params is not None else {}
         data = json.dump(params)
 
-        if callback is not None:
+        if background:
             callback = build_object_callback(Cloud.handle_function_result,
                 callback=callback, **kwargs)
 
-        return (url, {'headers': headers, 'data': data, 'callback': callback})
+        return (url, {'headers': headers, 'data': data, 'callback': callback,
+            'coalesce': coalesce})
 
     @staticmethod
     def handle_function_result(response, **kwargs):
@@ -1441,15 +2095,25 @@ class Cloud(object):
             raise e
 
     @staticmethod
+    @traced('Cloud.call_function')
     def call_function(fn, params=None, **kwargs):
         url, kwargs = Cloud.build_function_args(fn, params, **kwargs)
-        Cloud.handle_function_result(post(url, **kwargs))
+        return Cloud.handle_function_result(post(url, **kwargs))
 
     @staticmethod
+    @traced('Cloud.call_function_in_background')
     def call_function_in_background(fn, params=None, **kwargs):
-        url, kwargs = Cloud.build_function_args(fn, params, **kwargs)
+        url, kwargs = Cloud.build_function_args(fn, params,
+            background=True, **kwargs)
         return post(url, **kwargs)
 
+    @staticmethod
+    @traced('Cloud.acall_function')
+    def acall_function(fn, params=None, **kwargs):
+        url, kwargs = Cloud.build_function_args(fn, params,
+            background=True, **kwargs)
+        return apost(url, **kwargs)
+
 class GeoPoint(object):
     def __init__(self, latitude, longitude):
         self.latitude = latitude
@@ -54,13 +54,17 @@ import cgi
 import collections
 import cookielib
 import datetime
+import errno
+import heapq
 import httplib
 import json
+import select
 import socket
 import threading
+import time
 import urllib
-import urllib2
 import zlib
+import Queue
 import StringIO
 
 from urlparse import urlparse, urlunparse
@@ -78,6 +82,25 @@ if PLATFORM['implementation'] == 'Google App Engine':
 CONTENT_CHUNK_SIZE = 10 * 1024
 ITER_CHUNK_SIZE = 10 * 1024
 
+POOL_MAXSIZE = 10
+POOL_IDLE_TIMEOUT = 60
+POOL_BLOCK = False
+
+EXECUTOR_WORKERS = 8
+EXECUTOR_QUEUE_SIZE = 1024
+# threads started to cover workers blocked on other requests
+EXECUTOR_MAX_SPARES = 8
+# seconds a spare worker waits for a call before checking whether it is
+# still needed
+EXECUTOR_SPARE_POLL = 0.1
+
+EVENT_LOOP_MAX_CONNECTIONS = 100
+EVENT_LOOP_RECV_SIZE = 64 * 1024
+
+DNS_CACHE_TTL = 60
+DNS_CACHE_MAXSIZE = 256
+TLS_SESSION_CACHE_SIZE = 64
+
 try:
     import ssl
 except:
@@ -390,6 +413,12 @@ class InvalidURL(RequestException, ValueError):
 class ResponseTooLarge(RequestException):
     """The response from the server was too large."""
 
+class CancelledError(Exception):
+    """The background request was cancelled before it started."""
+
+class TimeoutError(Exception):
+    """Timed out waiting for a background request to finish."""
+
 
 """
 Cookies
@@ -486,10 +515,7 @@ def extract_cookies_to_jar(jar, request, response):
     
     # pull out the HTTPMessage with the headers and put it in the mock:
     if PLATFORM['implementation'] != 'Google App Engine':
-        try:
-            res = MockResponse(response.fp._sock.msg)       # response
-        except AttributeError:
-            res = MockResponse(response.fp.fp._sock.msg)    # HTTP error
+        res = MockResponse(response.msg)
     else:
         res = MockResponse(response.header_msg)
     jar.extract_cookies(res, req)
@@ -801,6 +827,82 @@ Models
 
 """
 
+TIMING_HOOKS = []
+
+class Timing(object):
+    """Where the time went, and how many bytes moved, for one request
+
+    Phases are in seconds: `queue` waiting for a pooled connection, then
+    `dns`, `connect` and `tls` for new connections, `send` writing the
+    request, `wait` until the response headers arrive and `receive`
+    reading the body. Reused connections skip the setup phases.
+    """
+
+    PHASES = ('queue', 'dns', 'connect', 'tls', 'send', 'wait', 'receive')
+
+    def __init__(self, method=None, url=None, data=None):
+        if isinstance(data, unicode):
+            data = data.encode('utf-8')
+
+        self.method = method
+        self.url = url
+        self.started = self.last = time.time()
+        self.phases = dict((phase, 0.0) for phase in self.PHASES)
+        self.total = 0.0
+        self.reused = False
+        self.status_code = None
+        self.error = None
+        self.request_bytes = len(data or bytes())
+        self.response_bytes = 0
+        self.response_bytes_decoded = 0
+
+    def __repr__(self):
+        return '<Timing [%s %.3fs]>' % (self.method, self.total)
+
+    def mark(self, phase):
+        """Charge the time since the previous mark to `phase`"""
+        now = time.time()
+        self.phases[phase] += now - self.last
+        self.last = now
+
+    def finish(self, response=None, error=None):
+        """Stop the clock and publish the record to `TIMING_HOOKS`"""
+        self.total = time.time() - self.started
+        self.error = error
+
+        if response is not None:
+            self.status_code = response.status_code
+            response.elapsed = datetime.timedelta(seconds=self.total)
+            response.timing = self
+
+        for hook in list(TIMING_HOOKS):
+            try:
+                hook(self)
+            except Exception:
+                # instrumentation must never fail the request it measures
+                pass
+
+    def as_dict(self):
+        record = dict(self.phases)
+        record.update({
+            'method': self.method,
+            'url': self.url,
+            'total': self.total,
+            'reused': self.reused,
+            'status_code': self.status_code,
+            'error': type(self.error).__name__ if self.error else None,
+            'request_bytes': self.request_bytes,
+            'response_bytes': self.response_bytes,
+            'response_bytes_decoded': self.response_bytes_decoded
+        })
+        return record
+
+def stream_count(iterator, timing):
+    """Counts decoded body bytes into `timing` as they are read"""
+    for chunk in iterator:
+        timing.response_bytes_decoded += len(chunk)
+        yield chunk
+
 class Request(object):
     """HTTP request"""
     
@@ -810,7 +912,8 @@ class Request(object):
         headers=None,
         data=None,
         cookies=None,
-        callback=None):
+        callback=None,
+        stream=False):
         
         data = '' if not data else data
         headers = {} if not headers else headers
@@ -821,6 +924,7 @@ class Request(object):
         self.data = data
         self.cookies = cookies
         self.callback = callback
+        self.stream = stream
     
     def __repr__(self):
         return '<Request [%s]>' % (self.method)
@@ -839,6 +943,8 @@ class Response(object):
         self.reason = None
         self.cookies = cookiejar_from_dict({})
         self.elapsed = datetime.timedelta(0)
+        self.timing = None
+        self.retries = 0
     
     def __repr__(self):
         return '<Response [%s]>' % (self.status_code)
@@ -878,10 +984,14 @@ class Response(object):
                 chunk = f.read(chunk_size)
                 if not chunk:
                     break
+                if self.timing is not None:
+                    self.timing.response_bytes += len(chunk)
                 yield chunk
             self._content_consumed = True
         
         gen = stream_untransfer(generate(), self)
+        if self.timing is not None:
+            gen = stream_count(gen, self.timing)
         
         if decode_unicode:
             gen = stream_decode_response_unicode(gen, self)
@@ -983,7 +1093,217 @@ class Response(object):
             raise http_error
     
     def close(self):
-        pass
+        """Give back the connection of a streamed response not read to the
+        end, it is closed rather than reused"""
+        close = getattr(self.raw, 'close', None)
+        if close is not None:
+            close()
+
+
+"""
+Futures
+
+"""
+
+PENDING = 'PENDING'
+RUNNING = 'RUNNING'
+CANCELLED = 'CANCELLED'
+FINISHED = 'FINISHED'
+
+class Future(object):
+    """Result of a background request
+
+    Resolves to whatever the request callback returns, or to the exception
+    it raises.
+    """
+
+    def __init__(self, waiter=None):
+        self.cond = threading.Condition()
+        self.state = PENDING
+        self._result = None
+        self._exception = None
+        self.callbacks = []
+        # called before blocking, for transports that only make progress
+        # while somebody waits on them
+        self.waiter = waiter
+
+    def __repr__(self):
+        return '<Future [%s]>' % (self.state)
+
+    def cancel(self):
+        """Cancel the request if it hasn't started, returns True if so"""
+        with self.cond:
+            if self.state in (RUNNING, FINISHED):
+                return False
+            elif self.state == CANCELLED:
+                return True
+
+            self.state = CANCELLED
+            self.cond.notify_all()
+
+        self.invoke_callbacks()
+        return True
+
+    def cancelled(self):
+        return self.state == CANCELLED
+
+    def running(self):
+        return self.state == RUNNING
+
+    def done(self):
+        return self.state in (CANCELLED, FINISHED)
+
+    def wait(self, timeout=None):
+        """Block until done, returns False if the timeout expired first
+
+        An executor worker waiting here is covered by a spare worker until
+        it resumes. The scheduler and event loop threads can't be covered,
+        so waiting on them raises `RuntimeError` rather than deadlocking.
+        """
+        if self.waiter is not None and not self.done():
+            self.waiter()
+
+        if not self.done():
+            role = getattr(POOL_THREADS, 'role', None)
+            if role in ('scheduler', 'event loop'):
+                raise RuntimeError("Cannot wait for a background request "
+                    "on the %s thread" % (role))
+            elif role == 'worker':
+                return POOL_THREADS.executor.wait(self, timeout)
+
+        return self.wait_done(timeout)
+
+    def wait_done(self, timeout):
+        with self.cond:
+            if not self.done():
+                self.cond.wait(timeout)
+            return self.done()
+
+    def result(self, timeout=None):
+        if not self.wait(timeout):
+            raise TimeoutError("Timed out waiting for result")
+
+        if self.state == CANCELLED:
+            raise CancelledError("Request was cancelled")
+
+        if self._exception is not None:
+            raise self._exception
+
+        return self._result
+
+    def exception(self, timeout=None):
+        if not self.wait(timeout):
+            raise TimeoutError("Timed out waiting for result")
+
+        if self.state == CANCELLED:
+            raise CancelledError("Request was cancelled")
+
+        return self._exception
+
+    def add_done_callback(self, fn):
+        """Call `fn(future)` once done, immediately if already done"""
+        with self.cond:
+            if not self.done():
+                self.callbacks.append(fn)
+                return
+
+        fn(self)
+
+    def invoke_callbacks(self):
+        for fn in self.callbacks:
+            try:
+                fn(self)
+            except Exception:
+                pass
+
+    def set_running(self):
+        """Mark as running, returns False if it was cancelled instead"""
+        with self.cond:
+            if self.state == CANCELLED:
+                return False
+            self.state = RUNNING
+            return True
+
+    def set_result(self, result):
+        with self.cond:
+            self._result = result
+            self.state = FINISHED
+            self.cond.notify_all()
+
+        self.invoke_callbacks()
+
+    def set_exception(self, exception):
+        with self.cond:
+            self._exception = exception
+            self.state = FINISHED
+            self.cond.notify_all()
+
+        self.invoke_callbacks()
+
+    def run(self, fn, *args, **kwargs):
+        if not self.set_running():
+            return
+
+        try:
+            result = fn(*args, **kwargs)
+        except Exception as e:
+            self.set_exception(e)
+        else:
+            self.set_result(result)
+
+def wait_all(futures, timeout=None):
+    """Wait for every future, returns a (done, not_done) pair of sets"""
+    futures = list(futures)
+    end_time = time.time() + timeout if timeout is not None else None
+
+    for future in futures:
+        if end_time is None:
+            future.wait()
+        else:
+            future.wait(max(0, end_time - time.time()))
+
+    done = set(f for f in futures if f.done())
+    return (done, set(futures) - done)
+
+def as_completed(futures, timeout=None):
+    """Yield each future as it finishes
+
+    Raises `TimeoutError` if any are still pending after `timeout`
+    seconds.
+    """
+    futures = list(futures)
+    end_time = time.time() + timeout if timeout is not None else None
+    pending = set(futures)
+    finished = Queue.Queue()
+
+    for future in pending:
+        future.add_done_callback(finished.put)
+
+    while pending:
+        try:
+            future = finished.get_nowait()
+        except Queue.Empty:
+            remaining = None
+            if end_time is not None:
+                remaining = end_time - time.time()
+                if remaining <= 0:
+                    msg = "%d of %d futures unfinished" % (len(pending),
+                        len(futures))
+                    raise TimeoutError(msg)
+
+            waiting = [f for f in pending if f.waiter is not None]
+            if waiting:
+                waiting[0].wait(remaining)
+                continue
+
+            try:
+                future = finished.get(timeout=remaining)
+            except Queue.Empty:
+                continue
+
+        if future in pending:
+            pending.remove(future)
+            yield future
 
 
 """
@@ -991,23 +1311,231 @@ Adapters
 
 """
 
-class VerifiedHTTPSConnection(httplib.HTTPSConnection):
+CA_CERTS = os.path.join(os.path.dirname(__file__), 'cacert.pem')
+
+class DNSCache(object):
+    """Resolved addresses per (host, port), kept for `ttl` seconds"""
+
+    def __init__(self, ttl=DNS_CACHE_TTL, maxsize=DNS_CACHE_MAXSIZE):
+        self.ttl = ttl
+        self.maxsize = maxsize
+        self.entries = OrderedDict()
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def cached(self, host, port):
+        """Returns the cached addresses for host:port, or None"""
+        key = (host, port)
+        with self.lock:
+            entry = self.entries.pop(key, None)
+            if entry is not None and (self.ttl is None or
+                time.time() - entry[1] < self.ttl):
+                self.entries[key] = entry
+                self.hits += 1
+                return entry[0]
+
+    def resolve(self, host, port):
+        """Returns `getaddrinfo` results for a TCP connection to host:port"""
+        key = (host, port)
+        now = time.time()
+
+        addresses = self.cached(host, port)
+        if addresses is not None:
+            return addresses
+
+        with self.lock:
+            self.misses += 1
+
+        addresses = socket.getaddrinfo(host, port, 0, socket.SOCK_STREAM)
+
+        if self.ttl:
+            with self.lock:
+                self.entries[key] = (addresses, now)
+                while len(self.entries) > self.maxsize:
+                    self.entries.popitem(last=False)
+
+        return addresses
+
+    def invalidate(self, host, port):
+        with self.lock:
+            self.entries.pop((host, port), None)
+
+    def stats(self):
+        with self.lock:
+            return {'hits': self.hits, 'misses': self.misses,
+                'entries': len(self.entries)}
+
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
+
+DNS_CACHE = DNSCache()
+
+def create_connection(address, timeout=socket._GLOBAL_DEFAULT_TIMEOUT,
+    source_address=None, timing=None):
+    """`socket.create_connection` resolving through `DNS_CACHE`
+
+    A host that refuses every cached address is resolved afresh next time.
+    """
+    host, port = address
+    error = None
+
+    addresses = DNS_CACHE.resolve(host, port)
+    if timing is not None:
+        timing.mark('dns')
+
+    for family, socktype, proto, _, addr in addresses:
+        sock = None
+        try:
+            sock = socket.socket(family, socktype, proto)
+            if timeout is not socket._GLOBAL_DEFAULT_TIMEOUT:
+                sock.settimeout(timeout)
+            if source_address:
+                sock.bind(source_address)
+            sock.connect(addr)
+            if timing is not None:
+                timing.mark('connect')
+            return sock
+        except socket.error as e:
+            error = e
+            if sock is not None:
+                sock.close()
+
+    DNS_CACHE.invalidate(host, port)
+    if error is not None:
+        raise error
+    raise socket.error("getaddrinfo returns an empty list")
+
+class TLSSessionCache(object):
+    """Most recent TLS session per (host, port) for resumed handshakes
+
+    Resumption needs `SSLSocket.session`, which older interpreters lack;
+    there handshakes are still full but share the cached context.
+    """
+
+    supported = hasattr(ssl, 'SSLSession') if 'ssl' in globals() else False
+
+    def __init__(self, maxsize=TLS_SESSION_CACHE_SIZE):
+        self.maxsize = maxsize
+        self.sessions = OrderedDict()
+        self.lock = threading.Lock()
+        self.resumed = 0
+        self.full = 0
+
+    def get(self, host, port):
+        if not self.supported:
+            return None
+
+        with self.lock:
+            return self.sessions.get((host, port))
+
+    def store(self, host, port, sock):
+        """Record the handshake on `sock` and keep its session"""
+        with self.lock:
+            if getattr(sock, 'session_reused', False):
+                self.resumed += 1
+            else:
+                self.full += 1
+
+            session = getattr(sock, 'session', None)
+            if session is None:
+                return
+
+            self.sessions.pop((host, port), None)
+            self.sessions[(host, port)] = session
+            while len(self.sessions) > self.maxsize:
+                self.sessions.popitem(last=False)
+
+    def stats(self):
+        with self.lock:
+            return {'resumed': self.resumed, 'full': self.full,
+                'sessions': len(self.sessions)}
+
+    def clear(self):
+        with self.lock:
+            self.sessions.clear()
+
+TLS_SESSIONS = TLSSessionCache()
+
+SSL_CONTEXTS = {}
+SSL_CONTEXTS_LOCK = threading.Lock()
+
+def get_ssl_context(verify=True, key_file=None, cert_file=None):
+    """Process-wide SSL context, so the CA bundle is only loaded once"""
+    key = (bool(verify), key_file, cert_file)
+
+    with SSL_CONTEXTS_LOCK:
+        context = SSL_CONTEXTS.get(key)
+        if context is None:
+            context = ssl.SSLContext(ssl.PROTOCOL_SSLv23)
+            context.options |= ssl.OP_NO_SSLv2 | ssl.OP_NO_SSLv3
+            if verify:
+                context.verify_mode = ssl.CERT_REQUIRED
+                context.load_verify_locations(CA_CERTS)
+            if cert_file:
+                context.load_cert_chain(cert_file, key_file)
+            SSL_CONTEXTS[key] = context
+
+    return context
+
+def wrap_socket(sock, host, port, verify=True, key_file=None,
+    cert_file=None, do_handshake_on_connect=True):
+    """Wrap `sock` for TLS to host:port, resuming a cached session if any"""
+    if not hasattr(ssl, 'SSLContext'):
+        if not verify:
+            return ssl.wrap_socket(sock, key_file, cert_file,
+                do_handshake_on_connect=do_handshake_on_connect)
+        return ssl.wrap_socket(sock, key_file, cert_file,
+            cert_reqs=ssl.CERT_REQUIRED, ca_certs=CA_CERTS,
+            do_handshake_on_connect=do_handshake_on_connect)
+
+    kwargs = {}
+    session = TLS_SESSIONS.get(host, port)
+    if session is not None:
+        kwargs['session'] = session
+
+    context = get_ssl_context(verify, key_file, cert_file)
+    sock = context.wrap_socket(sock, server_hostname=host,
+        do_handshake_on_connect=do_handshake_on_connect, **kwargs)
+
+    if do_handshake_on_connect:
+        TLS_SESSIONS.store(host, port, sock)
+
+    return sock
+
+class HTTPConnection(httplib.HTTPConnection):
+    # set by the adapter for the request about to be sent
+    timing = None
+
     def connect(self):
-        sock = socket.create_connection((self.host, self.port), self.timeout)
-        
+        self.sock = create_connection((self.host, self.port), self.timeout,
+            self.source_address, self.timing)
+
+        if self._tunnel_host:
+            self._tunnel()
+
+class HTTPSConnection(httplib.HTTPSConnection):
+    timing = None
+
+    def __init__(self, *args, **kwargs):
+        self.verify = kwargs.pop('verify', True)
+        httplib.HTTPSConnection.__init__(self, *args, **kwargs)
+
+    def connect(self):
+        sock = create_connection((self.host, self.port), self.timeout,
+            self.source_address, self.timing)
+
         if self._tunnel_host:
             self.sock = sock
             self._tunnel()
-        
-        self.sock = ssl.wrap_socket(sock,
-            self.key_file,
-            self.cert_file,
-            cert_reqs=ssl.CERT_REQUIRED,
-            ca_certs=os.path.join(os.path.dirname(__file__), 'cacert.pem'))
 
-class VerifiedHTTPSHandler(urllib2.HTTPSHandler):
-    def https_open(self, req):
-        return self.do_open(VerifiedHTTPSConnection, req)
+        self.sock = wrap_socket(sock, self._tunnel_host or self.host,
+            self._tunnel_port or self.port, self.verify, self.key_file,
+            self.cert_file)
+
+        if self.timing is not None:
+            self.timing.mark('tls')
 
 class BaseConnection(object):
     def send(self):
@@ -1015,9 +1543,6 @@ class BaseConnection(object):
     
     def close(self):
         raise NotImplementedError
-    
-    def wait(self):
-        raise NotImplementedError
 
 class BaseAdapter(object):
     def send(self):
@@ -1026,36 +1551,485 @@ class BaseAdapter(object):
     def close(self):
         raise NotImplementedError
 
-class DefaultConnection(BaseConnection):
-    def build_handler(self, url, verify=True):
-        scheme = urlparse(url).scheme
-        handler = None
-        
-        if scheme == 'https':
-            if verify:
-                handler = VerifiedHTTPSHandler()
-            else:
-                handler = urllib2.HTTPSHandler()
-        elif scheme == 'http':
-            handler = urllib2.HTTPHandler()
-        elif len(scheme):
+def is_connection_dropped(conn):
+    """Returns True if a pooled connection was closed by the server
+
+    An idle keep-alive socket should never be readable, so a readable
+    socket means either EOF or unexpected data and must not be reused.
+    """
+    sock = getattr(conn, 'sock', None)
+    if sock is None:
+        return True
+
+    return is_socket_dropped(sock)
+
+def is_socket_dropped(sock):
+    try:
+        if hasattr(select, 'poll'):
+            poller = select.poll()
+            poller.register(sock, select.POLLIN)
+            return bool(poller.poll(0))
+
+        readable, _, _ = select.select([sock], [], [], 0)
+    except (select.error, socket.error, ValueError):
+        return True
+
+    return bool(readable)
+
+def parse_pool_key(url, verify=True):
+    """Returns the (scheme, host, port, verify) a connection is shared by"""
+    scheme, netloc, path, params, query, fragment = urlparse(url)
+
+    if scheme not in ('http', 'https'):
+        if len(scheme):
             raise InvalidSchema("Invalid scheme: %s" % (scheme))
         else:
             raise MissingSchema("Missing scheme")
-        
-        return handler
-    
-    def build_request(self, request):
-        req = urllib2.Request(request.url)
-        for k, v in request.headers.items():
-            req.add_header(k, v)
-        req.get_method = lambda: request.method
-        return req
+
+    if not netloc:
+        raise InvalidURL("Invalid URL")
+
+    host, _, port = netloc.rpartition('@')[2].partition(':')
+    try:
+        port = int(port) if port else httplib.HTTPS_PORT if \
+            scheme == 'https' else httplib.HTTP_PORT
+    except ValueError:
+        raise InvalidURL("Invalid URL")
+
+    # certificates only matter for https
+    return (scheme, host.lower(), port, bool(verify) or scheme == 'http')
+
+class ConnectionPool(object):
+    """Persistent HTTP/1.1 connections to a single (scheme, host, port)
+
+    Idle connections are kept on a LIFO stack so the most recently used,
+    and therefore most likely still open, socket is handed out first.
+    """
+
+    def __init__(self, scheme, host, port, verify=True,
+        maxsize=POOL_MAXSIZE, idle_timeout=POOL_IDLE_TIMEOUT,
+        block=POOL_BLOCK):
+        self.scheme = scheme
+        self.host = host
+        self.port = port
+        self.verify = verify
+        self.maxsize = maxsize
+        self.idle_timeout = idle_timeout
+        self.block = block
+        self.idle = collections.deque()
+        self.cond = threading.Condition(threading.Lock())
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.in_use = 0
+
+    def __repr__(self):
+        return '<ConnectionPool [%s://%s:%s]>' % (self.scheme, self.host,
+            self.port)
+
+    def new_connection(self, timeout):
+        if self.scheme != 'https':
+            return HTTPConnection(self.host, self.port, timeout=timeout)
+
+        return HTTPSConnection(self.host, self.port, timeout=timeout,
+            verify=self.verify)
+
+    def is_expired(self, last_used):
+        if self.idle_timeout is None:
+            return False
+        return time.time() - last_used > self.idle_timeout
+
+    def get_connection(self, timeout=None):
+        """Returns a (connection, reused) pair, creating one if needed"""
+        if timeout is None:
+            timeout = socket.getdefaulttimeout()
+
+        with self.cond:
+            while self.block and not self.idle and \
+                self.in_use >= self.maxsize:
+                self.cond.wait()
+
+            while self.idle:
+                conn, last_used = self.idle.pop()
+                if self.is_expired(last_used) or is_connection_dropped(conn):
+                    self.evictions += 1
+                    conn.close()
+                    continue
+
+                self.hits += 1
+                self.in_use += 1
+                conn.timeout = timeout
+                conn.sock.settimeout(timeout)
+                return (conn, True)
+
+            self.misses += 1
+            self.in_use += 1
+
+        if timeout is None:
+            timeout = socket._GLOBAL_DEFAULT_TIMEOUT
+
+        return (self.new_connection(timeout), False)
+
+    def release_connection(self, conn, reusable=True):
+        with self.cond:
+            self.in_use -= 1
+
+            if reusable and conn.sock is not None and \
+                len(self.idle) < self.maxsize:
+                self.idle.append((conn, time.time()))
+                conn = None
+            elif reusable:
+                self.evictions += 1
+
+            self.cond.notify()
+
+        if conn is not None:
+            conn.close()
+
+    def stats(self):
+        with self.cond:
+            return {
+                'hits': self.hits,
+                'misses': self.misses,
+                'evictions': self.evictions,
+                'in_use': self.in_use,
+                'idle': len(self.idle)
+            }
+
+    def close(self):
+        with self.cond:
+            idle = list(self.idle)
+            self.idle.clear()
+
+        for conn, last_used in idle:
+            conn.close()
+
+class PoolManager(object):
+    """Process-wide registry of connection pools shared by all adapters"""
+
+    def __init__(self, maxsize=POOL_MAXSIZE, idle_timeout=POOL_IDLE_TIMEOUT,
+        block=POOL_BLOCK):
+        self.maxsize = maxsize
+        self.idle_timeout = idle_timeout
+        self.block = block
+        self.pools = {}
+        self.lock = threading.Lock()
+
+    def configure(self, maxsize=None, idle_timeout=None, block=None):
+        with self.lock:
+            if maxsize is not None:
+                self.maxsize = maxsize
+            if idle_timeout is not None:
+                self.idle_timeout = idle_timeout
+            if block is not None:
+                self.block = block
+
+            for pool in self.pools.values():
+                with pool.cond:
+                    pool.maxsize = self.maxsize
+                    pool.idle_timeout = self.idle_timeout
+                    pool.block = self.block
+                    pool.cond.notify_all()
+
+    def pool_for_url(self, url, verify=True):
+        key = parse_pool_key(url, verify)
+        scheme, host, port, verify = key
+
+        with self.lock:
+            pool = self.pools.get(key)
+            if pool is None:
+                pool = ConnectionPool(scheme, host, port, verify=verify,
+                    maxsize=self.maxsize, idle_timeout=self.idle_timeout,
+                    block=self.block)
+                self.pools[key] = pool
+
+        return pool
+
+    def stats(self):
+        """Returns pool counters summed over every host, plus per host"""
+        with self.lock:
+            pools = list(self.pools.values())
+
+        stats = {'hits': 0, 'misses': 0, 'evictions': 0, 'in_use': 0,
+            'idle': 0, 'pools': {}}
+
+        for pool in pools:
+            pool_stats = pool.stats()
+            for k, v in pool_stats.items():
+                stats[k] += v
+            key = '%s://%s:%s' % (pool.scheme, pool.host, pool.port)
+            if not pool.verify:
+                key = ' '.join([key, '(unverified)'])
+            stats['pools'][key] = pool_stats
+
+        return stats
+
+    def clear(self):
+        with self.lock:
+            pools = list(self.pools.values())
+            self.pools.clear()
+
+        for pool in pools:
+            pool.close()
+
+POOL_MANAGER = PoolManager()
+
+# marks the threads background requests depend on, which must never block
+# on them
+POOL_THREADS = threading.local()
+
+class Executor(object):
+    """Fixed number of worker threads fed from a bounded queue
+
+    Workers are started on first use and live for the life of the
+    process. Once `queue_size` calls are waiting, `submit` blocks the
+    caller until a worker frees a slot, except on the workers, scheduler
+    and event loop, whose calls go to an unbounded backlog the workers
+    drain first.
+
+    Request callbacks run on the workers. One that waits on another
+    background request is covered by a spare worker until it resumes, so
+    the pool can't deadlock on its own callbacks. Once `max_spares` are
+    out, a waiting worker runs queued calls itself until its result is in.
+    """
+
+    def __init__(self, workers=EXECUTOR_WORKERS,
+        queue_size=EXECUTOR_QUEUE_SIZE, max_spares=EXECUTOR_MAX_SPARES):
+        if workers < 1:
+            raise ValueError("Executor requires at least one worker")
+
+        self.workers = workers
+        self.max_spares = max_spares
+        self.queue = Queue.Queue(queue_size)
+        self.backlog = collections.deque()
+        self.threads = []
+        self.lock = threading.Lock()
+        self.shutdown_requested = False
+        self.spares = 0
+        self.overflows = 0
+
+    def start(self):
+        with self.lock:
+            if self.shutdown_requested:
+                raise RuntimeError("Cannot submit after shutdown")
+
+            while len(self.threads) < self.workers:
+                thread = threading.Thread(target=self.work,
+                    name='parse-worker-%d' % (len(self.threads)))
+                thread.daemon = True
+                thread.start()
+                self.threads.append(thread)
+
+    def take(self, timeout=None):
+        """The next call, from the backlog first, raises `Queue.Empty` if
+        none comes within `timeout`"""
+        try:
+            return self.backlog.popleft()
+        except IndexError:
+            pass
+
+        item = self.queue.get(timeout=timeout)
+        self.queue.task_done()
+        return item
+
+    def run(self, item):
+        future, fn, args, kwargs = item
+        future.run(fn, *args, **kwargs)
+
+    def work(self, resumed=None):
+        """Run queued calls, for a spare worker only until `resumed` is set"""
+        POOL_THREADS.role = 'worker'
+        POOL_THREADS.executor = self
+
+        try:
+            while resumed is None or not resumed.is_set():
+                try:
+                    item = self.take(None if resumed is None else
+                        EXECUTOR_SPARE_POLL)
+                except Queue.Empty:
+                    continue
+
+                if item is None:
+                    if resumed is not None:
+                        # shutdown counts on every regular worker seeing one
+                        self.queue.put(None)
+                    return
+                self.run(item)
+        finally:
+            if resumed is not None:
+                with self.lock:
+                    self.spares -= 1
+
+    def wait(self, future, timeout=None):
+        """Wait for `future` on one of the workers, see the class"""
+        with self.lock:
+            spare = self.spares < self.max_spares
+            if spare:
+                self.spares += 1
+
+        if spare:
+            resumed = threading.Event()
+            thread = threading.Thread(target=self.work, args=(resumed,),
+                name='parse-worker-spare')
+            thread.daemon = True
+            thread.start()
+            try:
+                return future.wait_done(timeout)
+            finally:
+                resumed.set()
+
+        deadline = time.time() + timeout if timeout is not None else None
+        while not future.done():
+            poll = EXECUTOR_SPARE_POLL
+            if deadline is not None:
+                poll = min(poll, deadline - time.time())
+                if poll <= 0:
+                    break
+
+            try:
+                item = self.take(poll)
+            except Queue.Empty:
+                continue
+
+            if item is None:
+                self.queue.put(None)
+                return future.wait_done(None if deadline is None else
+                    max(0, deadline - time.time()))
+            self.run(item)
+
+        return future.done()
+
+    def submit(self, fn, *args, **kwargs):
+        if self.shutdown_requested:
+            raise RuntimeError("Cannot submit after shutdown")
+
+        if len(self.threads) < self.workers:
+            self.start()
+
+        future = Future()
+        item = (future, fn, args, kwargs)
+        if getattr(POOL_THREADS, 'role', None) is None:
+            self.queue.put(item)
+        else:
+            try:
+                self.queue.put_nowait(item)
+            except Queue.Full:
+                # the queue is full, so a worker checks the backlog soon
+                with self.lock:
+                    self.overflows += 1
+                self.backlog.append(item)
+        return future
+
+    def stats(self):
+        with self.lock:
+            return {'workers': len(self.threads), 'spares': self.spares,
+                'queued': self.queue.qsize() + len(self.backlog),
+                'overflows': self.overflows}
+
+    def shutdown(self, wait=True):
+        """Stop the workers once every queued call has run"""
+        with self.lock:
+            self.shutdown_requested = True
+            threads = list(self.threads)
+
+        for thread in threads:
+            self.queue.put(None)
+
+        if wait:
+            for thread in threads:
+                thread.join()
+
+EXECUTOR = Executor()
+
+class Scheduler(object):
+    """Single timer thread running calls once their delay has passed
+
+    Scheduled calls run on the timer thread and should only hand work
+    off, e.g. resend a request through an adapter.
+    """
+
+    def __init__(self):
+        self.heap = []
+        self.counter = 0
+        self.cond = threading.Condition(threading.Lock())
+        self.thread = None
+
+    def call_later(self, delay, fn, *args, **kwargs):
+        with self.cond:
+            self.counter += 1
+            heapq.heappush(self.heap, (time.time() + max(0, delay),
+                self.counter, fn, args, kwargs))
+            self.cond.notify()
+
+            if self.thread is None:
+                self.thread = threading.Thread(target=self.run,
+                    name='parse-scheduler')
+                self.thread.daemon = True
+                self.thread.start()
+
+    def run(self):
+        POOL_THREADS.role = 'scheduler'
+
+        while True:
+            with self.cond:
+                while not self.heap or self.heap[0][0] > time.time():
+                    if self.heap:
+                        self.cond.wait(self.heap[0][0] - time.time())
+                    else:
+                        self.cond.wait()
+                when, counter, fn, args, kwargs = heapq.heappop(self.heap)
+
+            try:
+                fn(*args, **kwargs)
+            except Exception:
+                # scheduled calls report their own errors
+                pass
+
+SCHEDULER = Scheduler()
+
+class PooledBody(object):
+    """Body of a streamed response, its connection goes back to the pool
+    once the body is read to the end"""
+
+    def __init__(self, resp, release):
+        self.resp = resp
+        self.release = release
+
+    def __getattr__(self, name):
+        return getattr(self.resp, name)
+
+    def read(self, amt=None):
+        data = self.resp.read(amt)
+        if not data:
+            self.finish(True)
+        return data
+
+    def finish(self, reusable):
+        release, self.release = self.release, None
+        if release is not None:
+            release(reusable)
+
+    def close(self):
+        self.finish(False)
+
+class DefaultConnection(BaseConnection):
+    def build_path(self, url):
+        scheme, netloc, path, params, query, fragment = urlparse(url)
+        path = path or '/'
+
+        if params:
+            path = ';'.join([path, params])
+
+        if query:
+            path = '?'.join([path, query])
+
+        return path
     
     def build_response(self, req, resp):
         response = Response()
-        response.status_code = resp.getcode()
-        response.headers = CaseInsensitiveDict(getattr(resp, 'headers', {}))
+        response.status_code = resp.status
+        response.reason = resp.reason
+        response.headers = CaseInsensitiveDict(resp.getheaders())
         response.encoding = get_encoding_from_headers(response.headers)
         response.raw = resp
         
@@ -1067,46 +2041,92 @@ class DefaultConnection(BaseConnection):
         extract_cookies_to_jar(response.cookies, req, resp)
         response.request = req
         return response
+
+    def urlopen(self, request, data, timeout, verify=True, timing=None):
+        timing = timing or Timing(request.method, request.url, data)
+        pool = POOL_MANAGER.pool_for_url(request.url, verify)
+        path = self.build_path(request.url)
+
+        while True:
+            conn, reused = pool.get_connection(timeout)
+            conn.timing = timing
+            timing.reused = reused
+            timing.mark('queue')
+
+            try:
+                conn.request(request.method, path, data, request.headers)
+                timing.mark('send')
+                resp = conn.getresponse()
+                timing.mark('wait')
+            except (httplib.BadStatusLine, socket.error) as error:
+                pool.release_connection(conn, reusable=False)
+
+                # the server may drop a keep-alive connection at any time,
+                # so a reused socket gets a single retry on a fresh one
+                stale = isinstance(error, httplib.BadStatusLine) or \
+                    getattr(error, 'errno', None) in (errno.ECONNRESET,
+                        errno.EPIPE, errno.ECONNABORTED)
+                if reused and stale:
+                    continue
+                raise
+            except:
+                pool.release_connection(conn, reusable=False)
+                raise
+
+            try:
+                r = self.build_response(request, resp)
+                r.timing = timing
+
+                # error bodies are small and needed to raise, so only a
+                # successful body is left on the socket
+                if request.stream and r.status_code < 400:
+                    r.raw = PooledBody(resp, lambda reusable:
+                        pool.release_connection(conn, reusable=reusable and
+                            not resp.will_close))
+                    return r
+
+                r.content
+                timing.mark('receive')
+            except:
+                pool.release_connection(conn, reusable=False)
+                raise
+            finally:
+                conn.timing = None
+
+            pool.release_connection(conn, reusable=not resp.will_close)
+            return r
     
-    def open(self, opener, request, data, timeout, callback=None):
+    def open(self, request, data, timeout, verify=True, callback=None):
         e = None
         r = None
+        timing = Timing(request.method, request.url, data)
         
         try:
-            req = self.build_request(request)
-            response = opener.open(req, data, timeout)
+            r = self.urlopen(request, data, timeout, verify, timing)
+        except RequestException as error:
+            e = error
         except ssl.SSLError:
             e = SSLError("SSL error")
-        except socket.error as error:
-            e = ConnectionError("Connection error")
         except socket.timeout as error:
             e = Timeout("Connection timed out")
-        except IOError as error:
-            if hasattr(error, 'reason'):
-                if error.reason == "no host given":
-                    e = InvalidURL("Invalid URL")
-                elif "unknown url type:" in error.reason:
-                    scheme = error.reason.split("'")[1]
-                    
-                    if len(scheme):
-                        e = InvalidSchema("Invalid scheme: %s" % (scheme))
-                    else:
-                        e = MissingSchema("Missing scheme")
-                else:
-                    e = RequestException(error.reason)
-            elif hasattr(error, 'code'):
-                r = self.build_response(request, error)
-                r.raise_for_status()
+        except socket.error as error:
+            e = ConnectionError("Connection error")
+        except httplib.HTTPException as error:
+            e = ConnectionError("Connection error")
         except AttributeError:
             e = SSLError("SSL not supported on this platform")
         except Exception as error:
             e = RequestException(str(error))
         else:
-            r = self.build_response(request, response)
-            r.content
+            try:
+                r.raise_for_status()
+            except HTTPError as error:
+                e = error
+
+        timing.finish(r, e)
         
         if callback:
-            callback(r, e)
+            return callback(r, e)
         else:
             if e is not None:
                 raise e
@@ -1123,25 +2143,17 @@ class DefaultConnection(BaseConnection):
             elif request.method == 'GET':
                 request.url = ''.join([request.url, '?', request.data])
         
-        handler = self.build_handler(request.url, verify)
-        opener = urllib2.build_opener(handler)
-        
         if callback:
-            args = (opener, request, data, timeout, callback)
-            self.thread = threading.Thread(target=self.open, args=args)
-            return self
+            return EXECUTOR.submit(self.open, request, data, timeout, verify,
+                callback)
         else:
-            return self.open(opener, request, data, timeout)
+            return self.open(request, data, timeout, verify)
     
     def close(self):
         pass
-    
-    def wait(self):
-        if not self.thread.is_alive():
-            self.thread.start()
 
 class DefaultAdapter(BaseAdapter):
-    """Default adapter for urllib2"""
+    """Default adapter using persistent connections from `POOL_MANAGER`"""
     
     def __init__(self):
         self.rpc = DefaultConnection()
@@ -1169,7 +2181,9 @@ class AppEngineConnection(BaseConnection):
         response.request = req
         return response
 
-    def build_callback(self, rpc, request, callback=None):
+    def build_callback(self, rpc, request, future, callback=None):
+        timing = Timing(request.method, request.url, request.data)
+
         def wrapper():
             r = None
             e = None
@@ -1197,13 +2211,20 @@ class AppEngineConnection(BaseConnection):
                 e = RequestException(str(e))
             else:
                 try:
+                    r.timing = timing
                     r.content
                     r.raise_for_status()
                 except HTTPError as error:
                     e = error
+
+            timing.finish(r, e)
             
             if callback:
-                callback(r, e)
+                future.run(callback, r, e)
+            elif e is not None:
+                future.set_exception(e)
+            else:
+                future.set_result(r)
         
         return wrapper
     
@@ -1218,20 +2239,20 @@ class AppEngineConnection(BaseConnection):
                 url = ''.join([url, '?', request.data])
         
         if callback:
-            self.rpc = urlfetch.create_rpc()
-            self.rpc.timeout = timeout
-            self.rpc.callback = self.build_callback(self.rpc,
-                request,
+            rpc = urlfetch.create_rpc(deadline=timeout)
+            future = Future(waiter=rpc.wait)
+            rpc.callback = self.build_callback(rpc, request, future,
                 callback)
             
-            urlfetch.make_fetch_call(self.rpc,
+            urlfetch.make_fetch_call(rpc,
                 url,
                 payload=data,
                 method=request.method,
                 headers=request.headers,
                 validate_certificate=verify)
-            return self
+            return future
         else:
+            timing = Timing(request.method, request.url, data)
             try:
                 response = urlfetch.fetch(url,
                     payload=data,
@@ -1260,19 +2281,19 @@ class AppEngineConnection(BaseConnection):
                 raise RequestException(str(e))
             else:
                 r = self.build_response(request, response)
+                r.timing = timing
                 try:
                     r.content
                     r.raise_for_status()
                 except HTTPError as e:
+                    timing.finish(r, e)
                     raise e
                 else:
+                    timing.finish(r)
                     return r
     
     def close(self):
         pass
-    
-    def wait(self):
-        self.rpc.wait()
 
 class AppEngineAdapter(BaseAdapter):
     """Adapter for Google AppEngine"""
@@ -1286,6 +2307,697 @@ class AppEngineAdapter(BaseAdapter):
     def close(self):
         return self.rpc.close()
 
+class Poller(object):
+    """Readiness notification over poll(), or select() where unavailable"""
+
+    READ = 1
+    WRITE = 2
+
+    def __init__(self):
+        self.fds = {}
+        self.poller = select.poll() if hasattr(select, 'poll') else None
+
+    def register(self, fd, events):
+        if self.poller is not None:
+            mask = 0
+            if events & self.READ:
+                mask |= select.POLLIN | select.POLLPRI
+            if events & self.WRITE:
+                mask |= select.POLLOUT
+
+            if fd in self.fds:
+                self.poller.modify(fd, mask)
+            else:
+                self.poller.register(fd, mask)
+
+        self.fds[fd] = events
+
+    def unregister(self, fd):
+        if self.fds.pop(fd, None) is not None and self.poller is not None:
+            self.poller.unregister(fd)
+
+    def poll(self, timeout=None):
+        if self.poller is not None:
+            timeout = None if timeout is None else int(timeout * 1000)
+            events = []
+            for fd, mask in self.poller.poll(timeout):
+                flags = 0
+                if mask & (select.POLLIN | select.POLLPRI | select.POLLHUP |
+                    select.POLLERR | select.POLLNVAL):
+                    flags |= self.READ
+                if mask & (select.POLLOUT | select.POLLERR):
+                    flags |= self.WRITE
+                events.append((fd, flags))
+            return events
+
+        r = [fd for fd, ev in self.fds.items() if ev & self.READ]
+        w = [fd for fd, ev in self.fds.items() if ev & self.WRITE]
+        r, w, x = select.select(r, w, r + w, timeout)
+        events = {}
+        for fd in r + x:
+            events[fd] = events.get(fd, 0) | self.READ
+        for fd in w + x:
+            events[fd] = events.get(fd, 0) | self.WRITE
+        return events.items()
+
+class AsyncResponseParser(object):
+    """Incremental HTTP/1.1 response parser fed from a non-blocking socket"""
+
+    def __init__(self, method):
+        self.method = method
+        self.buffer = bytes()
+        self.msg = None
+        self.status = None
+        self.reason = None
+        self.version = None
+        self.body = []
+        self.length = None
+        self.chunked = False
+        self.chunk_left = None
+        self.until_close = False
+        self.complete = False
+
+    def feed(self, data):
+        self.buffer += data
+
+        if self.msg is None:
+            end = self.buffer.find('\r\n\r\n')
+            if end < 0:
+                return
+            head, self.buffer = self.buffer[:end + 2], self.buffer[end + 4:]
+            self.parse_head(head)
+
+        if self.chunked:
+            self.feed_chunked()
+        elif self.length is not None:
+            self.body.append(self.buffer)
+            self.length -= len(self.buffer)
+            self.buffer = bytes()
+            if self.length <= 0:
+                self.complete = True
+        else:
+            self.body.append(self.buffer)
+            self.buffer = bytes()
+
+    def parse_head(self, head):
+        status_line, _, headers = head.partition('\r\n')
+
+        try:
+            version, status, reason = (status_line.split(None, 2) + [''])[:3]
+            self.status = int(status)
+        except ValueError:
+            raise httplib.BadStatusLine(status_line)
+
+        self.version = version
+        self.reason = reason.strip()
+        self.msg = httplib.HTTPMessage(StringIO.StringIO(headers))
+
+        if self.status in (204, 304) or 100 <= self.status < 200 or \
+            self.method == 'HEAD':
+            self.length = 0
+            self.complete = True
+        elif 'chunked' in self.msg.getheader('transfer-encoding', '').lower():
+            self.chunked = True
+        elif self.msg.getheader('content-length') is not None:
+            try:
+                self.length = int(self.msg.getheader('content-length'))
+            except ValueError:
+                raise httplib.HTTPException("Invalid Content-Length")
+            self.complete = self.length == 0
+        else:
+            self.until_close = True
+
+    def feed_chunked(self):
+        while not self.complete:
+            if self.chunk_left is None:
+                end = self.buffer.find('\r\n')
+                if end < 0:
+                    return
+                size = self.buffer[:end].split(';', 1)[0].strip()
+                try:
+                    self.chunk_left = int(size, 16)
+                except ValueError:
+                    raise httplib.HTTPException("Invalid chunk size")
+                self.buffer = self.buffer[end + 2:]
+            elif self.chunk_left == 0:
+                # trailers end with an empty line
+                end = self.buffer.find('\r\n')
+                if end < 0:
+                    return
+                if end == 0:
+                    self.buffer = self.buffer[2:]
+                    self.complete = True
+                else:
+                    self.buffer = self.buffer[end + 2:]
+            else:
+                if len(self.buffer) < self.chunk_left + 2:
+                    return
+                self.body.append(self.buffer[:self.chunk_left])
+                self.buffer = self.buffer[self.chunk_left + 2:]
+                self.chunk_left = None
+
+    def feed_eof(self):
+        if self.msg is None:
+            raise httplib.BadStatusLine(self.buffer)
+
+        if not self.until_close:
+            raise httplib.IncompleteRead(bytes().join(self.body))
+
+        self.complete = True
+
+    @property
+    def will_close(self):
+        if self.until_close or self.version != 'HTTP/1.1':
+            return True
+        return 'close' in self.msg.getheader('connection', '').lower()
+
+class AsyncRaw(object):
+    """Finished response body with the `msg` and `read` of httplib's"""
+
+    def __init__(self, parser):
+        self.msg = parser.msg
+        self.status = parser.status
+        self.reason = parser.reason
+        self.fp = StringIO.StringIO(bytes().join(parser.body))
+
+    def read(self, amt=None):
+        return self.fp.read() if amt is None else self.fp.read(amt)
+
+    def getheaders(self):
+        return self.msg.items()
+
+    def close(self):
+        self.fp.close()
+
+class AsyncChannel(object):
+    """A single request driven by an `EventLoop`"""
+
+    CONNECTING = 'CONNECTING'
+    HANDSHAKING = 'HANDSHAKING'
+    SENDING = 'SENDING'
+    RECEIVING = 'RECEIVING'
+
+    def __init__(self, loop, key, request, data, timeout, verify, future,
+        callback=None):
+        self.loop = loop
+        self.key = key
+        self.request = request
+        self.payload = self.build_payload(request, data)
+        self.deadline = time.time() + timeout if timeout else None
+        self.verify = verify
+        self.future = future
+        self.callback = callback
+        self.sock = None
+        self.reused = False
+        self.state = None
+        self.sent = 0
+        self.parser = None
+        # addresses still to try, None until resolved
+        self.addresses = None
+        self.timing = Timing(request.method, request.url, data)
+
+    def build_payload(self, request, data):
+        scheme, netloc, path, params, query, fragment = urlparse(request.url)
+        path = DefaultConnection().build_path(request.url)
+
+        lines = ['%s %s HTTP/1.1' % (request.method, path)]
+        if 'host' not in set(k.lower() for k in request.headers):
+            lines.append('Host: %s' % (netloc.rpartition('@')[2]))
+
+        for k, v in request.headers.items():
+            lines.append('%s: %s' % (k, v))
+
+        data = data or bytes()
+        if isinstance(data, unicode):
+            data = data.encode('utf-8')
+
+        if data or request.method in ('POST', 'PUT'):
+            lines.append('Content-Length: %d' % (len(data)))
+
+        head = '\r\n'.join(lines + ['', ''])
+        if isinstance(head, unicode):
+            head = head.encode('utf-8')
+
+        return head + data
+
+    @property
+    def fd(self):
+        return self.sock.fileno()
+
+    def start(self, sock=None):
+        self.parser = AsyncResponseParser(self.request.method)
+        self.sent = 0
+        self.timing.mark('queue')
+
+        if sock is not None:
+            self.sock = sock
+            self.reused = self.timing.reused = True
+            self.state = self.SENDING
+            self.loop.poller.register(self.fd, Poller.WRITE)
+            return
+
+        self.reused = self.timing.reused = False
+        self.state = self.CONNECTING
+        self.connect_next()
+
+    def connect_next(self):
+        """Start connecting to the next address, as `create_connection`
+        would try them in turn"""
+        error = None
+        while self.addresses:
+            family, socktype, proto, _, address = self.addresses.pop(0)
+            sock = socket.socket(family, socktype, proto)
+            sock.setblocking(0)
+
+            code = sock.connect_ex(address)
+            if code in (0, errno.EINPROGRESS, errno.EWOULDBLOCK):
+                self.sock = sock
+                self.loop.poller.register(self.fd, Poller.WRITE)
+                return
+
+            sock.close()
+            error = socket.error(code, os.strerror(code))
+
+        DNS_CACHE.invalidate(*self.key[1:3])
+        if error is not None:
+            raise error
+        raise socket.error("getaddrinfo returns an empty list")
+
+    def handle(self, events):
+        if self.state == self.CONNECTING:
+            error = self.sock.getsockopt(socket.SOL_SOCKET, socket.SO_ERROR)
+            if error and self.addresses:
+                self.loop.reconnect(self)
+                return
+            elif error:
+                DNS_CACHE.invalidate(*self.key[1:3])
+                raise socket.error(error, os.strerror(error))
+            self.timing.mark('connect')
+
+            if self.key[0] == 'https':
+                self.wrap_socket()
+                self.state = self.HANDSHAKING
+            else:
+                self.state = self.SENDING
+
+        if self.state == self.HANDSHAKING:
+            if not self.ssl_step(self.sock.do_handshake):
+                return
+            TLS_SESSIONS.store(self.key[1], self.key[2], self.sock)
+            self.timing.mark('tls')
+            self.state = self.SENDING
+
+        if self.state == self.SENDING:
+            while self.sent < len(self.payload):
+                sent = self.ssl_step(self.sock.send,
+                    self.payload[self.sent:self.sent + EVENT_LOOP_RECV_SIZE])
+                if sent is None:
+                    return
+                self.sent += sent
+
+            self.timing.mark('send')
+            self.state = self.RECEIVING
+            self.loop.poller.register(self.fd, Poller.READ)
+
+        if self.state == self.RECEIVING:
+            while not self.parser.complete:
+                data = self.ssl_step(self.sock.recv, EVENT_LOOP_RECV_SIZE)
+                if data is None:
+                    return
+                if not data:
+                    self.parser.feed_eof()
+                    break
+                waiting = self.parser.msg is None
+                self.parser.feed(data)
+                if waiting and self.parser.msg is not None:
+                    self.timing.mark('wait')
+
+            self.timing.mark('receive')
+            self.loop.finish(self)
+
+    def wrap_socket(self):
+        scheme, host, port, verify = self.key
+        self.sock = wrap_socket(self.sock, host, port, verify,
+            do_handshake_on_connect=False)
+
+    def ssl_step(self, fn, *args):
+        """Run a socket call, returns None if it would block"""
+        try:
+            result = fn(*args)
+        except ssl.SSLError as e:
+            if e.args[0] == ssl.SSL_ERROR_WANT_READ:
+                self.loop.poller.register(self.fd, Poller.READ)
+                return None
+            if e.args[0] == ssl.SSL_ERROR_WANT_WRITE:
+                self.loop.poller.register(self.fd, Poller.WRITE)
+                return None
+            raise
+        except socket.error as e:
+            if e.args[0] in (errno.EAGAIN, errno.EWOULDBLOCK):
+                return None
+            raise
+
+        return True if result is None else result
+
+    def build_response(self, raw):
+        return DefaultConnection().build_response(self.request, raw)
+
+    def close(self):
+        if self.sock is not None:
+            self.loop.poller.unregister(self.fd)
+            self.sock.close()
+            self.sock = None
+
+class EventLoop(object):
+    """One thread driving any number of non-blocking requests
+
+    Requests are queued from any thread with `submit`; the loop thread
+    connects, writes and reads them as their sockets become ready, and
+    keeps finished keep-alive sockets for reuse.
+    """
+
+    def __init__(self, max_connections=EVENT_LOOP_MAX_CONNECTIONS,
+        maxsize=POOL_MAXSIZE, idle_timeout=POOL_IDLE_TIMEOUT):
+        self.max_connections = max_connections
+        self.maxsize = maxsize
+        self.idle_timeout = idle_timeout
+        self.poller = None
+        self.channels = {}
+        self.active = collections.defaultdict(int)
+        self.waiting = collections.defaultdict(collections.deque)
+        self.idle = collections.defaultdict(list)
+        self.incoming = collections.deque()
+        # channels whose addresses are being, or were, looked up off the
+        # loop
+        self.resolving = set()
+        self.resolved = collections.deque()
+        self.lock = threading.Lock()
+        self.thread = None
+        self.waker = None
+
+    def start(self):
+        with self.lock:
+            if self.thread is not None:
+                return
+
+            self.poller = Poller()
+            self.waker = socketpair()
+            for sock in self.waker:
+                sock.setblocking(0)
+            self.poller.register(self.waker[0].fileno(), Poller.READ)
+
+            self.thread = threading.Thread(target=self.run,
+                name='parse-event-loop')
+            self.thread.daemon = True
+            self.thread.start()
+
+    def submit(self, channel):
+        if self.thread is None:
+            self.start()
+
+        self.incoming.append(channel)
+        self.wake()
+
+    def wake(self):
+        try:
+            self.waker[1].send(b'x')
+        except socket.error:
+            # the wake-up byte is only a hint, a full buffer is fine
+            pass
+
+    def run(self):
+        POOL_THREADS.role = 'event loop'
+
+        while True:
+            while self.incoming:
+                self.schedule(self.incoming.popleft())
+            while self.resolved:
+                resolved = self.resolved.popleft()
+                # a channel that timed out meanwhile has been failed
+                if resolved[0] in self.resolving:
+                    self.resolving.discard(resolved[0])
+                    self.connect(*resolved)
+
+            for fd, events in self.poller.poll(self.next_timeout()):
+                if fd == self.waker[0].fileno():
+                    self.drain_waker()
+                    continue
+
+                channel = self.channels.get(fd)
+                if channel is None:
+                    continue
+
+                try:
+                    channel.handle(events)
+                except Exception as error:
+                    self.fail(channel, error)
+
+            self.expire()
+
+    def drain_waker(self):
+        try:
+            while self.waker[0].recv(4096):
+                pass
+        except socket.error:
+            pass
+
+    def pending(self):
+        """Every channel not yet finished, connected or not"""
+        channels = list(self.channels.values()) + list(self.resolving)
+        for waiting in self.waiting.values():
+            channels.extend(waiting)
+        return channels
+
+    def next_timeout(self):
+        deadlines = [c.deadline for c in self.pending()
+            if c.deadline is not None]
+
+        if self.idle_timeout is not None and self.idle:
+            deadlines.append(time.time() + self.idle_timeout)
+
+        if not deadlines:
+            return None
+
+        return max(0, min(deadlines) - time.time())
+
+    def expire(self):
+        now = time.time()
+
+        for channel in self.pending():
+            if channel.deadline is None or channel.deadline > now:
+                continue
+
+            waiting = self.waiting.get(channel.key)
+            if waiting is not None and channel in waiting:
+                # never counted as active, so there is nothing to release
+                waiting.remove(channel)
+                if not waiting:
+                    del self.waiting[channel.key]
+                self.resolve(channel, None, Timeout("Connection timed out"))
+            else:
+                self.resolving.discard(channel)
+                self.fail(channel, socket.timeout("timed out"))
+
+        if self.idle_timeout is None:
+            return
+
+        for key, socks in self.idle.items():
+            fresh = [(sock, last_used) for sock, last_used in socks
+                if now - last_used <= self.idle_timeout]
+            for sock, last_used in socks:
+                if now - last_used > self.idle_timeout:
+                    sock.close()
+            if fresh:
+                self.idle[key] = fresh
+            else:
+                del self.idle[key]
+
+    def schedule(self, channel):
+        if self.max_connections is not None and \
+            self.active[channel.key] >= self.max_connections:
+            self.waiting[channel.key].append(channel)
+            return
+
+        self.active[channel.key] += 1
+        self.connect(channel)
+
+    def connect(self, channel, fresh=False, addresses=None, error=None):
+        """Start `channel` on an idle socket, or else on a new one once
+        its host is resolved"""
+        sock = None
+        idle = self.idle.get(channel.key) if not fresh else None
+        while idle:
+            candidate, last_used = idle.pop()
+            if not is_socket_dropped(candidate):
+                sock = candidate
+                break
+            candidate.close()
+
+        if sock is None and error is None and addresses is None:
+            scheme, host, port, verify = channel.key
+            addresses = DNS_CACHE.cached(host, port)
+            if addresses is None:
+                self.resolve_address(channel)
+                return
+
+        try:
+            if error is not None:
+                raise error
+            if sock is None:
+                channel.addresses = list(addresses)
+                channel.timing.mark('dns')
+            channel.start(sock)
+        except Exception as error:
+            self.fail(channel, error)
+        else:
+            self.channels[channel.fd] = channel
+
+    def resolve_address(self, channel):
+        """Look the channel's host up on the executor, a slow lookup would
+        stall every request on the loop"""
+        def resolved(future):
+            try:
+                self.resolved.append((channel, True, future.result(), None))
+            except Exception as error:
+                self.resolved.append((channel, True, None, error))
+            self.wake()
+
+        self.resolving.add(channel)
+        scheme, host, port, verify = channel.key
+        EXECUTOR.submit(DNS_CACHE.resolve, host, port).add_done_callback(
+            resolved)
+
+    def reconnect(self, channel):
+        """Move a channel whose connect failed on to its next address"""
+        self.channels.pop(channel.fd, None)
+        channel.close()
+        channel.connect_next()
+        self.channels[channel.fd] = channel
+
+    def release(self, channel, reusable):
+        fd = channel.fd if channel.sock is not None else None
+        self.channels.pop(fd, None)
+
+        if reusable and len(self.idle[channel.key]) < self.maxsize:
+            self.poller.unregister(fd)
+            self.idle[channel.key].append((channel.sock, time.time()))
+            channel.sock = None
+        else:
+            channel.close()
+
+        self.active[channel.key] -= 1
+        waiting = self.waiting.get(channel.key)
+        if waiting:
+            self.schedule(waiting.popleft())
+            if not waiting:
+                del self.waiting[channel.key]
+
+    def finish(self, channel):
+        parser = channel.parser
+        self.release(channel, reusable=not parser.will_close)
+
+        r = channel.build_response(AsyncRaw(parser))
+        r.timing = channel.timing
+        self.resolve(channel, r, None)
+
+    def fail(self, channel, error):
+        # a reused keep-alive socket may have been closed by the server
+        # before our request reached it, so retry once on a new socket
+        stale = isinstance(error, httplib.BadStatusLine) or \
+            getattr(error, 'errno', None) in (errno.ECONNRESET, errno.EPIPE,
+                errno.ECONNABORTED)
+        parser = channel.parser
+        if channel.reused and stale and parser.msg is None and \
+            not parser.buffer:
+            self.channels.pop(channel.fd, None)
+            channel.close()
+            channel.reused = False
+            self.connect(channel, fresh=True)
+            return
+
+        self.release(channel, reusable=False)
+
+        if isinstance(error, RequestException):
+            e = error
+        elif isinstance(error, ssl.SSLError):
+            e = SSLError("SSL error")
+        elif isinstance(error, socket.timeout):
+            e = Timeout("Connection timed out")
+        elif isinstance(error, (socket.error, httplib.HTTPException)):
+            e = ConnectionError("Connection error")
+        else:
+            e = RequestException(str(error))
+
+        self.resolve(channel, None, e)
+
+    def resolve(self, channel, r, e):
+        """Complete the channel's future on the executor, so reading the
+        body and running the callback don't hold up the loop"""
+        EXECUTOR.submit(self.complete, channel, r, e)
+
+    def complete(self, channel, r, e):
+        if r is not None:
+            try:
+                r.content
+                r.raise_for_status()
+            except HTTPError as error:
+                e = error
+
+        channel.timing.finish(r, e)
+
+        if channel.callback:
+            channel.future.run(channel.callback, r, e)
+        elif e is not None:
+            channel.future.set_running()
+            channel.future.set_exception(e)
+        else:
+            channel.future.set_running()
+            channel.future.set_result(r)
+
+def socketpair():
+    """socket.socketpair, falling back to a loopback TCP pair"""
+    if hasattr(socket, 'socketpair'):
+        return socket.socketpair()
+
+    listener = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    listener.bind(('127.0.0.1', 0))
+    listener.listen(1)
+    client = socket.create_connection(listener.getsockname())
+    server, _ = listener.accept()
+    listener.close()
+    return (server, client)
+
+EVENT_LOOP = EventLoop()
+
+class AsyncAdapter(BaseAdapter):
+    """Adapter multiplexing every request on the shared `EVENT_LOOP`
+
+    `send` never blocks on the network and always returns a `Future`.
+    """
+
+    def __init__(self, loop=None):
+        self.loop = loop
+
+    def send(self, request, timeout=None, verify=True, callback=None):
+        request.url = prepend_scheme_if_needed(request.url, 'https')
+        data = None
+
+        if request.data:
+            if request.method == 'POST' or request.method == 'PUT':
+                data = request.data
+            elif request.method == 'GET':
+                request.url = ''.join([request.url, '?', request.data])
+
+        key = parse_pool_key(request.url, verify)
+        future = Future()
+        channel = AsyncChannel(self.loop or EVENT_LOOP, key, request, data,
+            timeout, verify, future, callback)
+        channel.loop.submit(channel)
+        return future
+
+    def close(self):
+        pass
+
 """
 Sessions
 
@@ -1336,6 +3048,9 @@ def merge_kwargs(local_kwarg, default_kwarg):
 
     return kwargs
 
+# adapters every new session mounts over its defaults, see `mount`
+MOUNTS = {}
+
 class Session(object):
     def __init__(self):
         self.headers = default_headers()
@@ -1349,6 +3064,8 @@ class Session(object):
         else:
             self.mount('http://', AppEngineAdapter())
             self.mount('https://', AppEngineAdapter())
+
+        self.adapters.update(MOUNTS)
     
     def __enter__(self):
         return self
@@ -1358,9 +3075,10 @@ class Session(object):
     
     def build_callback(self, callback=None):
         def wrapper(response, error):
+            if response is not None:
+                self.cookies.update(response.cookies)
             if callback:
-                callback(response, error)
-            self.cookies.update(response.cookies)
+                return callback(response, error)
         return wrapper
     
     def request(self, method, url,
@@ -1369,7 +3087,8 @@ class Session(object):
         timeout=None,
         verify=None,
         cookies=None,
-        callback=None):
+        callback=None,
+        stream=False):
         cookies = cookies or {}
         
         if not isinstance(cookies, cookielib.CookieJar):
@@ -1389,6 +3108,7 @@ class Session(object):
         req.data = {} if not data else data
         req.cookies = {} if not cookies else cookies
         req.callback = callback
+        req.stream = stream
         
         if callback:
             return self.send(req,
@@ -1418,9 +3138,11 @@ class Session(object):
         return r
     
     def get_adapter(self, url):
-        for (prefix, adapter) in self.adapters.items():
+        # the longest matching prefix wins, so a host can be mounted
+        # over the scheme-wide default
+        for prefix in sorted(self.adapters, key=len, reverse=True):
             if url.startswith(prefix):
-                return adapter
+                return self.adapters[prefix]
         
         scheme, netloc, path, params, query, fragment = urlparse(url)
         raise InvalidSchema("Invalid scheme: %s" % (scheme))
@@ -1446,10 +3168,111 @@ API
 
 """
 
+def configure_pool(maxsize=None, idle_timeout=None, block=None):
+    """Resize the shared connection pools
+
+    :param maxsize: idle connections kept per host (and, when `block` is
+        set, the cap on connections in use per host)
+    :param idle_timeout: seconds an idle connection may be reused for
+    :param block: wait for a free connection instead of opening a new one
+    """
+    POOL_MANAGER.configure(maxsize=maxsize, idle_timeout=idle_timeout,
+        block=block)
+
+def reset_after_fork():
+    """Forget the connection pools and threads inherited from a parent
+    process
+
+    Pooled sockets are shared with the parent, so they are dropped rather
+    than reused or closed. Only the forking thread survives a fork, so the
+    executor, scheduler and event loop are replaced, and the locks another
+    thread may have held are made afresh.
+    """
+    global EXECUTOR, SCHEDULER, EVENT_LOOP, SSL_CONTEXTS_LOCK
+
+    POOL_MANAGER.lock = threading.Lock()
+    POOL_MANAGER.pools = {}
+
+    EXECUTOR = Executor(workers=EXECUTOR.workers,
+        queue_size=EXECUTOR.queue.maxsize, max_spares=EXECUTOR.max_spares)
+    SCHEDULER = Scheduler()
+    EVENT_LOOP = EventLoop(max_connections=EVENT_LOOP.max_connections,
+        maxsize=EVENT_LOOP.maxsize, idle_timeout=EVENT_LOOP.idle_timeout)
+    # the forking thread may have been one of the old workers
+    POOL_THREADS.__dict__.clear()
+
+    DNS_CACHE.lock = threading.Lock()
+    TLS_SESSIONS.lock = threading.Lock()
+    SSL_CONTEXTS_LOCK = threading.Lock()
+
+def add_timing_hook(hook):
+    """Call `hook(timing)` with the `Timing` of every finished request"""
+    TIMING_HOOKS.append(hook)
+
+def remove_timing_hook(hook):
+    if hook in TIMING_HOOKS:
+        TIMING_HOOKS.remove(hook)
+
+def pool_stats():
+    stats = POOL_MANAGER.stats()
+    stats['dns'] = DNS_CACHE.stats()
+    stats['tls'] = TLS_SESSIONS.stats()
+    stats['executor'] = EXECUTOR.stats()
+    return stats
+
+def configure_dns_cache(ttl=None, maxsize=None):
+    """Change how long, and for how many hosts, addresses are cached
+
+    A `ttl` of 0 disables the cache.
+    """
+    if ttl is not None:
+        DNS_CACHE.ttl = ttl
+    if maxsize is not None:
+        DNS_CACHE.maxsize = maxsize
+    if not DNS_CACHE.ttl:
+        DNS_CACHE.clear()
+
+def configure_executor(workers=EXECUTOR_WORKERS,
+    queue_size=EXECUTOR_QUEUE_SIZE, max_spares=EXECUTOR_MAX_SPARES):
+    """Replace the shared executor used for background requests
+
+    Calls already queued on the previous executor still run before its
+    workers exit.
+    """
+    global EXECUTOR
+
+    executor = EXECUTOR
+    EXECUTOR = Executor(workers=workers, queue_size=queue_size,
+        max_spares=max_spares)
+    executor.shutdown(wait=False)
+
+def mount(prefix, adapter):
+    """Send every request for URLs starting with `prefix` to `adapter`"""
+    MOUNTS[prefix] = adapter
+
+def unmount(prefix):
+    """Undo `mount`, returns the adapter that was mounted if any"""
+    return MOUNTS.pop(prefix, None)
+
 def request(method, url, **kwargs):
     session = Session()
     return session.request(method, url, **kwargs)
 
+def resolve_response(response, error):
+    if error is not None:
+        raise error
+    return response
+
+def async_request(method, url, **kwargs):
+    """Send a request on the shared event loop, returns a `Future`"""
+    kwargs['callback'] = kwargs.get('callback') or resolve_response
+
+    session = Session()
+    session.mount('http://', AsyncAdapter())
+    session.mount('https://', AsyncAdapter())
+    session.adapters.update(MOUNTS)
+    return session.request(method, url, **kwargs)
+
 def get(url, **kwargs):
     return request('GET', url, **kwargs)
 
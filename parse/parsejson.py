@@ -1,9 +1,101 @@
 import base64
 import datetime
 import json
+import re
+import threading
 
 import models
-from .constants import DATETIME_FORMAT, CLASS_TYPE_USER
+from .constants import CLASS_TYPE_USER
+from .dates import parse_date, format_date
+
+FULL_OBJECT_KEYS = ('objectId', 'createdAt', 'updatedAt')
+
+WHITESPACE = re.compile(r'[ \t\n\r]*')
+
+def decode_full_object(obj, class_name):
+    if class_name != CLASS_TYPE_USER:
+        return models.Object(class_name, **obj)
+    else:
+        return models.User(**obj)
+
+def decode_type(obj):
+    """Returns the Parse value for a `__type` dict or the dict itself"""
+    type_ = obj['__type']
+
+    if type_ == 'Pointer':
+        return models.Object(obj['className'], obj['objectId'])
+    elif type_ == 'Date':
+        return parse_date(obj['iso'])
+    elif type_ == 'Bytes':
+        return bytearray(base64.b64decode(obj['base64']))
+    elif type_ == 'Relation':
+        return models.Relation(obj['className'])
+    elif type_ == 'GeoPoint':
+        return models.GeoPoint(obj['latitude'], obj['longitude'])
+
+    return obj
+
+def build_object_hook(class_name=None):
+    """An object hook for `class_name`, or for the `className` in each
+    object when it is None"""
+    def object_hook(obj):
+        # most dicts are neither, so bail out on the cheapest test first
+        if 'objectId' in obj and 'createdAt' in obj and 'updatedAt' in obj:
+            return decode_full_object(obj, class_name or obj['className'])
+        elif '__type' in obj:
+            return decode_type(obj)
+
+        return obj
+    return object_hook
+
+OBJECT_HOOKS = {}
+
+def get_object_hook(class_name=None):
+    hook = OBJECT_HOOKS.get(class_name)
+    if hook is None:
+        hook = OBJECT_HOOKS[class_name] = build_object_hook(class_name)
+    return hook
+
+def decode_value(value, class_name=None):
+    """Convert JSON decoded without a hook as `load` would have"""
+    if isinstance(value, dict):
+        hook = get_object_hook(class_name)
+        return hook(dict((k, decode_value(v, class_name))
+            for (k, v) in value.iteritems()))
+    elif isinstance(value, list):
+        return [decode_value(v, class_name) for v in value]
+
+    return value
+
+def encode_default(obj):
+    if isinstance(obj, datetime.datetime):
+        return {
+            '__type': 'Date',
+            'iso': format_date(obj)
+        }
+    elif isinstance(obj, bytearray):
+        return {
+            '__type': 'Bytes',
+            'base64': base64.b64encode(str(obj))
+        }
+    elif isinstance(obj, models.Relation):
+        return {
+            '__type': 'Relation',
+            'className': obj.class_name
+        }
+    elif isinstance(obj, models.File):
+        return {
+            '__type': 'File',
+            'name': obj.name
+        }
+    elif isinstance(obj, models.GeoPoint):
+        return {
+            '__type': 'GeoPoint',
+            'latitude': obj.latitude,
+            'longitude': obj.longitude
+        }
+
+    raise TypeError(repr(obj) + " is not JSON serializable")
 
 
 class JSONDecoder(json.JSONDecoder):
@@ -12,29 +104,12 @@ class JSONDecoder(json.JSONDecoder):
         self.class_name = class_name
 
     def object_hook(self, obj):
-        keys = ('objectId', 'createdAt', 'updatedAt')
-
-        if all(key in obj for key in keys):
+        if all(key in obj for key in FULL_OBJECT_KEYS):
             if self.class_name is None:
                 self.class_name = obj['className']
-            
-            if self.class_name != CLASS_TYPE_USER:
-                return models.Object(self.class_name, **obj)
-            else:
-                return models.User(**obj)
+            return decode_full_object(obj, self.class_name)
         elif '__type' in obj:
-            if obj['__type'] == 'Pointer':
-                return models.Object(obj['className'], obj['objectId'])
-            elif obj['__type'] == 'Date':
-                return datetime.datetime.strptime(obj['iso'],
-                    DATETIME_FORMAT)
-            elif obj['__type'] == 'Bytes':
-                return bytearray(base64.base64decode(obj['base64']))
-            elif obj['__type'] == 'Relation':
-                return models.Relation(obj['className'])
-            elif obj['__type'] == 'GeoPoint':
-                return models.GeoPoint(obj['latitude'],
-                    obj['longitude'])
+            return decode_type(obj)
 
         return obj
 
@@ -45,37 +120,185 @@ class JSONEncoder(json.JSONEncoder):
         self.class_name = class_name
 
     def default(self, obj):
-        if isinstance(obj, datetime.datetime):
-            return {
-                '__type': 'Date',
-                'iso': obj.strftime(DATETIME_FORMAT)
-            }
-        elif isinstance(obj, bytearray):
-            return {
-                '__type': 'Bytes',
-                'base64': base64.base64encode(str(obj))
-            }
-        elif isinstance(obj, models.Relation):
-            return {
-                '__type': 'Relation',
-                'className': obj.class_name
-            }
-        elif isinstance(obj, models.File):
-            return {
-                '__type': 'File',
-                'name': obj.name
-            }
-        elif isinstance(obj, models.GeoPoint):
-            return {
-                '__type': 'GeoPoint',
-                'latitude': obj.latitude,
-                'longitude': obj.longitude
-            }
-
-        return super(JSONEncoder, self).default(obj)
+        try:
+            return encode_default(obj)
+        except TypeError:
+            return super(JSONEncoder, self).default(obj)
+
+
+class Codec(object):
+    """Parse JSON through one JSON library, reusing its decoders and encoder
+
+    `module` needs the stdlib `json` interface: `JSONDecoder(object_hook=)`
+    and `JSONEncoder(default=)`. Decoders are built once per class name;
+    they and the encoder hold no per-call state, so threads share them.
+    """
+
+    def __init__(self, name, module):
+        self.name = name
+        self.module = module
+        self.decoders = {}
+        self.lock = threading.Lock()
+        self.encoder = module.JSONEncoder(default=encode_default)
+        self.raw_decoder = module.JSONDecoder()
+
+    def __repr__(self):
+        return '<Codec [%s]>' % (self.name)
+
+    def decoder(self, class_name):
+        decoder = self.decoders.get(class_name)
+        if decoder is None:
+            with self.lock:
+                decoder = self.decoders.get(class_name)
+                if decoder is None:
+                    decoder = self.module.JSONDecoder(
+                        object_hook=get_object_hook(class_name))
+                    self.decoders[class_name] = decoder
+        return decoder
+
+    def load(self, s, class_name=None):
+        return self.decoder(class_name).decode(s)
+
+    def load_raw(self, s):
+        return self.raw_decoder.decode(s)
+
+    def dump(self, obj):
+        return self.encoder.encode(obj)
+
+def has_speedups(module):
+    """Whether `module` scans JSON in C rather than Python"""
+    scanner = getattr(module, 'scanner', None)
+    return getattr(scanner, 'c_make_scanner', None) is not None
+
+def find_backends():
+    """Available JSON libraries, fastest first"""
+    backends = []
+
+    try:
+        import simplejson
+    except ImportError:
+        pass
+    else:
+        if has_speedups(simplejson):
+            backends.append(('simplejson', simplejson))
+
+    backends.append(('json', json))
+    return backends
+
+BACKENDS = dict(find_backends())
+codec = Codec(*find_backends()[0])
+
+def register_backend(name, module):
+    """Make a JSON library with the stdlib interface available by name"""
+    BACKENDS[name] = module
+
+def set_backend(name):
+    """Use the JSON library registered as `name` for all Parse JSON"""
+    global codec
+
+    if name not in BACKENDS:
+        raise ValueError("Unknown JSON backend '%s', available: %s" % (
+            name, ', '.join(sorted(BACKENDS))))
+    codec = Codec(name, BACKENDS[name])
+
+def get_backend():
+    return codec.name
 
 def load(s, class_name=None):
-    return JSONDecoder(class_name).decode(s)
+    return codec.load(s, class_name)
+
+def load_raw(s):
+    """Plain JSON, Parse types left as dicts for `decode_value`"""
+    return codec.load_raw(s)
 
 def dump(obj, class_name=None):
-    return JSONEncoder(class_name).encode(obj)
\ No newline at end of file
+    return codec.dump(obj)
+
+
+class ChunkReader(object):
+    """JSON text arriving in chunks, only the unread part is kept"""
+
+    def __init__(self, chunks):
+        self.chunks = iter(chunks)
+        self.buf = ''
+        self.pos = 0
+        self.eof = False
+
+    def fill(self):
+        """Append the next chunk, False once there are none left"""
+        for chunk in self.chunks:
+            if chunk:
+                self.buf = self.buf[self.pos:] + chunk
+                self.pos = 0
+                return True
+
+        self.eof = True
+        return False
+
+    def peek(self):
+        """The next character that is not whitespace, '' at the end"""
+        while True:
+            self.pos = WHITESPACE.match(self.buf, self.pos).end()
+            if self.pos < len(self.buf) or not self.fill():
+                return self.buf[self.pos:self.pos + 1]
+
+    def expect(self, char):
+        if self.peek() != char:
+            raise ValueError("Expecting '%s' at offset %d" % (char,
+                self.pos))
+        self.pos += 1
+
+    def value(self, decoder):
+        self.peek()
+        while True:
+            try:
+                value, end = decoder.raw_decode(self.buf, self.pos)
+            except ValueError:
+                if not self.fill():
+                    raise
+                continue
+
+            # a number at the end of the buffer may be cut short
+            if end == len(self.buf) and not self.eof and self.fill():
+                continue
+
+            self.pos = end
+            return value
+
+def iter_results(chunks, class_name=None, key='results'):
+    """Yield the decoded elements of the `key` array of a JSON object
+
+    `chunks` is the response body as it arrives, for example from
+    `Response.iter_content`. Only the current chunk and element are held,
+    so memory does not grow with the number of results. Other members,
+    such as 'count', are skipped.
+    """
+    reader = ChunkReader(chunks)
+    current = codec
+    decoder = current.decoder(class_name)
+
+    reader.expect('{')
+    if reader.peek() == '}':
+        return
+
+    while True:
+        name = reader.value(current.raw_decoder)
+        reader.expect(':')
+
+        if name != key:
+            reader.value(current.raw_decoder)
+        else:
+            reader.expect('[')
+            if reader.peek() == ']':
+                reader.pos += 1
+            else:
+                while True:
+                    yield reader.value(decoder)
+                    if reader.peek() == ']':
+                        reader.pos += 1
+                        break
+                    reader.expect(',')
+
+        if reader.peek() == '}':
+            return
+        reader.expect(',')
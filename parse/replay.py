@@ -0,0 +1,336 @@
+"""Record real Parse traffic and replay it without a network
+
+    adapter = RecordReplayAdapter('traffic.jsonl.gz', mode=RECORD)
+    parse.mount('https://api.parse.com', adapter)
+    ...                                 # run the workload
+    adapter.close()
+
+    adapter = RecordReplayAdapter('traffic.jsonl.gz', mode=REPLAY,
+        speed=None)
+    parse.mount('https://api.parse.com', adapter)
+    ...                                 # run it again, deterministically
+
+Each exchange is one JSON line. Headers carrying keys, session tokens or
+cookies are never written, nor are passwords and session tokens in JSON
+or form encoded bodies.
+"""
+
+import base64
+import collections
+import gzip
+import json
+import threading
+import time
+import urllib
+from urlparse import parse_qsl
+
+from .packages import requests
+
+RECORD = 'record'
+REPLAY = 'replay'
+
+REDACTED_HEADERS = ('authorization', 'cookie', 'set-cookie',
+    'x-parse-session-token')
+REDACTED_KEYS = ('password', 'sessionToken')
+REDACTED = 'REDACTED'
+
+class ReplayMissError(requests.RequestException):
+    """A request was replayed that the recording does not contain"""
+
+def redact(headers):
+    return dict((k, v) for (k, v) in (headers or {}).items()
+        if 'key' not in k.lower() and k.lower() not in REDACTED_HEADERS)
+
+def scrub_value(value, keys):
+    if isinstance(value, dict):
+        return dict((k, REDACTED if k in keys else scrub_value(v, keys))
+            for (k, v) in value.items())
+    if isinstance(value, list):
+        return [scrub_value(v, keys) for v in value]
+    return value
+
+def scrub(text, keys):
+    """`text` with the values of `keys` redacted, when it is a JSON or form
+    encoded body containing any of them"""
+    if not text or not keys or not any(key in text for key in keys):
+        return text
+
+    try:
+        value = json.loads(text)
+    except ValueError:
+        pairs = parse_qsl(text.encode('utf-8'), keep_blank_values=True)
+        if not any(k in keys for (k, v) in pairs):
+            return text
+        return urllib.urlencode([(k, REDACTED if k in keys else v)
+            for (k, v) in pairs]).decode('utf-8')
+
+    # sorted, so a replayed request scrubs to the recorded body
+    return json.dumps(scrub_value(value, keys), sort_keys=True,
+        separators=(',', ':'))
+
+def encode_body(body):
+    """Returns (text, is_base64) for a request or response body"""
+    if body is None:
+        return (None, False)
+    if isinstance(body, unicode):
+        return (body, False)
+    try:
+        return (body.decode('utf-8'), False)
+    except UnicodeDecodeError:
+        return (base64.b64encode(body), True)
+
+def decode_body(text, is_base64):
+    if text is None:
+        return None
+    if is_base64:
+        return base64.b64decode(text)
+    return text.encode('utf-8')
+
+def request_key(method, url, data, keys=REDACTED_KEYS):
+    body, body_base64 = encode_body(data or None)
+    if not body_base64:
+        body = scrub(body, keys)
+    return (method.upper(), url, body)
+
+def open_file(path, mode):
+    if path.endswith('.gz'):
+        return gzip.open(path, mode)
+    return open(path, mode)
+
+class RecordReplayAdapter(requests.BaseAdapter):
+    """Records exchanges through `adapter`, or serves recorded ones
+
+    :param path: recording file, gzipped when it ends in '.gz'
+    :param mode: `RECORD` or `REPLAY`
+    :param adapter: adapter that really sends requests when recording
+    :param speed: when replaying, 1.0 waits as long as the original
+        response took, 2.0 half as long and None not at all
+    :param strict: raise `ReplayMissError` for unrecorded requests, else
+        serve the next recording with the same method and path
+    :param redacted_keys: keys whose values are left out of recorded
+        bodies, at any depth
+    """
+
+    def __init__(self, path, mode=REPLAY, adapter=None, speed=1.0,
+        strict=True, redacted_keys=REDACTED_KEYS):
+        if mode not in (RECORD, REPLAY):
+            raise ValueError("Mode must be '%s' or '%s'" % (RECORD, REPLAY))
+
+        self.path = path
+        self.mode = mode
+        self.speed = speed
+        self.strict = strict
+        self.redacted_keys = tuple(redacted_keys or ())
+        self.lock = threading.Lock()
+        self.started = time.time()
+        self.recorded = 0
+        self.served = 0
+        self.missed = 0
+
+        if mode == RECORD:
+            self.adapter = adapter or requests.DefaultAdapter()
+            self.file = open_file(path, 'wb')
+        else:
+            self.adapter = None
+            self.file = None
+            self.load()
+
+    def __repr__(self):
+        return '<RecordReplayAdapter [%s %s]>' % (self.mode, self.path)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    def load(self):
+        self.exchanges = collections.defaultdict(collections.deque)
+        self.by_path = collections.defaultdict(collections.deque)
+
+        with open_file(self.path, 'rb') as f:
+            for line in f:
+                if not line.strip():
+                    continue
+                exchange = json.loads(line)
+                request = exchange['request']
+                key = (request['method'], request['url'], request['body'])
+                self.exchanges[key].append(exchange)
+                self.by_path[(request['method'],
+                    requests.urlparse(request['url']).path)].append(exchange)
+
+    def stats(self):
+        with self.lock:
+            return {'recorded': self.recorded, 'served': self.served,
+                'missed': self.missed}
+
+    def send(self, request, timeout=None, verify=True, callback=None):
+        if self.mode == RECORD:
+            return self.record(request, timeout, verify, callback)
+        return self.replay(request, callback)
+
+    def record(self, request, timeout, verify, callback):
+        # adapters append GET data to the URL, so keep what was asked for
+        method, url, data = request.method, request.url, request.data
+        headers = dict(request.headers)
+        started = time.time()
+
+        def write(response, error):
+            self.write(method, url, data, headers, started, response, error)
+
+        if callback:
+            def wrapper(response, error):
+                write(response, error)
+                return callback(response, error)
+            return self.adapter.send(request, timeout, verify, wrapper)
+
+        try:
+            response = self.adapter.send(request, timeout, verify)
+        except requests.RequestException as e:
+            write(getattr(e, 'response', None), e)
+            raise
+
+        write(response, None)
+        return response
+
+    def write(self, method, url, data, headers, started, response, error):
+        body, body_base64 = encode_body(data or None)
+        if not body_base64:
+            body = scrub(body, self.redacted_keys)
+        exchange = {
+            'offset': round(started - self.started, 6),
+            'elapsed': round(time.time() - started, 6),
+            'request': {
+                'method': method,
+                'url': url,
+                'headers': redact(headers),
+                'body': body,
+                'base64': body_base64
+            },
+            'response': None,
+            'error': type(error).__name__ if error is not None else None
+        }
+
+        if response is not None:
+            content, content_base64 = encode_body(response.content)
+            if not content_base64:
+                content = scrub(content, self.redacted_keys)
+            exchange['response'] = {
+                'status': response.status_code,
+                'reason': response.reason,
+                'headers': redact(dict(response.headers or {})),
+                'content': content,
+                'base64': content_base64
+            }
+
+        line = json.dumps(exchange, separators=(',', ':'))
+        with self.lock:
+            self.file.write(line + '\n')
+            self.file.flush()
+            self.recorded += 1
+
+    def find(self, request):
+        key = request_key(request.method, request.url, request.data,
+            self.redacted_keys)
+
+        with self.lock:
+            queue = self.exchanges.get(key)
+            if not queue and not self.strict:
+                queue = self.by_path.get((key[0],
+                    requests.urlparse(key[1]).path))
+
+            if not queue:
+                self.missed += 1
+                return None
+
+            exchange = queue.popleft()
+            # identical requests get the recordings in order, then the last
+            # one again
+            if not queue:
+                queue.append(exchange)
+            self.served += 1
+            return exchange
+
+    def build_response(self, request, exchange):
+        recorded = exchange['response']
+        response = requests.Response()
+        response.status_code = recorded['status']
+        response.reason = recorded['reason']
+        response.headers = requests.CaseInsensitiveDict(recorded['headers'])
+        response.encoding = requests.get_encoding_from_headers(
+            response.headers)
+        response.url = request.url
+        response.request = request
+        response._content = decode_body(recorded['content'],
+            recorded['base64'])
+        response._content_consumed = True
+        return response
+
+    def resolve(self, request, exchange):
+        """Returns the (response, error) pair a replayed request ends in"""
+        if exchange is None:
+            return (None, ReplayMissError("No recording for %s %s" % (
+                request.method, request.url)))
+
+        if exchange['response'] is None:
+            error = getattr(requests, exchange['error'] or '', None)
+            if not (isinstance(error, type) and
+                issubclass(error, requests.RequestException)):
+                error = requests.RequestException
+            return (None, error("Replayed %s" % (exchange['error'])))
+
+        response = self.build_response(request, exchange)
+        try:
+            response.raise_for_status()
+        except requests.HTTPError as e:
+            return (response, e)
+        return (response, None)
+
+    def delay(self, exchange):
+        if exchange is None or not self.speed:
+            return 0
+        return exchange['elapsed'] / float(self.speed)
+
+    def replay(self, request, callback):
+        exchange = self.find(request)
+        delay = self.delay(exchange)
+        timing = requests.Timing(request.method, request.url, request.data)
+
+        def finish():
+            timing.mark('wait')
+            response, error = self.resolve(request, exchange)
+            if response is not None:
+                response.timing = timing
+                timing.response_bytes = len(response.content or '')
+                timing.response_bytes_decoded = timing.response_bytes
+            timing.finish(response, error)
+            return (response, error)
+
+        if callback:
+            future = requests.Future()
+
+            def deliver():
+                response, error = finish()
+                future.run(callback, response, error)
+
+            if delay > 0:
+                requests.SCHEDULER.call_later(delay, deliver)
+            else:
+                deliver()
+            return future
+
+        if delay > 0:
+            time.sleep(delay)
+
+        response, error = finish()
+        if error is not None:
+            raise error
+        return response
+
+    def close(self):
+        if self.adapter is not None:
+            self.adapter.close()
+        if self.file is not None:
+            with self.lock:
+                self.file.close()
+                self.file = None
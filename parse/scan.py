@@ -0,0 +1,651 @@
+"""Scanning a whole class with several queries at once
+
+`Query.parallel_scan` splits a query into `Partition`s, disjoint ranges of
+one key, and pages through them with `Query.iter_pages` on a few threads.
+`ScanCoordinator` does the same with worker processes, handing each a
+`ScanSpec` it can resume from.
+"""
+
+import heapq
+import multiprocessing
+import Queue
+import string
+import sys
+import threading
+
+from . import constants
+from . import parsejson as json
+from .constants import QUERY_MAX_LIMIT
+from .dates import parse_date
+from .exceptions import ScanError
+from .utils import reset_after_fork
+
+# objectIds are drawn from these, listed in the order they compare
+OBJECT_ID_CHARS = string.digits + string.ascii_uppercase + \
+    string.ascii_lowercase
+
+SCAN_QUEUE_PAGES = 2
+SCAN_PUT_INTERVAL = 0.1
+SCAN_POLL_INTERVAL = 0.1
+SCAN_RETRIES = 2
+
+def keyset_value(obj, key):
+    # these two come back as strings but must be compared as dates
+    if key == 'createdAt':
+        return obj.created_at
+    elif key == 'updatedAt':
+        return obj.updated_at
+    return obj[key]
+
+def sort_value(obj, key):
+    """`keyset_value`, or None when `obj` lacks `key`, which the server
+    sorts before every other value"""
+    try:
+        return keyset_value(obj, key)
+    except KeyError:
+        return None
+
+def is_condition(value):
+    """Whether a `where` value holds operators rather than an equality"""
+    return isinstance(value, dict) and bool(value) and \
+        all(k.startswith('$') for k in value)
+
+class Partition(object):
+    """Objects whose `key` is at least `low` and below `high`
+
+    A bound of None leaves that side open. Objects without `key` are only
+    found when it is objectId, which every object has.
+    """
+
+    def __init__(self, key, low=None, high=None):
+        self.key = key
+        self.low = low
+        self.high = high
+
+    def __repr__(self):
+        return '<Partition [%s %r:%r]>' % (self.key, self.low, self.high)
+
+    def __eq__(self, other):
+        return isinstance(other, Partition) and (self.key, self.low,
+            self.high) == (other.key, other.low, other.high)
+
+    def __ne__(self, other):
+        return not self == other
+
+    def narrow(self, where):
+        """`where` with this partition's range added to it"""
+        where = dict(where or {})
+        condition = where.get(self.key)
+
+        if condition is not None and not is_condition(condition):
+            # an equality, which a range can only rule out
+            if (self.low is not None and condition < self.low) or \
+                (self.high is not None and condition >= self.high):
+                condition = {'$in': []}
+            where[self.key] = condition
+            return where
+
+        condition = dict(condition or {})
+        if self.low is not None:
+            lower = condition.get('$gt', condition.get('$gte'))
+            if lower is None or self.low > lower:
+                condition.pop('$gt', None)
+                condition['$gte'] = self.low
+        if self.high is not None:
+            upper = condition.get('$lt', condition.get('$lte'))
+            if upper is None or self.high <= upper:
+                condition.pop('$lte', None)
+                condition['$lt'] = self.high
+
+        if condition:
+            where[self.key] = condition
+        return where
+
+    def apply(self, query):
+        """A copy of `query` limited to this partition"""
+        query = query.copy()
+        query.data['where'] = self.narrow(query.data.get('where'))
+        return query
+
+def split_object_ids(count):
+    """`count` partitions of objectId by leading character"""
+    size = len(OBJECT_ID_CHARS)
+    count = max(1, min(count, size))
+    bounds = [OBJECT_ID_CHARS[i * size // count] for i in range(1, count)]
+    return split_at('objectId', bounds)
+
+def split_at(key, bounds):
+    """Partitions of `key` between each of the sorted `bounds`"""
+    edges = [None] + list(bounds) + [None]
+    return [Partition(key, low, high) for (low, high) in zip(edges,
+        edges[1:])]
+
+def split_range(key, low, high, count):
+    """`count` equal partitions of the numbers or datetimes from `low` to
+    `high`, the first and last left open"""
+    if low is None or high is None or low == high or count < 2:
+        return [Partition(key)]
+
+    step = (high - low) / count
+    return split_at(key, [low + step * i for i in range(1, count)])
+
+def find_bound(query, key, descending=False, **kwargs):
+    """The lowest, or highest, value of `key` among the query's objects"""
+    bound = query.copy()
+    for name in ('skip', 'count', 'include'):
+        bound.data.pop(name, None)
+    bound.data['order'] = '-' + key if descending else key
+    bound.data['limit'] = 1
+    if bound.data.get('keys'):
+        bound.data['keys'] = key
+
+    where = bound.data.setdefault('where', {})
+    if key not in where:
+        where[key] = {'$exists': True}
+    elif is_condition(where[key]):
+        where[key] = dict(where[key], **{'$exists': True})
+
+    results = bound.find(**kwargs)
+    return keyset_value(results[0], key) if results else None
+
+def build_partitions(query, key='objectId', count=4, bounds=None,
+    **kwargs):
+    """Disjoint partitions covering `query`
+
+    objectId is split by leading character. Other keys, numbers or dates
+    such as createdAt, are split at `bounds` when given, else into equal
+    ranges between their lowest and highest values, found with two
+    queries.
+    """
+    if bounds is not None:
+        return split_at(key, sorted(bounds))
+    if key == 'objectId':
+        return split_object_ids(count)
+
+    low = find_bound(query, key, **kwargs)
+    high = find_bound(query, key, descending=True, **kwargs)
+    return split_range(key, low, high, count)
+
+class SortKey(object):
+    """Orders objects by values compared ascending or descending"""
+
+    __slots__ = ('values', 'descending')
+
+    def __init__(self, values, descending):
+        self.values = values
+        self.descending = descending
+
+    def __eq__(self, other):
+        return self.values == other.values
+
+    def __lt__(self, other):
+        for a, b, descending in zip(self.values, other.values,
+            self.descending):
+            if a != b:
+                return a > b if descending else a < b
+        return False
+
+class ScanClosed(Exception):
+    pass
+
+class PartitionStream(object):
+    """The pages of one partition, fetched on request by a shared pool
+
+    `wanted` counts pages asked for but not yet fetched and `active` is
+    set while a worker holds the stream, so its pages are only ever read
+    on one thread at a time.
+    """
+
+    def __init__(self, pages):
+        self.pages = pages
+        self.output = Queue.Queue()
+        self.lock = threading.Lock()
+        self.wanted = 0
+        self.active = False
+        self.done = False
+
+class ParallelScan(object):
+    """Iterates the objects of every partition, paged on worker threads
+
+    Unordered, up to `workers` partitions run at a time and objects come
+    out as pages arrive. Ordered, every partition is open at once and
+    their pages are merged on the query's order keys, objects missing one
+    sorting as on the server, first when ascending, while `workers`
+    threads fetch pages for whichever partitions need them. Either way,
+    each partition holds at most a couple of pages.
+    """
+
+    def __init__(self, query, partitions, workers=4, ordered=False,
+        page_size=None, **kwargs):
+        self.query = query
+        self.partitions = list(partitions)
+        self.workers = max(1, workers)
+        self.ordered = ordered
+        self.page_size = page_size
+        self.kwargs = kwargs
+        self.closed = threading.Event()
+        self.threads = []
+        self.started = False
+
+    def __repr__(self):
+        return '<ParallelScan [%d partitions]>' % (len(self.partitions))
+
+    def __iter__(self):
+        if self.started:
+            raise RuntimeError("A scan can only be iterated once")
+        self.started = True
+
+        if self.ordered:
+            return self.iter_ordered()
+        return self.iter_unordered()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    def close(self):
+        """Stop the workers, pages already requested are dropped"""
+        self.closed.set()
+
+    def put(self, queue, item):
+        while not self.closed.is_set():
+            try:
+                queue.put(item, timeout=SCAN_PUT_INTERVAL)
+                return
+            except Queue.Full:
+                pass
+        raise ScanClosed()
+
+    def scan(self, partition, output):
+        kwargs = dict(self.kwargs)
+        if self.page_size is not None:
+            kwargs['page_size'] = self.page_size
+
+        pages = partition.apply(self.query).iter_pages(**kwargs)
+        try:
+            for page in pages:
+                self.put(output, ('page', page))
+        finally:
+            pages.close()
+
+    def start(self, target, *args):
+        thread = threading.Thread(target=target, args=args,
+            name='parse-scan')
+        thread.daemon = True
+        thread.start()
+        self.threads.append(thread)
+
+    def iter_unordered(self):
+        pending = Queue.Queue()
+        for partition in self.partitions:
+            pending.put(partition)
+        output = Queue.Queue(SCAN_QUEUE_PAGES * self.workers)
+
+        def work():
+            try:
+                while True:
+                    try:
+                        partition = pending.get_nowait()
+                    except Queue.Empty:
+                        break
+                    self.scan(partition, output)
+                self.put(output, ('done', None))
+            except ScanClosed:
+                pass
+            except Exception:
+                try:
+                    self.put(output, ('error', sys.exc_info()[1]))
+                except ScanClosed:
+                    pass
+
+        workers = min(self.workers, len(self.partitions))
+        for _ in range(workers):
+            self.start(work)
+
+        try:
+            done = 0
+            while done < workers:
+                kind, value = output.get()
+                if kind == 'page':
+                    for obj in value:
+                        yield obj
+                elif kind == 'done':
+                    done += 1
+                else:
+                    raise value
+        finally:
+            self.close()
+
+    def request(self, stream, tasks, count=1):
+        with stream.lock:
+            stream.wanted += count
+            if stream.active or stream.done:
+                return
+            stream.active = True
+        tasks.put(stream)
+
+    def fetch(self, stream):
+        """Fetch pages of `stream` until none are wanted"""
+        while not self.closed.is_set():
+            with stream.lock:
+                if not stream.wanted:
+                    stream.active = False
+                    return
+                stream.wanted -= 1
+            try:
+                page = next(stream.pages)
+            except StopIteration:
+                stream.output.put(('done', None))
+            except Exception:
+                stream.output.put(('error', sys.exc_info()[1]))
+            else:
+                stream.output.put(('page', page))
+                continue
+            with stream.lock:
+                stream.done = True
+                stream.active = False
+            return
+        stream.pages.close()
+
+    def iter_stream(self, stream, tasks):
+        while True:
+            kind, value = stream.output.get()
+            if kind == 'page':
+                self.request(stream, tasks)
+                for obj in value:
+                    yield obj
+            elif kind == 'done':
+                return
+            else:
+                raise value
+
+    def iter_ordered(self):
+        order = self.query.build_keyset_order()
+        names = [key.lstrip('-') for key in order]
+        descending = [key.startswith('-') for key in order]
+
+        kwargs = dict(self.kwargs)
+        if self.page_size is not None:
+            kwargs['page_size'] = self.page_size
+
+        # every partition is open for the merge, but only `workers` fetch
+        # at a time, each keeping a couple of pages ready
+        tasks = Queue.Queue()
+        streams = [PartitionStream(partition.apply(self.query).iter_pages(
+            **kwargs)) for partition in self.partitions]
+        for stream in streams:
+            self.request(stream, tasks, SCAN_QUEUE_PAGES)
+
+        def work():
+            while not self.closed.is_set():
+                try:
+                    stream = tasks.get(timeout=SCAN_POLL_INTERVAL)
+                except Queue.Empty:
+                    continue
+                self.fetch(stream)
+
+        for _ in range(min(self.workers, len(streams))):
+            self.start(work)
+
+        def decorate(objs):
+            for obj in objs:
+                yield (SortKey([sort_value(obj, name) for name in names],
+                    descending), obj)
+
+        try:
+            for key, obj in heapq.merge(*[decorate(self.iter_stream(stream,
+                tasks)) for stream in streams]):
+                yield obj
+        finally:
+            self.close()
+            # streams a worker holds are closed by it
+            for stream in streams:
+                with stream.lock:
+                    if stream.active:
+                        continue
+                stream.pages.close()
+
+
+def decode_dates(value):
+    """JSON decoded without a hook, with only its Dates converted"""
+    if isinstance(value, dict):
+        if value.get('__type') == 'Date':
+            return parse_date(value['iso'])
+        return dict((k, decode_dates(v)) for (k, v) in value.iteritems())
+    elif isinstance(value, list):
+        return [decode_dates(v) for v in value]
+
+    return value
+
+class ScanSpec(object):
+    """One partition of a scan as plain data, to run in another process
+
+    `data` holds the query's parameters, its `where` included, and `key`,
+    `low` and `high` the partition. `cursor` is the order keys of the last
+    object handled, see `Query.build_cursor`, and `count` how many there
+    have been, so a spec picks up where it was checkpointed. `dumps` gives
+    JSON that `ScanSpec.loads` turns back into a spec wherever the
+    application is set.
+    """
+
+    FIELDS = ('index', 'class_name', 'data', 'key', 'low', 'high', 'cursor',
+        'page_size', 'count', 'done', 'attempts', 'error')
+
+    def __init__(self, class_name, data=None, key='objectId', low=None,
+        high=None, cursor=None, page_size=QUERY_MAX_LIMIT, index=0, count=0,
+        done=False, attempts=0, error=None):
+        self.class_name = class_name
+        self.data = data or {}
+        self.key = key
+        self.low = low
+        self.high = high
+        self.cursor = cursor
+        self.page_size = page_size
+        self.index = index
+        self.count = count
+        self.done = done
+        self.attempts = attempts
+        self.error = error
+
+    def __repr__(self):
+        return '<ScanSpec [%s #%d]>' % (self.class_name, self.index)
+
+    @property
+    def partition(self):
+        return Partition(self.key, self.low, self.high)
+
+    def build_query(self):
+        # models imports this module
+        from .models import Query
+
+        query = Query(self.class_name)
+        query.data = dict(self.data)
+        return self.partition.apply(query)
+
+    def to_dict(self):
+        return dict((name, getattr(self, name)) for name in self.FIELDS)
+
+    @classmethod
+    def from_dict(cls, d):
+        return cls(**dict((str(k), v) for (k, v) in d.iteritems()))
+
+    def dumps(self):
+        return json.dump(self.to_dict())
+
+    @classmethod
+    def loads(cls, s):
+        return cls.from_dict(decode_dates(json.load_raw(s)))
+
+    def run(self, task, report=None, **kwargs):
+        """Call `task(obj)` for every object after the cursor, moving the
+        cursor on and calling `report(self)` after each page"""
+        query = self.build_query()
+        order = query.build_keyset_order()
+
+        pages = query.iter_pages(self.page_size, read_ahead=False,
+            cursor=self.cursor, **kwargs)
+        try:
+            for page in pages:
+                for obj in page:
+                    task(obj)
+
+                self.cursor = query.build_cursor(order, page[-1])
+                self.count += len(page)
+                if report is not None:
+                    report(self)
+        finally:
+            pages.close()
+
+        self.done = True
+        return self
+
+# set in each worker process by `init_scan_worker`
+progress_queue = None
+
+def init_scan_worker(queue, application):
+    global progress_queue
+
+    progress_queue = queue
+    reset_after_fork()
+
+    name, settings = application
+    if settings is not None:
+        from . import set_application
+        set_application(name, **settings)
+
+def report_progress(spec):
+    progress_queue.put(spec.dumps())
+
+def run_scan_spec(s, task):
+    """Run a dumped spec in a worker, returns it dumped again with its
+    final checkpoint and any error"""
+    spec = ScanSpec.loads(s)
+    try:
+        spec.run(task, report_progress)
+    except Exception as e:
+        spec.error = '%s: %s' % (type(e).__name__, e)
+    return spec.dumps()
+
+class ScanCoordinator(object):
+    """Runs the `ScanSpec`s of a scan on a pool of worker processes
+
+    Decoding and handling objects in separate processes gets around the
+    GIL that limits `Query.parallel_scan`. Workers report a checkpoint
+    after each page, and a partition that fails is retried alone from its
+    last one, up to `retries` times. Objects after that checkpoint may be
+    handled twice. `dumps` saves the progress of every partition for
+    `ScanCoordinator.loads` to resume later.
+    """
+
+    def __init__(self, specs, retries=SCAN_RETRIES):
+        self.specs = sorted(specs, key=lambda spec: spec.index)
+        self.retries = retries
+
+    def __repr__(self):
+        return '<ScanCoordinator [%d/%d partitions done]>' % (
+            len(self.specs) - len(self.pending()), len(self.specs))
+
+    @classmethod
+    def from_query(cls, query, count=4, key='objectId', bounds=None,
+        page_size=QUERY_MAX_LIMIT, retries=SCAN_RETRIES, **kwargs):
+        """Split `query` into `count` partitions, see `build_partitions`"""
+        data = dict(query.data)
+        for name in ('skip', 'limit', 'count'):
+            data.pop(name, None)
+
+        partitions = build_partitions(query, key, count, bounds, **kwargs)
+        return cls([ScanSpec(query.class_name, data, partition.key,
+            partition.low, partition.high, page_size=page_size, index=i)
+            for (i, partition) in enumerate(partitions)], retries)
+
+    def dumps(self):
+        return json.dump([spec.to_dict() for spec in self.specs])
+
+    @classmethod
+    def loads(cls, s, retries=SCAN_RETRIES):
+        return cls([ScanSpec.from_dict(d)
+            for d in decode_dates(json.load_raw(s))], retries)
+
+    def pending(self):
+        return [spec for spec in self.specs if not spec.done]
+
+    def failed(self):
+        return [spec for spec in self.pending()
+            if spec.attempts > self.retries]
+
+    def count(self):
+        return sum(spec.count for spec in self.specs)
+
+    def update(self, reported, progress=None):
+        """Take on a checkpoint unless it is older than the one held"""
+        spec = self.specs[reported.index]
+        if spec.done or reported.count < spec.count:
+            return
+
+        spec.cursor = reported.cursor
+        spec.count = reported.count
+        spec.done = reported.done
+        if progress is not None:
+            progress(spec)
+
+    def drain(self, queue, progress, timeout=None):
+        try:
+            while True:
+                s = queue.get(timeout is not None, timeout)
+                timeout = None
+                self.update(ScanSpec.loads(s), progress)
+        except Queue.Empty:
+            pass
+
+    def run(self, task, processes=None, progress=None):
+        """Call `task(obj)` on every object in `processes` workers, one
+        per CPU by default, returns how many objects there were
+
+        `task` must be picklable, a module-level function for example.
+        `progress(spec)` is called here as partitions checkpoint. Raises
+        `ScanError` when partitions fail more than `retries` times.
+        """
+        name = constants.APPLICATION_NAME
+        application = (name, constants.APPLICATIONS.get(name))
+        queue = multiprocessing.Queue()
+        pool = multiprocessing.Pool(processes, init_scan_worker,
+            (queue, application))
+        running = {}
+
+        def submit(spec):
+            running[spec.index] = pool.apply_async(run_scan_spec,
+                (spec.dumps(), task))
+
+        try:
+            for spec in self.pending():
+                if spec.attempts <= self.retries:
+                    submit(spec)
+
+            while running:
+                self.drain(queue, progress, SCAN_POLL_INTERVAL)
+
+                for index, result in running.items():
+                    if not result.ready():
+                        continue
+
+                    del running[index]
+                    self.drain(queue, progress)
+                    reported = ScanSpec.loads(result.get())
+                    self.update(reported, progress)
+
+                    spec = self.specs[index]
+                    if not spec.done:
+                        spec.attempts += 1
+                        spec.error = reported.error
+                        if spec.attempts <= self.retries:
+                            submit(spec)
+        finally:
+            pool.terminate()
+            pool.join()
+
+        failed = self.failed()
+        if failed:
+            raise ScanError(failed)
+        return self.count()
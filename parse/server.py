@@ -0,0 +1,604 @@
+"""In-memory stand-in for the Parse REST API
+
+Serves the parts of the API this library uses, so tests and benchmarks
+can run without a network or a Parse app::
+
+    server = LocalServer(latency=0.01)
+    server.start()
+    parse.set_application('local', 'app-id', 'rest-key', 'master-key',
+        api_base_url=server.url)
+
+Or run it standalone with ``python -m parse.server --port 8000``.
+"""
+
+import BaseHTTPServer
+import SocketServer
+import collections
+import copy
+import datetime
+import json
+import random
+import string
+import threading
+import time
+import uuid
+from urlparse import urlparse, parse_qsl
+
+from .constants import (API_VERSION, API_CLASSES_PATH, API_BATCH_PATH,
+    API_USERS_PATH, API_LOGIN_PATH, API_PASSWORD_RESET_PATH, API_ROLES_PATH,
+    API_FILES_PATH, API_EVENTS_PATH, API_PUSH_PATH, API_INSTALLATIONS_PATH,
+    API_FUNCTIONS_PATH, CLASS_TYPE_USER, CLASS_TYPE_ROLE,
+    CLASS_TYPE_INSTALLATION, QUERY_DEFAULT_LIMIT, QUERY_MAX_LIMIT)
+from . import matching
+from .exceptions import UnsupportedQueryError
+
+BATCH_MAX_REQUESTS = 50
+OBJECT_ID_LENGTH = 10
+
+ERROR_INTERNAL = 1
+ERROR_INVALID_QUERY = 102
+ERROR_INVALID_KEY = 105
+ERROR_INVALID_JSON = 107
+ERROR_OBJECT_NOT_FOUND = 101
+ERROR_INVALID_FUNCTION = 141
+ERROR_USERNAME_MISSING = 200
+ERROR_PASSWORD_MISSING = 201
+ERROR_USERNAME_TAKEN = 202
+
+class APIError(Exception):
+    """Turned into a Parse error response: `{"code": .., "error": ..}`"""
+
+    def __init__(self, status, code, error):
+        super(APIError, self).__init__(error)
+        self.status = status
+        self.code = code
+        self.error = error
+
+def now():
+    return datetime.datetime.utcnow().strftime(
+        '%Y-%m-%dT%H:%M:%S.%f')[:-3] + 'Z'
+
+def new_object_id():
+    chars = string.ascii_letters + string.digits
+    return ''.join(random.choice(chars) for _ in range(OBJECT_ID_LENGTH))
+
+def pointer(value):
+    return {'__type': 'Pointer', 'className': value['className'],
+        'objectId': value['objectId']}
+
+class MemoryStore(object):
+    """Classes, users, files and relations held in dictionaries"""
+
+    def __init__(self):
+        self.lock = threading.RLock()
+        self.reset()
+
+    def reset(self):
+        with self.lock:
+            self.classes = {}
+            self.relations = {}
+            self.passwords = {}
+            self.sessions = {}
+            self.files = {}
+            self.events = []
+            self.pushes = []
+
+    def objects(self, class_name):
+        return self.classes.setdefault(class_name,
+            collections.OrderedDict())
+
+    def get(self, class_name, object_id):
+        obj = self.objects(class_name).get(object_id)
+        if obj is None:
+            raise APIError(404, ERROR_OBJECT_NOT_FOUND,
+                'object not found for %s' % (object_id))
+        return obj
+
+    def create(self, class_name, data):
+        with self.lock:
+            obj = {}
+            object_id = new_object_id()
+            while object_id in self.objects(class_name):
+                object_id = new_object_id()
+
+            obj['objectId'] = object_id
+            obj['createdAt'] = obj['updatedAt'] = now()
+            self.apply(class_name, obj, data)
+            self.objects(class_name)[object_id] = obj
+            return obj
+
+    def update(self, class_name, object_id, data):
+        with self.lock:
+            obj = self.get(class_name, object_id)
+            self.apply(class_name, obj, data)
+            obj['updatedAt'] = now()
+            return obj
+
+    def delete(self, class_name, object_id):
+        with self.lock:
+            self.get(class_name, object_id)
+            del self.objects(class_name)[object_id]
+            for key in [k for k in self.relations
+                if k[:2] == (class_name, object_id)]:
+                del self.relations[key]
+
+    def apply(self, class_name, obj, data):
+        for key, value in data.items():
+            if key in ('objectId', 'createdAt', 'updatedAt', '__type',
+                'className'):
+                continue
+
+            if key.startswith('_') and key not in ('_ACL',):
+                raise APIError(400, ERROR_INVALID_KEY,
+                    'invalid field name: %s' % (key))
+
+            if isinstance(value, dict) and '__op' in value:
+                self.apply_op(class_name, obj, key, value)
+            elif isinstance(value, dict) and \
+                value.get('__type') in ('Object', 'Pointer') and \
+                'objectId' in value:
+                obj[key] = pointer(value)
+            else:
+                obj[key] = copy.deepcopy(value)
+
+    def apply_op(self, class_name, obj, key, value):
+        op = value['__op']
+        current = obj.get(key)
+
+        if op == 'Delete':
+            obj.pop(key, None)
+        elif op == 'Increment':
+            obj[key] = (current or 0) + value.get('amount', 1)
+        elif op == 'Add':
+            obj[key] = (current or []) + list(value['objects'])
+        elif op == 'AddUnique':
+            items = list(current or [])
+            items += [o for o in value['objects'] if o not in items]
+            obj[key] = items
+        elif op == 'Remove':
+            obj[key] = [o for o in (current or [])
+                if o not in value['objects']]
+        elif op in ('AddRelation', 'RemoveRelation'):
+            targets = self.relations.setdefault(
+                (class_name, obj['objectId'], key), set())
+            for target in value['objects']:
+                item = (target['className'], target['objectId'])
+                if op == 'AddRelation':
+                    targets.add(item)
+                else:
+                    targets.discard(item)
+            if value['objects']:
+                obj[key] = {'__type': 'Relation',
+                    'className': value['objects'][0]['className']}
+        else:
+            raise APIError(400, ERROR_INVALID_JSON,
+                'unknown operation: %s' % (op))
+
+    def query(self, class_name, params):
+        """Run a find, returns the response body"""
+        try:
+            where = json.loads(params.get('where') or '{}')
+            limit = int(params.get('limit', QUERY_DEFAULT_LIMIT))
+            skip = int(params.get('skip', 0))
+        except ValueError:
+            raise APIError(400, ERROR_INVALID_JSON, 'invalid query')
+
+        keys = [k for k in params.get('keys', '').split(',') if k]
+        exclude_keys = [k for k in params.get('excludeKeys', '').split(',')
+            if k]
+        include = [k for k in params.get('include', '').split(',') if k]
+        order = [k for k in params.get('order', '').split(',') if k]
+        body = {}
+
+        def related_to(condition, obj):
+            return self.related_to(class_name, condition, obj)
+
+        with self.lock:
+            try:
+                results = [obj for obj in self.objects(class_name).values()
+                    if matching.matches(obj, where, related_to)]
+            except UnsupportedQueryError as e:
+                raise APIError(400, ERROR_INVALID_QUERY, str(e))
+            matching.sort(results, order)
+
+            if params.get('count') in ('1', 'true'):
+                body['count'] = len(results)
+
+            limit = max(0, min(limit, QUERY_MAX_LIMIT))
+            body['results'] = [self.render(obj, keys, include, exclude_keys)
+                for obj in results[skip:skip + limit]]
+
+        return body
+
+    def render(self, obj, keys=None, include=None, exclude_keys=None):
+        if keys:
+            fields = set(k.split('.')[0] for k in keys) | \
+                set(['objectId', 'createdAt', 'updatedAt'])
+            obj = dict((k, v) for (k, v) in obj.items() if k in fields)
+        else:
+            obj = dict(obj)
+
+        for key in exclude_keys or []:
+            obj.pop(key, None)
+
+        for key in include or []:
+            value = obj.get(key)
+            if isinstance(value, dict) and value.get('__type') == 'Pointer':
+                target = self.objects(value['className']).get(
+                    value['objectId'])
+                if target is not None:
+                    target = dict(target, __type='Object',
+                        className=value['className'])
+                    obj[key] = target
+
+        return copy.deepcopy(obj)
+
+    def related_to(self, class_name, condition, obj):
+        owner = condition['object']
+        targets = self.relations.get((owner['className'],
+            owner['objectId'], condition['key']), ())
+        return (class_name, obj['objectId']) in targets
+
+class RequestHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+    server_version = 'ParseLocalServer/1.0'
+    # buffer the status line and headers so a response goes out in one
+    # write, unbuffered writes stall keep-alive requests on Nagle and
+    # delayed ACKs for ~40ms each
+    wbufsize = -1
+
+    def log_message(self, format, *args):
+        if self.server.parse_server.verbose:
+            BaseHTTPServer.BaseHTTPRequestHandler.log_message(self, format,
+                *args)
+
+    def do_GET(self):
+        self.dispatch('GET')
+
+    def do_POST(self):
+        self.dispatch('POST')
+
+    def do_PUT(self):
+        self.dispatch('PUT')
+
+    def do_DELETE(self):
+        self.dispatch('DELETE')
+
+    def dispatch(self, method):
+        length = int(self.headers.getheader('content-length') or 0)
+        body = self.rfile.read(length) if length else ''
+
+        server = self.server.parse_server
+        server.wait()
+
+        try:
+            status, content, mime_type = server.handle(method, self.path,
+                dict(self.headers.items()), body)
+        except APIError as e:
+            status, mime_type = e.status, 'application/json'
+            content = json.dumps({'code': e.code, 'error': e.error})
+        except Exception as e:
+            status, mime_type = 500, 'application/json'
+            content = json.dumps({'code': ERROR_INTERNAL, 'error': str(e)})
+
+        self.send_response(status)
+        self.send_header('Content-Type', mime_type)
+        self.send_header('Content-Length', str(len(content)))
+        self.end_headers()
+        self.wfile.write(content)
+        self.wfile.flush()
+
+class HTTPServer(SocketServer.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+    daemon_threads = True
+    allow_reuse_address = True
+    # benchmarks open many connections at once, the default backlog is 5
+    request_queue_size = 128
+
+    def handle_error(self, request, client_address):
+        # clients dropping keep-alive connections are not worth a traceback
+        if self.parse_server.verbose:
+            BaseHTTPServer.HTTPServer.handle_error(self, request,
+                client_address)
+
+class LocalServer(object):
+    """Parse REST API served from a `MemoryStore` on a background thread
+
+    :param latency: seconds added to every request
+    :param jitter: up to this many more seconds, chosen at random
+    :param app_id: only accept this application ID, any if None
+    :param master_key: key required by master key only calls
+    """
+
+    def __init__(self, host='127.0.0.1', port=0, latency=0.0, jitter=0.0,
+        app_id=None, master_key=None, verbose=False):
+        self.host = host
+        self.port = port
+        self.latency = latency
+        self.jitter = jitter
+        self.app_id = app_id
+        self.master_key = master_key
+        self.verbose = verbose
+        self.store = MemoryStore()
+        self.functions = {}
+        self.httpd = None
+        self.thread = None
+
+    def __enter__(self):
+        self.start()
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.stop()
+
+    @property
+    def url(self):
+        return 'http://%s:%d' % (self.host, self.port)
+
+    def start(self):
+        self.httpd = HTTPServer((self.host, self.port), RequestHandler)
+        self.httpd.parse_server = self
+        self.port = self.httpd.server_address[1]
+
+        self.thread = threading.Thread(target=self.httpd.serve_forever,
+            name='parse-local-server')
+        self.thread.daemon = True
+        self.thread.start()
+        return self
+
+    def stop(self):
+        if self.httpd is not None:
+            self.httpd.shutdown()
+            self.httpd.server_close()
+            self.httpd = None
+            self.thread = None
+
+    def reset(self):
+        """Forget every object, user, file, event and push"""
+        self.store.reset()
+
+    def define(self, name, fn):
+        """Serve cloud function `name` as `fn(params)`"""
+        self.functions[name] = fn
+
+    def wait(self):
+        delay = self.latency + random.uniform(0, self.jitter)
+        if delay > 0:
+            time.sleep(delay)
+
+    def handle(self, method, path, headers, body):
+        """Returns (status, content, mime type) for one request"""
+        headers = dict((k.lower(), v) for (k, v) in headers.items())
+        if self.app_id is not None and \
+            headers.get('x-parse-application-id') != self.app_id:
+            return (401, json.dumps({'error': 'unauthorized'}),
+                'application/json')
+
+        url = urlparse(path)
+        parts = [p for p in url.path.split('/') if p]
+
+        if len(parts) == 2 and parts[0] == API_FILES_PATH:
+            return self.serve_file(parts[1])
+
+        if not parts or parts[0] != API_VERSION:
+            raise APIError(404, ERROR_INVALID_JSON, 'unknown path')
+
+        params = dict(parse_qsl(url.query))
+        mime_type = headers.get('content-type', 'application/json')
+        master = self.master_key is None or \
+            headers.get('x-parse-master-key') == self.master_key
+
+        if parts[1] == API_FILES_PATH:
+            status, result = self.handle_file(method, parts[2:], body,
+                mime_type, master)
+        else:
+            data = {}
+            if body and method in ('POST', 'PUT'):
+                try:
+                    data = json.loads(body)
+                except ValueError:
+                    raise APIError(400, ERROR_INVALID_JSON, 'bad JSON')
+            elif body:
+                params.update(parse_qsl(body))
+
+            status, result = self.route(method, parts[1:], params, data,
+                headers)
+
+        return (status, json.dumps(result), 'application/json')
+
+    def route(self, method, parts, params, data, headers):
+        root, rest = parts[0], parts[1:]
+
+        if root == API_CLASSES_PATH and rest:
+            return self.handle_class(method, rest[0], rest[1:], params, data)
+        if root == API_USERS_PATH:
+            if method == 'POST' and not rest:
+                return self.sign_up(data)
+            return self.handle_class(method, CLASS_TYPE_USER, rest, params,
+                data)
+        if root == API_ROLES_PATH:
+            return self.handle_class(method, CLASS_TYPE_ROLE, rest, params,
+                data)
+        if root == API_INSTALLATIONS_PATH:
+            return self.handle_class(method, CLASS_TYPE_INSTALLATION, rest,
+                params, data)
+        if root == API_LOGIN_PATH:
+            return self.login(dict(params, **data))
+        if root == API_PASSWORD_RESET_PATH and method == 'POST':
+            return (200, {})
+        if root == API_BATCH_PATH and method == 'POST':
+            return self.batch(data, headers)
+        if root == API_FUNCTIONS_PATH and rest and method == 'POST':
+            return self.call_function(rest[0], data)
+        if root == API_EVENTS_PATH and rest and method == 'POST':
+            with self.store.lock:
+                self.store.events.append((rest[0], data))
+            return (200, {})
+        if root == API_PUSH_PATH and method == 'POST':
+            with self.store.lock:
+                self.store.pushes.append(data)
+            return (200, {'result': True})
+
+        raise APIError(404, ERROR_INVALID_JSON, 'unknown path')
+
+    def handle_class(self, method, class_name, rest, params, data):
+        store = self.store
+        object_id = rest[0] if rest else None
+
+        if object_id is None:
+            if method == 'GET':
+                return (200, store.query(class_name, params))
+            if method == 'POST':
+                obj = store.create(class_name, data)
+                return (201, {'objectId': obj['objectId'],
+                    'createdAt': obj['createdAt']})
+        else:
+            if method == 'GET':
+                with store.lock:
+                    return (200, store.render(store.get(class_name,
+                        object_id), include=[k for k in
+                        params.get('include', '').split(',') if k]))
+            if method == 'PUT':
+                if class_name == CLASS_TYPE_USER and 'password' in data:
+                    self.store.passwords[object_id] = data.pop('password')
+                obj = store.update(class_name, object_id, data)
+                return (200, {'updatedAt': obj['updatedAt']})
+            if method == 'DELETE':
+                store.delete(class_name, object_id)
+                return (200, {})
+
+        raise APIError(405, ERROR_INVALID_JSON, 'method not allowed')
+
+    def sign_up(self, data):
+        username = data.get('username')
+        password = data.pop('password', None)
+        if not username:
+            raise APIError(400, ERROR_USERNAME_MISSING, 'missing username')
+        if not password:
+            raise APIError(400, ERROR_PASSWORD_MISSING, 'missing password')
+
+        store = self.store
+        with store.lock:
+            if any(u.get('username') == username
+                for u in store.objects(CLASS_TYPE_USER).values()):
+                raise APIError(400, ERROR_USERNAME_TAKEN,
+                    'username %s already taken' % (username))
+
+            user = store.create(CLASS_TYPE_USER, data)
+            store.passwords[user['objectId']] = password
+            token = self.new_session(user['objectId'])
+
+        return (201, {'objectId': user['objectId'],
+            'createdAt': user['createdAt'], 'sessionToken': token})
+
+    def login(self, data):
+        store = self.store
+        with store.lock:
+            for user in store.objects(CLASS_TYPE_USER).values():
+                if user.get('username') == data.get('username') and \
+                    store.passwords.get(user['objectId']) == \
+                    data.get('password'):
+                    result = store.render(user)
+                    result['sessionToken'] = self.new_session(
+                        user['objectId'])
+                    return (200, result)
+
+        raise APIError(404, ERROR_OBJECT_NOT_FOUND,
+            'invalid login parameters')
+
+    def new_session(self, object_id):
+        token = 'r:%s' % (uuid.uuid4().hex)
+        self.store.sessions[token] = object_id
+        return token
+
+    def batch(self, data, headers):
+        requests = data.get('requests', [])
+        if len(requests) > BATCH_MAX_REQUESTS:
+            raise APIError(400, ERROR_INVALID_JSON,
+                'too many commands in batch: %d' % (len(requests)))
+
+        results = []
+        for item in requests:
+            parts = [p for p in item.get('path', '').split('/') if p]
+            try:
+                if not parts or parts[0] != API_VERSION:
+                    raise APIError(404, ERROR_INVALID_JSON, 'unknown path')
+                status, result = self.route(item['method'], parts[1:], {},
+                    item.get('body') or {}, headers)
+            except APIError as e:
+                results.append({'error': {'code': e.code,
+                    'error': e.error}})
+            else:
+                results.append({'success': result})
+
+        return (200, results)
+
+    def call_function(self, name, params):
+        fn = self.functions.get(name)
+        if fn is None:
+            raise APIError(400, ERROR_INVALID_FUNCTION,
+                'function not found: %s' % (name))
+
+        try:
+            return (200, {'result': fn(params)})
+        except APIError:
+            raise
+        except Exception as e:
+            raise APIError(400, ERROR_INVALID_FUNCTION, str(e))
+
+    def handle_file(self, method, parts, body, mime_type, master):
+        if not parts:
+            raise APIError(404, ERROR_INVALID_JSON, 'missing file name')
+
+        store = self.store
+        if method == 'POST':
+            name = 'tfss-%s-%s' % (uuid.uuid4().hex, parts[0])
+            with store.lock:
+                store.files[name] = (mime_type, body)
+            return (201, {'name': name,
+                'url': '/'.join([self.url, API_FILES_PATH, name])})
+
+        if method == 'DELETE':
+            if not master:
+                raise APIError(403, ERROR_INVALID_KEY,
+                    'unauthorized: master key is required')
+            with store.lock:
+                if store.files.pop(parts[0], None) is None:
+                    raise APIError(404, ERROR_OBJECT_NOT_FOUND,
+                        'file not found')
+            return (200, {})
+
+        raise APIError(405, ERROR_INVALID_JSON, 'method not allowed')
+
+    def serve_file(self, name):
+        with self.store.lock:
+            entry = self.store.files.get(name)
+        if entry is None:
+            raise APIError(404, ERROR_OBJECT_NOT_FOUND, 'file not found')
+
+        mime_type, data = entry
+        return (200, data, mime_type)
+
+def main(argv=None):
+    import argparse
+
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=8000)
+    parser.add_argument('--latency', type=float, default=0.0)
+    parser.add_argument('--jitter', type=float, default=0.0)
+    parser.add_argument('--verbose', action='store_true')
+    args = parser.parse_args(argv)
+
+    server = LocalServer(host=args.host, port=args.port,
+        latency=args.latency, jitter=args.jitter, verbose=args.verbose)
+    server.start()
+    print 'Serving the Parse API on %s' % (server.url)
+
+    try:
+        while server.thread.is_alive():
+            server.thread.join(1)
+    except KeyboardInterrupt:
+        server.stop()
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,247 @@
+"""Objects kept on disk between runs, in SQLite
+
+    store = LocalStore('reference.db', max_objects=100000)
+    store.warm()                        # fill the object cache from disk
+    store.revalidate('Country')         # fetch only what changed since
+    countries = store.find(parse.Query('Country'))
+
+Objects are stored as JSON by class and objectId with their updatedAt.
+Each class keeps a watermark, the latest updatedAt seen by `revalidate`,
+so a restart asks the server for one query's worth of changes per class
+instead of every object. Deleted objects are not noticed by revalidation
+and stay until they are removed or evicted. Use one store per application.
+"""
+
+import sqlite3
+import threading
+import time
+
+from . import matching
+from . import parsejson as json
+from .cache import get_object_cache
+from .constants import QUERY_DEFAULT_LIMIT, QUERY_MAX_LIMIT
+from .dates import parse_date, format_date
+from .models import Query
+from .utils import build_headers
+
+SCHEMA = (
+    '''CREATE TABLE IF NOT EXISTS objects (
+        class_name TEXT NOT NULL,
+        object_id TEXT NOT NULL,
+        updated_at TEXT NOT NULL,
+        data TEXT NOT NULL,
+        size INTEGER NOT NULL,
+        stored_at REAL NOT NULL,
+        PRIMARY KEY (class_name, object_id))''',
+    '''CREATE INDEX IF NOT EXISTS objects_stored_at
+        ON objects (stored_at)''',
+    '''CREATE TABLE IF NOT EXISTS watermarks (
+        class_name TEXT PRIMARY KEY,
+        updated_at TEXT NOT NULL)''',
+)
+
+class LocalStore(object):
+    """Full objects in an SQLite database at `path`
+
+    :param max_objects: objects kept, the least recently stored are
+        removed beyond it
+    :param max_bytes: JSON kept, likewise
+    """
+
+    def __init__(self, path, max_objects=None, max_bytes=None):
+        self.path = path
+        self.max_objects = max_objects
+        self.max_bytes = max_bytes
+        self.lock = threading.Lock()
+        self.db = sqlite3.connect(path, check_same_thread=False)
+
+        with self.lock, self.db:
+            if path != ':memory:':
+                self.db.execute('PRAGMA journal_mode=WAL')
+            self.db.execute('PRAGMA synchronous=NORMAL')
+            for statement in SCHEMA:
+                self.db.execute(statement)
+
+    def __repr__(self):
+        return '<LocalStore [%s]>' % (self.path)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    def close(self):
+        with self.lock:
+            self.db.close()
+
+    def put(self, obj):
+        self.put_all([obj])
+
+    def put_all(self, objs):
+        """Store full objects, replacing what is held for them"""
+        now = time.time()
+        rows = []
+        for obj in objs:
+            if obj.object_id is None or obj.updated_at is None:
+                raise ValueError("Only saved objects can be stored")
+
+            data = json.dump(obj)
+            rows.append((obj.class_name, obj.object_id,
+                format_date(obj.updated_at), data, len(data), now))
+
+        with self.lock, self.db:
+            self.db.executemany('INSERT OR REPLACE INTO objects VALUES '
+                '(?, ?, ?, ?, ?, ?)', rows)
+            self.evict()
+
+    def get(self, class_name, object_id):
+        """The stored object, or None"""
+        with self.lock:
+            row = self.db.execute('SELECT data FROM objects WHERE '
+                'class_name = ? AND object_id = ?', (class_name,
+                object_id)).fetchone()
+        return json.load(row[0], class_name) if row is not None else None
+
+    def iter_raw(self, class_name=None):
+        """Yield (class name, JSON) for the stored objects"""
+        with self.lock:
+            if class_name is None:
+                rows = self.db.execute('SELECT class_name, data '
+                    'FROM objects').fetchall()
+            else:
+                rows = self.db.execute('SELECT class_name, data FROM '
+                    'objects WHERE class_name = ?', (class_name,)).fetchall()
+
+        for class_name, data in rows:
+            yield (class_name, json.load_raw(data))
+
+    def find(self, query):
+        """Run `query` against the stored objects rather than the server
+
+        The query's where, order, limit, skip, keys and excludeKeys apply
+        as the server would apply them, but include is left unresolved.
+        Relations are not stored, so $relatedTo raises
+        UnsupportedQueryError, as do operators this library cannot
+        evaluate.
+        """
+        params = query.data
+        where = json.load_raw(json.dump(params.get('where', {})))
+        results = [data for _, data in self.iter_raw(query.class_name)
+            if matching.matches(data, where)]
+        matching.sort(results, [k for k in params.get('order',
+            '').split(',') if k])
+
+        skip = int(params.get('skip', 0))
+        limit = max(0, min(int(params.get('limit', QUERY_DEFAULT_LIMIT)),
+            QUERY_MAX_LIMIT))
+        keys, exclude_keys = [[k for k in params.get(name, '').split(',')
+            if k] for name in ('keys', 'excludeKeys')]
+
+        objs = []
+        for data in results[skip:skip + limit]:
+            if keys:
+                fields = set(k.split('.')[0] for k in keys) | \
+                    set(['objectId', 'createdAt', 'updatedAt'])
+                data = dict((k, v) for (k, v) in data.items()
+                    if k in fields)
+            for key in exclude_keys:
+                data.pop(key, None)
+            objs.append(json.decode_value(data, query.class_name))
+        return query.project(objs)
+
+    def delete(self, class_name, object_id):
+        with self.lock, self.db:
+            self.db.execute('DELETE FROM objects WHERE class_name = ? AND '
+                'object_id = ?', (class_name, object_id))
+
+    def count(self, class_name=None):
+        with self.lock:
+            if class_name is None:
+                return self.db.execute('SELECT COUNT(*) FROM '
+                    'objects').fetchone()[0]
+            return self.db.execute('SELECT COUNT(*) FROM objects WHERE '
+                'class_name = ?', (class_name,)).fetchone()[0]
+
+    def watermark(self, class_name):
+        """The latest updatedAt `revalidate` has seen, None before then"""
+        with self.lock:
+            row = self.db.execute('SELECT updated_at FROM watermarks WHERE '
+                'class_name = ?', (class_name,)).fetchone()
+        return parse_date(row[0]) if row is not None else None
+
+    def set_watermark(self, class_name, updated_at):
+        with self.lock, self.db:
+            self.db.execute('INSERT OR REPLACE INTO watermarks VALUES '
+                '(?, ?)', (class_name, format_date(updated_at)))
+
+    def revalidate(self, class_name, page_size=None, **kwargs):
+        """Store the objects of `class_name` updated since the watermark,
+        every object the first time, returns how many there were
+
+        Objects updated at the watermark itself are fetched again, in case
+        more of them were saved after it was taken.
+        """
+        query = Query(class_name)
+        watermark = self.watermark(class_name)
+        if watermark is not None:
+            query.gte('updatedAt', watermark)
+
+        if page_size is not None:
+            kwargs['page_size'] = page_size
+
+        count = 0
+        latest = watermark
+        for page in query.iter_pages(**kwargs):
+            self.put_all(page)
+            count += len(page)
+            updated_at = max(obj.updated_at for obj in page)
+            if latest is None or updated_at > latest:
+                latest = updated_at
+
+        if latest is not None:
+            self.set_watermark(class_name, latest)
+        return count
+
+    def warm(self, object_cache=None, headers=None):
+        """Put every stored object in the object cache, returns how many
+
+        They are cached for the ACL context of `headers`, by default that
+        of requests sent without the master key.
+        """
+        object_cache = object_cache or get_object_cache()
+        if object_cache is None:
+            raise ValueError("No object cache, see configure_object_cache")
+
+        headers = headers or build_headers()
+        count = 0
+        for class_name, data in self.iter_raw():
+            object_cache.add(class_name, data, headers)
+            count += 1
+        return count
+
+    def evict(self):
+        """Remove the least recently stored objects beyond the limits"""
+        if self.max_objects is not None:
+            self.db.execute('DELETE FROM objects WHERE rowid IN (SELECT '
+                'rowid FROM objects ORDER BY stored_at DESC, rowid DESC '
+                'LIMIT -1 OFFSET ?)', (self.max_objects,))
+
+        if self.max_bytes is not None:
+            total = 0
+            excess = []
+            rows = self.db.execute('SELECT rowid, size FROM objects ORDER BY '
+                'stored_at DESC, rowid DESC')
+            for rowid, size in rows.fetchall():
+                total += size
+                if total > self.max_bytes:
+                    excess.append((rowid,))
+            self.db.executemany('DELETE FROM objects WHERE rowid = ?',
+                excess)
+
+    def compact(self):
+        """Apply the limits and give freed pages back to the filesystem"""
+        with self.lock:
+            with self.db:
+                self.evict()
+            self.db.execute('VACUUM')
@@ -0,0 +1,221 @@
+import functools
+import itertools
+import json
+import os
+import threading
+import time
+
+from .packages import requests
+
+TRACERS = []
+
+span_ids = itertools.count(1)
+context = threading.local()
+
+class Tracer(object):
+    """Receives spans as they open and close, see `add_tracer`"""
+
+    def start_span(self, span):
+        pass
+
+    def finish_span(self, span):
+        pass
+
+class Span(object):
+    """A timed operation, an HTTP call or a model method around them"""
+
+    def __init__(self, name, category, parent=None, **attrs):
+        self.span_id = next(span_ids)
+        self.name = name
+        self.category = category
+        self.parent = parent
+        self.attrs = attrs
+        self.start = time.time()
+        self.end = None
+        self.error = None
+        self.thread_id = threading.current_thread().ident
+
+    def __repr__(self):
+        return '<Span [%s]>' % (self.name)
+
+    def __enter__(self):
+        stack = getattr(context, 'stack', None)
+        if stack is None:
+            stack = context.stack = []
+        stack.append(self)
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        context.stack.pop()
+
+    @property
+    def parent_id(self):
+        return self.parent.span_id if self.parent is not None else None
+
+    @property
+    def duration(self):
+        end = self.end if self.end is not None else time.time()
+        return end - self.start
+
+    def set(self, **attrs):
+        self.attrs.update(attrs)
+
+    def finish(self, error=None, **attrs):
+        if self.end is not None:
+            return
+
+        self.end = time.time()
+        self.error = error
+        self.attrs.update(attrs)
+        if error is not None:
+            self.attrs['error'] = type(error).__name__
+
+        for tracer in list(TRACERS):
+            tracer.finish_span(self)
+
+class NullSpan(object):
+    """Stands in for `Span` while no tracer is installed"""
+
+    span_id = None
+    parent_id = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        pass
+
+    def set(self, **attrs):
+        pass
+
+    def finish(self, error=None, **attrs):
+        pass
+
+NULL_SPAN = NullSpan()
+
+def add_tracer(tracer):
+    TRACERS.append(tracer)
+
+def remove_tracer(tracer):
+    if tracer in TRACERS:
+        TRACERS.remove(tracer)
+
+def current_span():
+    stack = getattr(context, 'stack', None)
+    return stack[-1] if stack else None
+
+def start_span(name, category, parent=None, **attrs):
+    """Open a span, by default a child of the current thread's span"""
+    if not TRACERS:
+        return NULL_SPAN
+
+    span = Span(name, category, parent or current_span(), **attrs)
+    for tracer in list(TRACERS):
+        tracer.start_span(span)
+    return span
+
+def describe(args):
+    """Span attributes for the object or objects an operation acts on"""
+    if not args:
+        return {}
+
+    target = args[0]
+    if isinstance(target, (list, tuple)):
+        attrs = {'count': len(target)}
+        if target and hasattr(target[0], 'class_name'):
+            attrs['class_name'] = target[0].class_name
+        return attrs
+
+    if hasattr(target, 'class_name'):
+        return {'class_name': target.class_name}
+
+    return {}
+
+def traced(name):
+    """Wrap a model method in an 'operation' span
+
+    Background and event-loop variants close their span when the returned
+    `Future` completes, so the span covers every retry.
+    """
+    def decorator(fn):
+        @functools.wraps(fn)
+        def wrapper(*args, **kwargs):
+            if not TRACERS:
+                return fn(*args, **kwargs)
+
+            span = start_span(name, 'operation', **describe(args))
+            with span:
+                try:
+                    result = fn(*args, **kwargs)
+                except Exception as e:
+                    span.finish(error=e)
+                    raise
+
+            if isinstance(result, requests.Future):
+                result.add_done_callback(
+                    lambda future: finish_future_span(span, future))
+            else:
+                finish_result_span(span, result)
+
+            return result
+        return wrapper
+    return decorator
+
+def finish_result_span(span, result, error=None):
+    if isinstance(result, list):
+        span.finish(error=error, count=len(result))
+    else:
+        span.finish(error=error)
+
+def finish_future_span(span, future):
+    if future.cancelled():
+        span.finish(error=requests.CancelledError("Request was cancelled"))
+    elif future.exception() is not None:
+        span.finish(error=future.exception())
+    else:
+        finish_result_span(span, future.result())
+
+class ChromeTraceExporter(Tracer):
+    """Collects spans as Chrome trace events
+
+    The written file opens as a waterfall in chrome://tracing or Perfetto.
+    """
+
+    def __init__(self):
+        self.events = []
+        self.pid = os.getpid()
+        self.lock = threading.Lock()
+
+    def finish_span(self, span):
+        args = dict(span.attrs)
+        args['span_id'] = span.span_id
+        if span.parent_id is not None:
+            args['parent_id'] = span.parent_id
+
+        event = {
+            'name': span.name,
+            'cat': span.category,
+            'ph': 'X',
+            'ts': span.start * 1e6,
+            'dur': (span.end - span.start) * 1e6,
+            'pid': self.pid,
+            'tid': span.thread_id,
+            'args': args
+        }
+
+        with self.lock:
+            self.events.append(event)
+
+    def to_json(self):
+        with self.lock:
+            events = sorted(self.events, key=lambda e: e['ts'])
+        return json.dumps({'traceEvents': events, 'displayTimeUnit': 'ms'},
+            default=str)
+
+    def write(self, path):
+        with open(path, 'w') as f:
+            f.write(self.to_json())
+
+    def clear(self):
+        with self.lock:
+            del self.events[:]
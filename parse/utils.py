@@ -1,12 +1,19 @@
 import base64
+import email.utils
 import json
 import logging
+import random
+import threading
+import time
 from numbers import Number
+from urlparse import urlparse
 
 from .packages import requests
 
 from . import constants
 from . import parsejson as json
+from . import tracing
+from .cache import get_query_cache, get_object_cache
 from .exceptions import ParseException
 
 
@@ -46,11 +53,600 @@ def generate_exception(error):
         # invalid JSON
         e = requests.HTTPError(str(error))
         e.reason = str(error)
-        e.code = error.code
+        e.code = getattr(error, 'code', None)
         e.response = error.response
     
     return e
 
+class RetryBudget(object):
+    """Caps retries at a fraction of the requests sent recently
+
+    Once more than `ratio` of the requests in the current window are
+    retries (beyond a floor of `min_retries`), further retries are
+    refused so a struggling server isn't hit with a retry storm.
+    """
+
+    def __init__(self, ratio=constants.RETRY_BUDGET_RATIO,
+        min_retries=constants.RETRY_BUDGET_MIN,
+        window=constants.RETRY_BUDGET_WINDOW):
+        self.ratio = ratio
+        self.min_retries = min_retries
+        self.window = window
+        self.lock = threading.Lock()
+        self.reset()
+
+    def reset(self):
+        self.started = time.time()
+        self.requests = 0
+        self.retries = 0
+
+    def roll(self):
+        if time.time() - self.started > self.window:
+            self.reset()
+
+    def record_request(self):
+        with self.lock:
+            self.roll()
+            self.requests += 1
+
+    def acquire(self):
+        with self.lock:
+            self.roll()
+            allowed = max(self.min_retries, self.ratio * self.requests)
+            if self.retries >= allowed:
+                return False
+            self.retries += 1
+            return True
+
+class RetryStats(object):
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.reset()
+
+    def reset(self):
+        self.requests = 0
+        self.retries = 0
+        self.exhausted = 0
+        self.budget_exhausted = 0
+        self.statuses = {}
+        self.exceptions = {}
+
+    def increment(self, name, key=None):
+        with self.lock:
+            setattr(self, name, getattr(self, name) + 1)
+            if isinstance(key, int):
+                self.statuses[key] = self.statuses.get(key, 0) + 1
+            elif key is not None:
+                self.exceptions[key] = self.exceptions.get(key, 0) + 1
+
+    def as_dict(self):
+        with self.lock:
+            return {
+                'requests': self.requests,
+                'retries': self.retries,
+                'exhausted': self.exhausted,
+                'budget_exhausted': self.budget_exhausted,
+                'statuses': dict(self.statuses),
+                'exceptions': dict(self.exceptions)
+            }
+
+RETRY_STATS = RetryStats()
+
+class RetryPolicy(object):
+    """When and how long to wait before resending a failed request
+
+    :param total: retries allowed per request
+    :param statuses: retryable HTTP statuses, or a dict mapping each
+        status to its own retry limit
+    :param exceptions: retryable transport errors, or a dict mapping each
+        exception class to its own retry limit (0 never retries it)
+    :param methods: methods safe to resend; POST isn't idempotent so has to
+        be added explicitly
+    :param backoff_factor: base of the exponential backoff in seconds; the
+        actual delay is drawn uniformly from zero up to it (full jitter)
+    :param backoff_max: cap on the backoff in seconds
+    :param respect_retry_after: wait as long as the server's Retry-After
+        asks, rather than backing off
+    :param retry_after_max: longest Retry-After waited out in seconds,
+        a request asked to wait longer isn't retried
+    :param budget: a `RetryBudget` shared by every request using the policy
+    """
+
+    def __init__(self, total=constants.RETRY_TOTAL,
+        statuses=constants.RETRY_STATUSES, exceptions=None,
+        methods=constants.RETRY_METHODS,
+        backoff_factor=constants.RETRY_BACKOFF_FACTOR,
+        backoff_max=constants.RETRY_BACKOFF_MAX, respect_retry_after=True,
+        retry_after_max=constants.RETRY_AFTER_MAX, budget=None):
+        if exceptions is None:
+            exceptions = {
+                requests.SSLError: 0,
+                requests.ConnectionError: total,
+                requests.Timeout: total
+            }
+
+        self.total = total
+        self.statuses = self.build_rules(statuses)
+        self.exceptions = self.build_rules(exceptions)
+        self.methods = tuple(m.upper() for m in methods)
+        self.backoff_factor = backoff_factor
+        self.backoff_max = backoff_max
+        self.respect_retry_after = respect_retry_after
+        self.retry_after_max = retry_after_max
+        self.budget = budget if budget is not None else RetryBudget()
+
+    def build_rules(self, rules):
+        if hasattr(rules, 'items'):
+            return dict(rules)
+        return dict((rule, self.total) for rule in rules)
+
+    def get_limit(self, error):
+        response = getattr(error, 'response', None)
+        if isinstance(error, requests.HTTPError) and response is not None:
+            return self.statuses.get(response.status_code, 0)
+
+        for cls in type(error).__mro__:
+            if cls in self.exceptions:
+                return self.exceptions[cls]
+
+        return 0
+
+    def get_retry_after(self, error):
+        response = getattr(error, 'response', None)
+        if response is None or not self.respect_retry_after:
+            return None
+
+        value = response.headers.get('retry-after')
+        if not value:
+            return None
+
+        try:
+            return max(0, float(value))
+        except ValueError:
+            date = email.utils.parsedate_tz(value)
+            if date is None:
+                return None
+            return max(0, email.utils.mktime_tz(date) - time.time())
+
+    def get_backoff(self, attempt):
+        backoff = self.backoff_factor * (2 ** attempt)
+        return random.uniform(0, min(self.backoff_max, backoff))
+
+    def next_delay(self, method, attempt, error):
+        """Seconds to wait before retry number `attempt + 1`, or None"""
+        if method.upper() not in self.methods:
+            return None
+
+        response = getattr(error, 'response', None)
+        if isinstance(error, requests.HTTPError) and response is not None:
+            key = response.status_code
+        else:
+            key = type(error).__name__
+
+        if attempt >= min(self.total, self.get_limit(error)):
+            if attempt > 0:
+                RETRY_STATS.increment('exhausted', key)
+            return None
+
+        # the server's Retry-After is waited out in full, or not at all
+        delay = self.get_retry_after(error)
+        if delay is not None and self.retry_after_max is not None and \
+            delay > self.retry_after_max:
+            RETRY_STATS.increment('exhausted', key)
+            return None
+
+        if not self.budget.acquire():
+            RETRY_STATS.increment('budget_exhausted', key)
+            return None
+
+        RETRY_STATS.increment('retries', key)
+
+        if delay is None:
+            return self.get_backoff(attempt)
+        return delay
+
+RETRY_POLICY = RetryPolicy()
+
+def set_retry_policy(policy):
+    """Set the default `RetryPolicy`, None turns retries off"""
+    global RETRY_POLICY
+    RETRY_POLICY = policy
+
+def retry_stats():
+    """Counts of retried, exhausted and budget-refused requests"""
+    return RETRY_STATS.as_dict()
+
+class TokenBucket(object):
+    """Token bucket allowing `burst` requests at once and `rate` per second
+
+    Tokens are reserved rather than waited for, so concurrent callers are
+    handed increasing delays in the order they asked.
+    """
+
+    def __init__(self, rate, burst=None):
+        if rate <= 0:
+            raise ValueError("Rate must be positive")
+
+        self.rate = float(rate)
+        self.burst = float(burst if burst is not None else max(1, rate))
+        self.tokens = self.burst
+        self.updated = time.time()
+        self.lock = threading.Lock()
+        self.throttled = 0
+        self.wait_time = 0.0
+
+    def reserve(self):
+        """Take a token, returns the seconds to wait before using it"""
+        with self.lock:
+            now = time.time()
+            self.tokens = min(self.burst,
+                self.tokens + (now - self.updated) * self.rate)
+            self.updated = now
+            self.tokens -= 1
+
+            if self.tokens >= 0:
+                return 0
+
+            delay = -self.tokens / self.rate
+            self.throttled += 1
+            self.wait_time += delay
+            return delay
+
+    def acquire(self):
+        delay = self.reserve()
+        if delay > 0:
+            time.sleep(delay)
+
+    def stats(self):
+        with self.lock:
+            return {
+                'rate': self.rate,
+                'burst': self.burst,
+                'throttled': self.throttled,
+                'wait_time': self.wait_time
+            }
+
+RATE_LIMITERS = {}
+
+def set_rate_limit(rate, burst=None, name=None):
+    """Limit requests for an application, None for `rate` removes it
+
+    :param rate: sustained requests per second
+    :param burst: requests allowed at once after a quiet spell
+    :param name: application name, defaults to the current application
+    """
+    name = name if name is not None else constants.APPLICATION_NAME
+    if name not in constants.APPLICATIONS:
+        raise ValueError("Unknown application '%s'" % (name))
+
+    if rate is None:
+        RATE_LIMITERS.pop(name, None)
+    else:
+        RATE_LIMITERS[name] = TokenBucket(rate, burst)
+
+def get_rate_limiter(headers=None):
+    """The limiter for the application a request is sent as"""
+    if not RATE_LIMITERS:
+        return None
+
+    app_id = (headers or {}).get('X-Parse-Application-Id')
+    for name, app in constants.APPLICATIONS.items():
+        if app['app_id'] == app_id and name in RATE_LIMITERS:
+            return RATE_LIMITERS[name]
+
+    return RATE_LIMITERS.get(constants.APPLICATION_NAME)
+
+def rate_limit_stats():
+    return dict((name, limiter.stats()) for (name, limiter) in
+        RATE_LIMITERS.items())
+
+class Flight(object):
+    """One request in flight, with the callers waiting on its outcome"""
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.finished = threading.Event()
+        self.response = None
+        self.error = None
+        self.waiters = []
+        # callers that joined and haven't cancelled, see `Coalescer.leave`
+        self.callers = 0
+        # the request's own future, when it was sent in the background
+        self.future = None
+
+    def finish(self, response, error):
+        with self.lock:
+            if self.finished.is_set():
+                return
+            self.response = response
+            self.error = error
+            self.finished.set()
+            waiters, self.waiters = self.waiters, []
+
+        for waiter in waiters:
+            waiter(response, error)
+
+    def add_callback(self, callback):
+        with self.lock:
+            if not self.finished.is_set():
+                self.waiters.append(callback)
+                return
+        callback(self.response, self.error)
+
+    def waiter(self):
+        future = self.future
+        if future is not None and future.waiter is not None:
+            future.waiter()
+
+    def wait(self):
+        if not self.finished.is_set():
+            self.waiter()
+        self.finished.wait()
+
+        if self.error is not None:
+            raise self.error
+        return self.response
+
+class Coalescer(object):
+    """Shares one request among identical requests made while it is in
+    flight, so a burst of the same read reaches the server once
+
+    Requests are identical when their method, URL, body, application and
+    credentials are. Every caller gets the same response, to decode for
+    itself, or the same exception. Cancelling a caller's future detaches
+    that caller only, the request is cancelled once every caller has.
+    """
+
+    def __init__(self):
+        self.enabled = False
+        self.lock = threading.Lock()
+        self.flights = {}
+        self.leaders = 0
+        self.followers = 0
+
+    def build_key(self, method, url, data, headers):
+        headers = headers or {}
+        return (method, url, data, headers.get('X-Parse-Application-Id'),
+            headers.get('X-Parse-Master-Key'),
+            headers.get('X-Parse-Session-Token'))
+
+    def join(self, key):
+        """Returns the flight for `key` and whether this caller leads it"""
+        with self.lock:
+            flight = self.flights.get(key)
+            if flight is not None:
+                self.followers += 1
+                flight.callers += 1
+                return (flight, False)
+
+            flight = self.flights[key] = Flight()
+            self.leaders += 1
+            flight.callers += 1
+            return (flight, True)
+
+    def leave(self, key, flight):
+        """A caller of `flight` cancelled, returns True if it was the last,
+        so the request itself can be cancelled
+
+        The last caller takes the flight out, so later callers send the
+        request afresh rather than joining one nobody waits for.
+        """
+        with self.lock:
+            flight.callers -= 1
+            if flight.callers > 0:
+                return False
+            if self.flights.get(key) is flight:
+                del self.flights[key]
+            return True
+
+    def land(self, key, flight, response, error):
+        with self.lock:
+            if self.flights.get(key) is flight:
+                del self.flights[key]
+        flight.finish(response, error)
+
+    def stats(self):
+        with self.lock:
+            return {
+                'leaders': self.leaders,
+                'followers': self.followers,
+                'in_flight': len(self.flights)
+            }
+
+COALESCER = Coalescer()
+
+def configure_coalescing(enabled=True):
+    """Coalesce identical GET requests made while one is in flight
+
+    Other requests, such as `Cloud.call_function`, are coalesced when
+    passed `coalesce=True`, and any request can opt out with
+    `coalesce=False`.
+    """
+    COALESCER.enabled = enabled
+
+def coalescing_stats():
+    """Requests sent (leaders), requests that shared one (followers) and
+    requests in flight"""
+    return COALESCER.stats()
+
+def coalesce_send(key, method, url, retry, **kwargs):
+    flight, leader = COALESCER.join(key)
+    if not leader:
+        return flight.wait()
+
+    # landed whatever happens, or later callers would wait forever
+    response = None
+    error = requests.CancelledError("Request was interrupted")
+    try:
+        response = send(requests.request, method, url, retry, **kwargs)
+        # read the body once, before several threads ask for it
+        response.content
+        error = None
+    except Exception as e:
+        response, error = None, e
+        raise
+    finally:
+        COALESCER.land(key, flight, response, error)
+    return response
+
+def coalesce_send_in_background(key, method, url, retry, callback,
+    **kwargs):
+    flight, leader = COALESCER.join(key)
+
+    # every caller gets a future of its own, so cancelling one only
+    # detaches that caller, and the request goes on for the others
+    future = requests.Future(flight.waiter)
+    flight.add_callback(lambda response, error: future.run(callback,
+        response, error))
+
+    def leave(future):
+        if future.cancelled() and COALESCER.leave(key, flight):
+            flight.future.cancel()
+
+    future.add_done_callback(leave)
+    if not leader:
+        return future
+
+    def land(response, error):
+        if isinstance(error, (requests.HTTPError,
+            requests.RequestException)):
+            # converted once, so every caller gets the same exception
+            error = generate_exception(error)
+        elif error is None:
+            try:
+                response.content
+            except Exception as e:
+                response, error = None, e
+        COALESCER.land(key, flight, response, error)
+
+    def cancelled(sent):
+        if sent.cancelled():
+            COALESCER.land(key, flight, None,
+                requests.CancelledError("Request was cancelled"))
+
+    flight.future = send_in_background(requests.request, method, url, retry,
+        land, **kwargs)
+    flight.future.add_done_callback(cancelled)
+    return future
+
+def reset_after_fork():
+    """Make a forked child process able to send requests
+
+    Besides `requests.reset_after_fork`, this makes afresh the locks of
+    this module and the caches, which a thread of the parent may have
+    held, and forgets the parent's requests in flight.
+    """
+    global COALESCER
+
+    requests.reset_after_fork()
+
+    coalescer = Coalescer()
+    coalescer.enabled = COALESCER.enabled
+    COALESCER = coalescer
+
+    RETRY_STATS.lock = threading.Lock()
+    if RETRY_POLICY:
+        RETRY_POLICY.budget.lock = threading.Lock()
+    for limiter in RATE_LIMITERS.values():
+        limiter.lock = threading.Lock()
+
+    for cache in (get_query_cache(), get_object_cache()):
+        if cache is not None:
+            cache.lock = threading.Lock()
+
+def start_http_span(method, url):
+    return tracing.start_span(' '.join([method, urlparse(url).path]),
+        'http', method=method, url=url)
+
+def finish_http_span(span, response, error, retries):
+    if response is None:
+        response = getattr(error, 'response', None)
+    status = response.status_code if response is not None else None
+    span.finish(error=error, status_code=status, retries=retries)
+
+def send(send_request, method, url, retry, **kwargs):
+    attempt = 0
+    limiter = get_rate_limiter(kwargs.get('headers'))
+    span = start_http_span(method, url)
+    RETRY_STATS.increment('requests')
+    if retry:
+        retry.budget.record_request()
+
+    while True:
+        if limiter is not None:
+            limiter.acquire()
+
+        try:
+            r = send_request(method, url, **kwargs)
+        except (requests.HTTPError, requests.RequestException) as e:
+            delay = retry.next_delay(method, attempt, e) if retry else None
+            if delay is None:
+                finish_http_span(span, None, e, attempt)
+                raise generate_exception(e)
+            time.sleep(delay)
+            attempt += 1
+        else:
+            r.retries = attempt
+            finish_http_span(span, r, None, attempt)
+            return r
+
+def send_in_background(send_request, method, url, retry, callback,
+    **kwargs):
+    """Send with retries, returns a `Future` resolved by `callback`
+
+    Retries, and requests held back by the rate limiter, are sent from the
+    scheduler thread after their delay so no worker is blocked waiting.
+    """
+    future = requests.Future()
+    limiter = get_rate_limiter(kwargs.get('headers'))
+    span = start_http_span(method, url)
+    state = {'attempt': 0}
+    RETRY_STATS.increment('requests')
+    if retry:
+        retry.budget.record_request()
+
+    def handle(response, error):
+        if error is not None and retry:
+            delay = retry.next_delay(method, state['attempt'], error)
+            if delay is not None:
+                state['attempt'] += 1
+                requests.SCHEDULER.call_later(delay, attempt)
+                return
+
+        if response is not None:
+            response.retries = state['attempt']
+        finish_http_span(span, response, error, state['attempt'])
+        future.run(callback, response, error)
+
+    def transmit():
+        # the request can't be cancelled once it is on the wire
+        if not future.set_running():
+            span.finish(cancelled=True)
+            return
+
+        try:
+            inner = send_request(method, url, callback=handle, **kwargs)
+        except Exception as e:
+            finish_http_span(span, None, e, state['attempt'])
+            future.run(callback, None, e)
+        else:
+            future.waiter = inner.waiter
+            future.add_done_callback(lambda outer: cancel(outer, inner))
+
+    def cancel(outer, inner):
+        if outer.cancelled():
+            inner.cancel()
+
+    def attempt():
+        delay = limiter.reserve() if limiter is not None else 0
+        if delay > 0:
+            requests.SCHEDULER.call_later(delay, transmit)
+        else:
+            transmit()
+
+    attempt()
+    return future
+
 def request(method, url, **kwargs):
     data = kwargs.get('data')
     headers = kwargs.get('headers')
@@ -58,19 +654,50 @@ def request(method, url, **kwargs):
     verify = kwargs.get('verify', True)
     cookies = kwargs.get('cookies')
     callback = kwargs.get('callback')
-    
+    retry = kwargs.get('retry', RETRY_POLICY)
+    stream = kwargs.get('stream', False)
+    coalesce = kwargs.get('coalesce')
+
+    if coalesce is None:
+        coalesce = COALESCER.enabled and method == 'GET'
+    if coalesce and not stream:
+        key = COALESCER.build_key(method, url, data, headers)
+        if callback:
+            return coalesce_send_in_background(key, method, url, retry,
+                callback, data=data, headers=headers, timeout=timeout,
+                verify=verify, cookies=cookies)
+        return coalesce_send(key, method, url, retry, data=data,
+            headers=headers, timeout=timeout, verify=verify, cookies=cookies)
+
     if callback:
-        r = requests.request(method, url, data=data, headers=headers,
-            timeout=timeout, verify=verify, cookies=cookies, callback=callback)
+        r = send_in_background(requests.request, method, url, retry,
+            callback, data=data, headers=headers, timeout=timeout,
+            verify=verify, cookies=cookies, stream=stream)
     else:
-        try:
-            r = requests.request(method, url, data=data, headers=headers,
-                timeout=timeout, verify=verify, cookies=cookies)
-        except (requests.HTTPError, requests.RequestException) as e:
-            raise generate_exception(e)
+        r = send(requests.request, method, url, retry, data=data,
+            headers=headers, timeout=timeout, verify=verify, cookies=cookies,
+            stream=stream)
     
     return r
 
+def arequest(method, url, **kwargs):
+    """Non-blocking `request` multiplexed on one event loop thread
+
+    Returns a `Future` resolving to the callback's result, or to the
+    response when no callback is given.
+    """
+    data = kwargs.get('data')
+    headers = kwargs.get('headers')
+    timeout = kwargs.get('timeout')
+    verify = kwargs.get('verify', True)
+    cookies = kwargs.get('cookies')
+    callback = kwargs.get('callback') or requests.resolve_response
+    retry = kwargs.get('retry', RETRY_POLICY)
+
+    return send_in_background(requests.async_request, method, url, retry,
+        callback, data=data, headers=headers, timeout=timeout,
+        verify=verify, cookies=cookies)
+
 def get(url, **kwargs):
     return request('GET', url, **kwargs)
 
@@ -83,6 +710,70 @@ def put(url, **kwargs):
 def delete(url, **kwargs):
     return request('DELETE', url, **kwargs)
 
+def aget(url, **kwargs):
+    return arequest('GET', url, **kwargs)
+
+def apost(url, **kwargs):
+    return arequest('POST', url, **kwargs)
+
+def aput(url, **kwargs):
+    return arequest('PUT', url, **kwargs)
+
+def adelete(url, **kwargs):
+    return arequest('DELETE', url, **kwargs)
+
+def configure_pool(maxsize=None, idle_timeout=None, block=None):
+    """Configure the keep-alive connection pools shared by every request"""
+    requests.configure_pool(maxsize=maxsize, idle_timeout=idle_timeout,
+        block=block)
+
+def pool_stats():
+    """Connection pool hits, misses, evictions and connections in use,
+    with DNS cache and TLS session counters under 'dns' and 'tls'"""
+    return requests.pool_stats()
+
+def mount(prefix, adapter):
+    """Send requests for URLs starting with `prefix` through `adapter`
+
+    For example `parse.replay.RecordReplayAdapter` to record or replay
+    traffic for 'https://api.parse.com'.
+    """
+    requests.mount(prefix, adapter)
+
+def unmount(prefix):
+    return requests.unmount(prefix)
+
+def configure_dns_cache(ttl=None, maxsize=None):
+    """Seconds resolved addresses are reused for, 0 to disable"""
+    requests.configure_dns_cache(ttl=ttl, maxsize=maxsize)
+
+def add_timing_hook(hook):
+    """Call `hook(timing)` after every request with its phase timings
+
+    `timing.as_dict()` gives the dns, connect, tls, send, wait and receive
+    seconds with request and response byte counts.
+    """
+    requests.add_timing_hook(hook)
+
+def remove_timing_hook(hook):
+    requests.remove_timing_hook(hook)
+
+def wait_all(futures, timeout=None):
+    """Wait for background requests, returns (done, not_done) sets"""
+    return requests.wait_all(futures, timeout=timeout)
+
+def as_completed(futures, timeout=None):
+    """Iterate over background requests in the order they finish"""
+    return requests.as_completed(futures, timeout=timeout)
+
+def configure_executor(workers=requests.EXECUTOR_WORKERS,
+    queue_size=requests.EXECUTOR_QUEUE_SIZE,
+    max_spares=requests.EXECUTOR_MAX_SPARES):
+    """Set the worker count, queue bound and spare thread cap for
+    *_in_background calls"""
+    requests.configure_executor(workers=workers, queue_size=queue_size,
+        max_spares=max_spares)
+
 def build_callback(result_type, handler, **kwargs):
     objs = kwargs.pop('objs', None)
     callback = kwargs.pop('callback', None)
@@ -94,11 +785,17 @@ def build_callback(result_type, handler, **kwargs):
             if not isinstance(result, result_type):
                 msg = "Result is of incorrect type"
                 raise TypeError(msg)
-        elif isinstance(error, requests.HTTPError):
-            error = get_error(error)
+        elif isinstance(error, (requests.HTTPError,
+            requests.RequestException)):
+            error = generate_exception(error)
 
         if callback:
             callback(result, error, **kwargs)
+
+        # resolves the future returned by the *_in_background call
+        if error:
+            raise error
+        return result
     
     return wrapper
 
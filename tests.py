@@ -1,20 +1,47 @@
+import datetime
+import gzip
+import httplib
+import json
 import os
+import socket
 import sys
+import tempfile
+import threading
 import time
 import unittest
 import parse
+from parse import dates, parsejson, tracing, utils
+from parse.packages import requests
+from parse.packages.requests import Executor, AsyncResponseParser
+from parse.cache import QueryCache
+from parse.faults import FaultInjectionAdapter, Fault
+from parse.scan import Partition, ScanCoordinator
+from parse.replay import RecordReplayAdapter, ReplayMissError, RECORD
+from parse.server import LocalServer
+from parse.store import LocalStore
+from parse.utils import TokenBucket
 
 
 TEST_CLASS_NAME = 'TestObject'
 
-class ParseTestTimeout(Exception):
-    pass
+LOCAL_SERVER = None
 
 def set_application():
-    app_id = os.environ['APPLICATION_ID']
-    rest_api_key = os.environ['REST_API_KEY']
-    master_key = os.environ['MASTER_KEY']
-    parse.set_application('test-parse', app_id, rest_api_key, master_key)
+    """Use the app in the environment, or else a local stand-in server"""
+    global LOCAL_SERVER
+
+    if 'APPLICATION_ID' in os.environ:
+        app_id = os.environ['APPLICATION_ID']
+        rest_api_key = os.environ['REST_API_KEY']
+        master_key = os.environ['MASTER_KEY']
+        parse.set_application('test-parse', app_id, rest_api_key,
+            master_key)
+        return
+
+    if LOCAL_SERVER is None:
+        LOCAL_SERVER = LocalServer().start()
+    parse.set_application('test-parse-local', 'app-id', 'rest-api-key',
+        'master-key', api_base_url=LOCAL_SERVER.url)
 
 def delete_all_objects(class_name=TEST_CLASS_NAME):
     while True:
@@ -40,21 +67,20 @@ def assert_is_object(test_case, obj):
     test_case.assertIsNotNone(obj.object_id)
     test_case.assertIsNotNone(obj.created_at)
 
-def wait(r, timeout=30):
-    end_time = time.time() + timeout
-    while True:
-        time.sleep(1)
-        if time.time() >= end_time:
-            raise ParseTestTimeout("Wait for value change timed out")
-        if r['result'] is not None:
-            break
+# scan tasks run in worker processes, so they live at module level
+SCAN_MARKER = None
+
+def scan_task(obj):
+    if obj['index'] == 5 and not os.path.exists(SCAN_MARKER):
+        open(SCAN_MARKER, 'w').close()
+        raise ValueError("fails the first time")
+
+def failing_scan_task(obj):
+    raise ValueError("always fails")
 
 class ParseObjectTestCase(unittest.TestCase):
     def setUp(self):
-        app_id = os.environ['APPLICATION_ID']
-        rest_api_key = os.environ['REST_API_KEY']
-        master_key = os.environ['MASTER_KEY']
-        parse.set_application('test-parse', app_id, rest_api_key, master_key)
+        set_application()
 
     def tearDown(self):
         delete_all_objects(TEST_CLASS_NAME)
@@ -69,8 +95,8 @@ class ParseObjectTestCase(unittest.TestCase):
             r['result'] = result if not error else False
 
         obj = parse.Object(TEST_CLASS_NAME)
-        obj.save_in_background(callback=callback).wait()
-        wait(r)
+        self.assertTrue(obj.save_in_background(callback=callback).result(30))
+        self.assertTrue(r['result'])
         assert_is_object(self, obj)
 
     def test_refresh(self):
@@ -87,10 +113,20 @@ class ParseObjectTestCase(unittest.TestCase):
             r['result'] = result if not error else error
 
         obj = parse.Object(TEST_CLASS_NAME, object_id)
-        obj.refresh_in_background(callback=callback).wait()
-        wait(r)
+        obj.refresh_in_background(callback=callback).result(30)
+        self.assertIs(r['result'], obj)
         assert_is_object(self, obj)
 
+    def test_save_many_in_background(self):
+        objs = [create_object(key='index', value=i) for i in range(20)]
+        futures = [obj.save_in_background() for obj in objs]
+
+        for future in parse.as_completed(futures, timeout=60):
+            self.assertTrue(future.result())
+
+        for obj in objs:
+            assert_is_object(self, obj)
+
     def test_delete(self):
         obj = save_object()
         object_id = obj.object_id
@@ -108,8 +144,8 @@ class ParseObjectTestCase(unittest.TestCase):
         def callback(result, error):
             r['result'] = result if not error else False
 
-        obj.delete_in_background(callback=callback).wait()
-        wait(r)
+        self.assertTrue(obj.delete_in_background(callback=callback).result(30))
+        self.assertTrue(r['result'])
 
         obj = parse.Object(TEST_CLASS_NAME, object_id)
         with self.assertRaises(parse.ParseException):
@@ -208,10 +244,7 @@ class ParseObjectTestCase(unittest.TestCase):
 
 class ParseUserTestCase(unittest.TestCase):
     def setUp(self):
-        app_id = os.environ['APPLICATION_ID']
-        rest_api_key = os.environ['REST_API_KEY']
-        master_key = os.environ['MASTER_KEY']
-        parse.set_application('test-parse', app_id, rest_api_key, master_key)
+        set_application()
 
     def tearDown(self):
         delete_all_objects(parse.CLASS_TYPE_USER)
@@ -240,5 +273,1070 @@ class ParseUserTestCase(unittest.TestCase):
         pass
     
 
+class ParseLocalServerTestCase(unittest.TestCase):
+    def setUp(self):
+        set_application()
+
+    def tearDown(self):
+        delete_all_objects(TEST_CLASS_NAME)
+
+    def test_query(self):
+        for i in range(5):
+            save_object(key='index', value=i)
+
+        q = parse.Query(TEST_CLASS_NAME)
+        q.gte('index', 1)
+        q.order('index', False)
+        q.limit = 2
+        q.skip = 1
+        self.assertEqual([obj['index'] for obj in q.find()], [3, 2])
+        self.assertEqual(parse.Query(TEST_CLASS_NAME).count(), 5)
+
+    def test_lazy_find(self):
+        obj = create_object(key='when', value=datetime.datetime(2014, 3, 1))
+        obj['owner'] = parse.Object('_User', 'u')
+        obj.save()
+
+        result = parse.Query(TEST_CLASS_NAME).find(lazy=True)[0]
+        self.assertIsInstance(result, parse.Object)
+        self.assertEqual(result.object_id, obj.object_id)
+        self.assertIsInstance(dict.__getitem__(result, 'when'), dict)
+        self.assertEqual(result['when'], datetime.datetime(2014, 3, 1))
+        self.assertIsInstance(dict.__getitem__(result, 'when'),
+            datetime.datetime)
+        self.assertEqual(dict(result.items())['owner'].object_id, 'u')
+        self.assertEqual(result.dirty_keys, [])
+
+        result['index'] = 1
+        self.assertTrue(result.save())
+        self.assertEqual(parse.Query(TEST_CLASS_NAME).get(
+            obj.object_id)['index'], 1)
+
+        future = parse.Query(TEST_CLASS_NAME).find_in_background(lazy=True)
+        self.assertEqual(future.result(5)[0]['when'], result['when'])
+
+    def test_iter_find(self):
+        parse.Object.save_all([create_object(key='index', value=i)
+            for i in range(30)])
+        q = parse.Query(TEST_CLASS_NAME)
+        q.order('index', True)
+
+        results = q.iter_find()
+        self.assertEqual(parse.pool_stats()['in_use'], 1)
+        self.assertEqual([obj['index'] for obj in results], range(30))
+        self.assertEqual(parse.pool_stats()['in_use'], 0)
+
+        results = q.iter_find()
+        self.assertIsInstance(next(results), parse.Object)
+        results.close()
+        self.assertEqual(parse.pool_stats()['in_use'], 0)
+
+    def test_keys(self):
+        objs = [create_object(key='index', value=i) for i in range(3)]
+        for obj in objs:
+            obj['blob'] = 'x' * 100
+        parse.Object.save_all(objs)
+
+        results = parse.Query(TEST_CLASS_NAME).keys('index').find()
+        self.assertEqual(sorted(obj['index'] for obj in results), [0, 1, 2])
+        self.assertNotIn('blob', results[0])
+        with self.assertRaises(parse.UnfetchedKeyError):
+            results[0]['blob']
+
+        parse.Object.fetch_missing(results[:1])
+        self.assertEqual(results[0]['blob'], 'x' * 100)
+
+        timings = []
+        parse.add_timing_hook(timings.append)
+        try:
+            query = parse.Query(TEST_CLASS_NAME)
+            results = query.exclude_keys('blob', fetch_missing=True).find()
+            self.assertNotIn('blob', results[0])
+            self.assertEqual([obj['blob'] for obj in results], ['x' * 100] * 3)
+        finally:
+            parse.remove_timing_hook(timings.append)
+        self.assertEqual(len(timings), 2)
+
+    def test_iter_all(self):
+        objs = [create_object(key='index', value=i // 3) for i in range(25)]
+        for i in range(0, 25, 10):
+            parse.Object.save_all(objs[i:i + 10])
+
+        q = parse.Query(TEST_CLASS_NAME)
+        q.order('index', False)
+        results = list(q.iter_all(page_size=4))
+        self.assertEqual(len(set(obj.object_id for obj in results)), 25)
+        self.assertEqual([obj['index'] for obj in results],
+            sorted((i // 3 for i in range(25)), reverse=True))
+
+        q = parse.Query(TEST_CLASS_NAME).gte('index', 2)
+        ids = [obj.object_id for obj in q.iter_all(page_size=5,
+            read_ahead=False)]
+        self.assertEqual(ids, sorted(obj.object_id for obj in objs
+            if obj['index'] >= 2))
+
+        q = parse.Query(TEST_CLASS_NAME)
+        q.order('createdAt', True)
+        self.assertEqual(len(set(obj.object_id for obj in
+            q.iter_all(page_size=4))), 25)
+
+        seen = []
+        self.assertEqual(parse.Query(TEST_CLASS_NAME).each(seen.append,
+            page_size=10), 25)
+        self.assertEqual(len(seen), 25)
+
+    def test_parallel_scan(self):
+        objs = [create_object(key='index', value=i) for i in range(20)]
+        for i in range(0, 20, 10):
+            parse.Object.save_all(objs[i:i + 10])
+
+        q = parse.Query(TEST_CLASS_NAME)
+        ids = [obj.object_id for obj in q.parallel_scan(workers=3,
+            page_size=3)]
+        self.assertEqual(sorted(ids), sorted(obj.object_id for obj in objs))
+
+        q = parse.Query(TEST_CLASS_NAME).gte('index', 2)
+        q.order('index', False)
+        scan = q.parallel_scan(workers=4, key='index', page_size=2)
+        self.assertEqual(len(scan.partitions), 4)
+        self.assertEqual([obj['index'] for obj in scan],
+            range(19, 1, -1))
+
+        q = parse.Query(TEST_CLASS_NAME)
+        q.order('index', True)
+        with q.parallel_scan(key='index', bounds=[5, 10]) as scan:
+            self.assertEqual([obj['index'] for obj in scan][:6], range(6))
+
+        # ordered on a key some objects lack, with fewer workers than
+        # partitions
+        parse.Object.save_all([create_object() for _ in range(2)])
+        q = parse.Query(TEST_CLASS_NAME).order('index', True)
+        scan = q.parallel_scan(workers=2, bounds=['4', '8', 'F'],
+            page_size=3)
+        self.assertEqual(len(scan.partitions), 4)
+        objs = list(scan)
+        self.assertEqual([obj.get('index') for obj in objs],
+            [None, None] + range(20))
+        self.assertTrue(len(scan.threads) <= 2)
+
+        where = Partition('index', 5, 10).narrow(
+            {'index': {'$gt': 7, '$lte': 20}})
+        self.assertEqual(where, {'index': {'$gt': 7, '$lt': 10}})
+
+    def test_scan_coordinator(self):
+        global SCAN_MARKER
+
+        objs = [create_object(key='index', value=i) for i in range(12)]
+        parse.Object.save_all(objs)
+
+        q = parse.Query(TEST_CLASS_NAME)
+        q.gt('createdAt', datetime.datetime(2000, 1, 1))
+        coordinator = ScanCoordinator.from_query(q, count=3, key='index',
+            page_size=2)
+        coordinator = ScanCoordinator.loads(coordinator.dumps())
+        spec = coordinator.specs[1]
+        self.assertEqual((spec.low, spec.high), (3, 6))
+        self.assertEqual(spec.data['where']['createdAt']['$gt'],
+            datetime.datetime(2000, 1, 1))
+
+        SCAN_MARKER = tempfile.mktemp()
+        try:
+            checkpoints = []
+            self.assertEqual(coordinator.run(scan_task, processes=2,
+                progress=checkpoints.append), 12)
+        finally:
+            os.remove(SCAN_MARKER)
+        self.assertEqual([s.attempts for s in coordinator.specs], [0, 1, 0])
+        self.assertEqual(coordinator.specs[1].cursor,
+            [max(obj.object_id for obj in objs[3:6])])
+        self.assertTrue(len(checkpoints) >= 6)
+
+        # every index partition holds objects, so every one calls the task
+        coordinator = ScanCoordinator.from_query(q, count=4, key='index',
+            retries=0)
+        with self.assertRaises(parse.ScanError) as cm:
+            coordinator.run(failing_scan_task, processes=2)
+        failed = cm.exception.failed
+        self.assertEqual(len(failed), 4)
+        self.assertIn('always fails', failed[0].error)
+
+    def test_query_cache(self):
+        parse.configure_query_cache(ttl=60)
+        try:
+            save_object(key='index', value=1)
+            q = parse.Query(TEST_CLASS_NAME)
+            self.assertEqual(len(q.find()), 1)
+            self.assertEqual(len(q.find()), 1)
+            self.assertEqual(len(q.find(lazy=True)), 1)
+            self.assertEqual(parse.query_cache_stats()['hits'], 2)
+
+            obj = save_object(key='index', value=2)
+            self.assertEqual(len(q.find()), 2)
+            obj.increment('index')
+            self.assertEqual(sorted(o['index'] for o in q.find()), [1, 3])
+            self.assertEqual(len(q.find(cache=False)), 2)
+
+            count = parse.Query(TEST_CLASS_NAME)
+            self.assertEqual(count.count(), 2)
+            parse.Object.delete_all([obj])
+            self.assertEqual(count.count(), 1)
+
+            stats = parse.query_cache_stats()
+            self.assertEqual((stats['hits'], stats['misses'],
+                stats['invalidations']), (2, 5, 4))
+        finally:
+            parse.configure_query_cache(0)
+        self.assertEqual(parse.query_cache_stats(), {})
+
+    def test_object_cache(self):
+        parse.configure_object_cache(ttl=60, negative_ttl=60)
+        try:
+            obj = save_object(key='index', value=1)
+            q = parse.Query(TEST_CLASS_NAME)
+            cached = q.get(obj.object_id)
+            self.assertEqual(cached['index'], 1)
+            cached['index'] = 2
+            self.assertEqual(q.get(obj.object_id)['index'], 1)
+            self.assertEqual(parse.object_cache_stats()['hits'], 2)
+
+            obj['index'] = 3
+            obj.save()
+            pointer = parse.Object(TEST_CLASS_NAME, obj.object_id)
+            pointer.refresh()
+            self.assertEqual(pointer['index'], 3)
+            self.assertEqual(pointer.created_at, obj.created_at)
+
+            parse.clear_object_cache()
+            other = save_object(key='index', value=4)
+            parse.clear_object_cache()
+            self.assertEqual(len(q.find()), 2)
+            self.assertEqual(q.get(other.object_id)['index'], 4)
+            self.assertEqual(parse.object_cache_stats()['hits'], 4)
+
+            for _ in range(2):
+                with self.assertRaises(parse.ParseException) as cm:
+                    q.get('missing')
+                self.assertEqual(cm.exception.code, 101)
+            object_id = obj.object_id
+            obj.delete()
+            with self.assertRaises(parse.ParseException):
+                q.get(object_id)
+
+            stats = parse.object_cache_stats()
+            self.assertEqual((stats['negative_hits'], stats['invalidations']),
+                (1, 1))
+            self.assertEqual(q.get(other.object_id, cache=False)['index'], 4)
+            self.assertEqual(parse.object_cache_stats()['hits'], 4)
+        finally:
+            parse.configure_object_cache(0)
+
+    def test_local_store(self):
+        objs = [create_object(key='index', value=i) for i in range(5)]
+        parse.Object.save_all(objs)
+        path = tempfile.mktemp(suffix='.db')
+        try:
+            with LocalStore(path) as store:
+                self.assertEqual(store.revalidate(TEST_CLASS_NAME,
+                    page_size=2), 5)
+                self.assertEqual(store.watermark(TEST_CLASS_NAME),
+                    max(obj.created_at for obj in objs))
+
+                objs[0]['index'] = 10
+                objs[0].save()
+                self.assertTrue(store.revalidate(TEST_CLASS_NAME) >= 1)
+                self.assertEqual(store.watermark(TEST_CLASS_NAME),
+                    objs[0].updated_at)
+                self.assertEqual(store.get(TEST_CLASS_NAME,
+                    objs[0].object_id)['index'], 10)
+
+                q = parse.Query(TEST_CLASS_NAME).gte('index', 2)
+                q.order('index', False)
+                self.assertEqual([obj['index'] for obj in store.find(q)],
+                    [10, 4, 3, 2])
+
+                q = parse.Query(TEST_CLASS_NAME).related_to(objs[1], 'peers')
+                with self.assertRaises(parse.UnsupportedQueryError):
+                    store.find(q)
+
+            # one page shares a timestamp, its last objects are kept
+            found = parse.Query(TEST_CLASS_NAME).order('index', True).find()
+            with LocalStore(':memory:', max_objects=3) as store:
+                store.put_all(found)
+                self.assertEqual(set(data['objectId'] for _, data in
+                    store.iter_raw()), set(obj.object_id for obj in found[2:]))
+
+            parse.configure_object_cache()
+            try:
+                with LocalStore(path, max_objects=3) as store:
+                    self.assertEqual(store.count(), 5)
+                    self.assertEqual(store.warm(), 5)
+                    parse.Query(TEST_CLASS_NAME).get(objs[1].object_id)
+                    self.assertEqual(parse.object_cache_stats()['hits'], 1)
+
+                    store.compact()
+                    self.assertEqual(store.count(TEST_CLASS_NAME), 3)
+                    store.max_bytes = 1
+                    store.put(objs[0])
+                    self.assertEqual(store.count(), 0)
+            finally:
+                parse.configure_object_cache(0)
+        finally:
+            for suffix in ('', '-wal', '-shm'):
+                if os.path.exists(path + suffix):
+                    os.remove(path + suffix)
+
+    def test_fork_after_background(self):
+        self.assertTrue(create_object().save_in_background().result(5))
+
+        pid = os.fork()
+        if pid == 0:
+            code = 1
+            try:
+                parse.reset_after_fork()
+                obj = create_object()
+                if obj.save_in_background().result(5) and obj.object_id:
+                    code = 0
+            finally:
+                os._exit(code)
+
+        _, status = os.waitpid(pid, 0)
+        self.assertEqual(os.WEXITSTATUS(status), 0)
+
+    def test_batch(self):
+        objs = [create_object(key='index', value=i) for i in range(3)]
+        self.assertTrue(parse.Object.save_all(objs))
+        for obj in objs:
+            assert_is_object(self, obj)
+
+    def test_latency(self):
+        server = LocalServer(latency=0.05, app_id='local').start()
+        try:
+            url = server.url + '/1/classes/' + TEST_CLASS_NAME
+            start = time.time()
+            with self.assertRaises(requests.HTTPError):
+                requests.get(url, headers={'X-Parse-Application-Id': 'x'})
+            self.assertTrue(time.time() - start >= 0.05)
+        finally:
+            server.stop()
+
+    def test_application_base_url(self):
+        default = parse.constants.API_DEFAULT_BASE_URL
+        try:
+            parse.set_application('redirected', 'a', 'b',
+                api_base_url='http://127.0.0.1:1')
+            self.assertEqual(parse.constants.API_BASE_URL,
+                'http://127.0.0.1:1')
+            parse.set_application('redirected', api_base_url='')
+            self.assertEqual(parse.constants.API_BASE_URL, default)
+
+            parse.constants.APPLICATIONS['manual'] = {'app_id': 'a',
+                'rest_api_key': 'b'}
+            parse.set_application('manual')
+            self.assertEqual(parse.constants.API_BASE_URL, default)
+        finally:
+            set_application()
+
+    def test_keep_alive_latency(self):
+        server = LocalServer().start()
+        try:
+            conn = httplib.HTTPConnection(server.host, server.port)
+            started = time.time()
+            for _ in range(5):
+                conn.request('GET', '/1/classes/' + TEST_CLASS_NAME)
+                conn.getresponse().read()
+            # well under the ~40ms a delayed ACK would add to each
+            self.assertLess(time.time() - started, 0.1)
+        finally:
+            server.stop()
+
+    def test_cloud_function(self):
+        if LOCAL_SERVER is None:
+            self.skipTest("Cloud functions are only defined locally")
+
+        LOCAL_SERVER.define('add', lambda params: params['a'] + params['b'])
+        self.assertEqual(parse.Cloud.call_function('add', {'a': 1, 'b': 2}),
+            3)
+
+
+class ParseRecordReplayTestCase(unittest.TestCase):
+    def setUp(self):
+        self.server = LocalServer().start()
+        self.url = self.server.url + '/1/classes/' + TEST_CLASS_NAME
+        self.path = tempfile.mktemp(suffix='.jsonl.gz')
+
+    def tearDown(self):
+        parse.unmount(self.server.url)
+        self.server.stop()
+        if os.path.exists(self.path):
+            os.remove(self.path)
+
+    def test_record_replay(self):
+        headers = {'X-Parse-REST-API-Key': 'secret'}
+        with RecordReplayAdapter(self.path, mode=RECORD) as adapter:
+            parse.mount(self.server.url, adapter)
+            recorded = requests.post(self.url, data='{"a": 1}',
+                headers=headers).content
+            with self.assertRaises(requests.HTTPError):
+                requests.get(self.url + '/missing')
+        self.server.stop()
+
+        with open(self.path, 'rb') as f:
+            self.assertNotIn('secret', gzip.GzipFile(fileobj=f).read())
+
+        adapter = RecordReplayAdapter(self.path, speed=None)
+        parse.mount(self.server.url, adapter)
+        response = requests.post(self.url, data='{"a": 1}', headers=headers)
+        self.assertEqual(response.content, recorded)
+        self.assertEqual(response.status_code, 201)
+        with self.assertRaises(requests.HTTPError):
+            requests.get(self.url + '/missing')
+        with self.assertRaises(ReplayMissError):
+            requests.get(self.url + '/other')
+        self.assertEqual(adapter.stats()['served'], 2)
+
+
+    def test_redacted_bodies(self):
+        users = self.server.url + '/1/users'
+        login = self.server.url + '/1/login'
+        with RecordReplayAdapter(self.path, mode=RECORD) as adapter:
+            parse.mount(self.server.url, adapter)
+            response = requests.post(users, data=json.dumps({
+                'username': 'u', 'password': 'secret123'}))
+            token = json.loads(response.content)['sessionToken']
+            requests.get(login, data='username=u&password=secret123')
+        self.server.stop()
+
+        with open(self.path, 'rb') as f:
+            recorded = gzip.GzipFile(fileobj=f).read()
+        self.assertNotIn('secret123', recorded)
+        self.assertNotIn(token, recorded)
+
+        parse.mount(self.server.url, RecordReplayAdapter(self.path,
+            speed=None))
+        response = requests.post(users, data=json.dumps({'password':
+            'other', 'username': 'u'}))
+        self.assertEqual(json.loads(response.content)['sessionToken'],
+            'REDACTED')
+        requests.get(login, data='username=u&password=secret123')
+
+
+class ParseFaultInjectionTestCase(unittest.TestCase):
+    def setUp(self):
+        self.server = LocalServer().start()
+        self.url = self.server.url + '/1/classes/' + TEST_CLASS_NAME
+
+    def tearDown(self):
+        parse.unmount(self.server.url)
+        self.server.stop()
+
+    def mount(self, *faults):
+        adapter = FaultInjectionAdapter(faults, seed=1)
+        parse.mount(self.server.url, adapter)
+        return adapter
+
+    def test_status(self):
+        self.mount(Fault('/1/classes/*', methods=['GET'], status=429,
+            retry_after=2))
+        with self.assertRaises(requests.HTTPError) as cm:
+            requests.get(self.url)
+        self.assertEqual(cm.exception.response.status_code, 429)
+        self.assertEqual(cm.exception.response.headers['Retry-After'], '2')
+        self.assertEqual(requests.post(self.url, data='{}').status_code, 201)
+
+    def test_reset_and_truncate(self):
+        adapter = self.mount(Fault('/1/batch', reset=True),
+            Fault('/1/classes/*', truncate=0.5))
+        with self.assertRaises(requests.ConnectionError):
+            requests.post(self.server.url + '/1/batch', data='{}')
+        response = requests.post(self.url, data='{"a": 1}')
+        with self.assertRaises(ValueError):
+            json.loads(response.content)
+        self.assertEqual(adapter.stats()['reset'], 1)
+        self.assertEqual(adapter.stats()['truncate'], 1)
+
+    def test_latency_in_background(self):
+        self.mount(Fault('*', latency=0.2))
+        started = time.time()
+        future = requests.async_request('GET', self.url,
+            callback=lambda r, e: r.status_code)
+        self.assertLess(time.time() - started, 0.1)
+        self.assertEqual(future.result(5), 200)
+        self.assertGreaterEqual(time.time() - started, 0.2)
+
+    def test_cancel_in_flight(self):
+        self.mount(Fault('*', latency=0.2))
+        future = utils.get(self.url, callback=lambda r, e: r.status_code)
+        self.assertTrue(future.running())
+        self.assertFalse(future.cancel())
+        self.assertEqual(future.result(5), 200)
+
+
+class ParseCoalescingTestCase(unittest.TestCase):
+    def setUp(self):
+        self.server = LocalServer().start()
+        self.url = self.server.url + '/1/classes/' + TEST_CLASS_NAME
+        parse.configure_coalescing()
+
+    def tearDown(self):
+        parse.configure_coalescing(False)
+        parse.unmount(self.server.url)
+        self.server.stop()
+
+    def mount(self, *faults):
+        adapter = FaultInjectionAdapter(faults)
+        parse.mount(self.server.url, adapter)
+        return adapter
+
+    def get_concurrently(self, count):
+        results = []
+
+        def get():
+            try:
+                results.append(utils.get(self.url))
+            except Exception as e:
+                results.append(e)
+
+        threads = [threading.Thread(target=get) for _ in range(count)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join(5)
+        return results
+
+    def test_coalesce(self):
+        adapter = self.mount(Fault('*', latency=0.2))
+        followers = parse.coalescing_stats()['followers']
+        results = self.get_concurrently(5)
+        self.assertEqual(adapter.stats()['requests'], 1)
+        self.assertEqual(len(set(r.content for r in results)), 1)
+        self.assertEqual(parse.coalescing_stats()['followers'] - followers, 4)
+        self.assertEqual(parse.coalescing_stats()['in_flight'], 0)
+
+        self.get_concurrently(1)
+        self.assertEqual(adapter.stats()['requests'], 2)
+
+    def test_shared_exception(self):
+        adapter = self.mount(Fault('*', latency=0.2, status=404))
+        errors = self.get_concurrently(3)
+        self.assertEqual(adapter.stats()['requests'], 1)
+        self.assertIsInstance(errors[0], parse.ParseException)
+        self.assertTrue(all(e is errors[0] for e in errors))
+
+    def test_background(self):
+        adapter = self.mount(Fault('*', latency=0.2))
+        futures = [utils.get(self.url, callback=lambda r, e: r.status_code)
+            for _ in range(3)]
+        self.assertEqual([f.result(5) for f in futures], [200] * 3)
+        self.assertEqual(adapter.stats()['requests'], 1)
+
+        futures = [utils.post(self.url, data='{}',
+            callback=lambda r, e: r.status_code) for _ in range(2)]
+        self.assertEqual([f.result(5) for f in futures], [201] * 2)
+        self.assertEqual(adapter.stats()['requests'], 3)
+
+    def test_leader_cancel(self):
+        set_application()
+        adapter = self.mount()
+        parse.set_rate_limit(2, burst=1)
+        try:
+            # spend the token, so the leader waits in the limiter
+            utils.get_rate_limiter().reserve()
+            leader, follower = [utils.get(self.url,
+                callback=lambda r, e: r.status_code) for _ in range(2)]
+            self.assertTrue(leader.cancel())
+            self.assertEqual(follower.result(5), 200)
+            self.assertTrue(leader.cancelled())
+            self.assertEqual(adapter.stats()['requests'], 1)
+
+            # the last caller to cancel takes the flight out
+            future = utils.get(self.url, callback=lambda r, e: r)
+            self.assertTrue(future.cancel())
+            self.assertEqual(parse.coalescing_stats()['in_flight'], 0)
+        finally:
+            parse.set_rate_limit(None)
+
+
+class ParseFutureTestCase(unittest.TestCase):
+    def setUp(self):
+        self.executor = Executor(workers=2, queue_size=4)
+
+    def tearDown(self):
+        self.executor.shutdown()
+
+    def test_result(self):
+        future = self.executor.submit(lambda x: x * 2, 21)
+        self.assertEqual(future.result(5), 42)
+        self.assertTrue(future.done())
+
+    def test_exception(self):
+        def fail():
+            raise parse.ParseException("failed")
+
+        future = self.executor.submit(fail)
+        self.assertIsInstance(future.exception(5), parse.ParseException)
+        with self.assertRaises(parse.ParseException):
+            future.result()
+
+    def test_cancel(self):
+        done = []
+        future = parse.Future()
+        future.add_done_callback(done.append)
+        self.assertTrue(future.cancel())
+        self.assertTrue(future.cancel())
+        self.assertTrue(future.cancelled())
+        self.assertEqual(done, [future])
+        with self.assertRaises(parse.CancelledError):
+            future.result()
+
+    def test_done_callback(self):
+        done = []
+        future = self.executor.submit(lambda: True)
+        future.add_done_callback(done.append)
+        future.wait(5)
+        future.add_done_callback(done.append)
+        self.assertEqual(done, [future, future])
+
+    def test_wait_on_worker(self):
+        def nested(i):
+            return self.executor.submit(lambda: i).result(3)
+
+        futures = [self.executor.submit(nested, i) for i in range(2)]
+        self.assertEqual([f.result(5) for f in futures], [0, 1])
+
+    def test_overflow(self):
+        executor = Executor(workers=1, queue_size=1)
+        try:
+            def fan_out():
+                futures = [executor.submit(lambda i=i: i) for i in range(3)]
+                return [f.result(3) for f in futures]
+
+            self.assertEqual(executor.submit(fan_out).result(5), [0, 1, 2])
+            self.assertGreaterEqual(executor.stats()['overflows'], 1)
+        finally:
+            executor.shutdown()
+
+    def test_wait_without_spares(self):
+        executor = Executor(workers=1, queue_size=1, max_spares=0)
+        try:
+            threads = set()
+
+            def run(i):
+                threads.add(threading.current_thread())
+                return i
+
+            def fan_out():
+                futures = [executor.submit(run, i) for i in range(5)]
+                return [f.result(3) for f in futures]
+
+            self.assertEqual(executor.submit(fan_out).result(5), range(5))
+            # every call ran inline on the one worker
+            self.assertEqual(threads, set(executor.threads))
+            self.assertEqual(executor.stats()['spares'], 0)
+        finally:
+            executor.shutdown()
+
+    def test_as_completed(self):
+        futures = [self.executor.submit(lambda i=i: i) for i in range(10)]
+        results = [f.result() for f in parse.as_completed(futures, 5)]
+        self.assertItemsEqual(results, range(10))
+
+    def test_wait_all_timeout(self):
+        future = parse.Future()
+        done, not_done = parse.wait_all([future], timeout=0.1)
+        self.assertEqual(not_done, set([future]))
+        with self.assertRaises(parse.TimeoutError):
+            list(parse.as_completed([future], timeout=0.1))
+
+
+class ParseJSONCodecTestCase(unittest.TestCase):
+    def tearDown(self):
+        parsejson.set_backend(parsejson.find_backends()[0][0])
+
+    def test_types(self):
+        text = json.dumps({'results': [{
+            'objectId': 'a', 'createdAt': '2014-03-01T12:00:00.000Z',
+            'updatedAt': '2014-03-01T12:00:00.000Z',
+            'when': {'__type': 'Date', 'iso': '2014-03-03T12:00:00.000Z'},
+            'data': {'__type': 'Bytes', 'base64': 'aGk='},
+            'where': {'__type': 'GeoPoint', 'latitude': 1.0,
+                'longitude': 2.0},
+            'owner': {'__type': 'Pointer', 'className': '_User',
+                'objectId': 'u'}}]})
+
+        for name in parsejson.BACKENDS:
+            parsejson.set_backend(name)
+            obj = parsejson.load(text, TEST_CLASS_NAME)['results'][0]
+            self.assertIsInstance(obj, parse.Object)
+            self.assertEqual(obj.class_name, TEST_CLASS_NAME)
+            self.assertEqual(obj['when'], datetime.datetime(2014, 3, 3, 12))
+            self.assertEqual(obj['data'], bytearray('hi'))
+            self.assertEqual(obj['where'].latitude, 1.0)
+            self.assertEqual(obj['owner'].class_name, '_User')
+
+            data = json.loads(parsejson.dump({'when': obj['when'],
+                'data': obj['data']}))
+            self.assertEqual(data['when']['__type'], 'Date')
+            self.assertEqual(data['data']['base64'], 'aGk=')
+
+    def test_iter_results(self):
+        text = json.dumps({'count': 12345, 'results': [
+            {'a': 12345, 'b': [1, {'c': u'\u00e9'}]},
+            {'when': {'__type': 'Date', 'iso': '2014-03-03T12:00:00.000Z'}},
+            67890], 'after': None})
+
+        for size in (1, 7, len(text)):
+            chunks = [text[i:i + size] for i in range(0, len(text), size)]
+            results = list(parsejson.iter_results(chunks))
+            self.assertEqual(results[0], {'a': 12345, 'b': [1,
+                {'c': u'\u00e9'}]})
+            self.assertEqual(results[1]['when'],
+                datetime.datetime(2014, 3, 3, 12))
+            self.assertEqual(results[2], 67890)
+
+        self.assertEqual(list(parsejson.iter_results(['{"results": []}'])),
+            [])
+        with self.assertRaises(ValueError):
+            list(parsejson.iter_results(['{"results": [{"a": 1}, {"b"']))
+
+    def test_backend(self):
+        parsejson.set_backend('json')
+        self.assertEqual(parsejson.get_backend(), 'json')
+        self.assertIs(parsejson.codec.decoder(TEST_CLASS_NAME),
+            parsejson.codec.decoder(TEST_CLASS_NAME))
+        with self.assertRaises(ValueError):
+            parsejson.set_backend('missing')
+        with self.assertRaises(TypeError):
+            parsejson.dump({'a': object()})
+
+
+class ParseDatesTestCase(unittest.TestCase):
+    def tearDown(self):
+        dates.configure_date_cache()
+
+    def test_parse_date(self):
+        for s in ('2014-03-01T12:00:07.001Z', '2014-03-01T12:00:07.5Z',
+            '2014-12-31T23:59:59.999999Z', u'2014-03-01T00:00:00.000Z',
+            '2014-3-1T12:00:07.001Z'):
+            self.assertEqual(dates.parse_date(s),
+                datetime.datetime.strptime(s, parse.DATETIME_FORMAT))
+            self.assertIs(dates.parse_date(s), dates.parse_date(s))
+
+        for s in ('2014-13-01T12:00:07.001Z', '2014-03-01 12:00:07.001Z',
+            '2014-03-01T12:00:07Z'):
+            with self.assertRaises(ValueError):
+                dates.parse_date(s)
+
+    def test_format_date(self):
+        dates.configure_date_cache(0)
+        for value in (datetime.datetime(2014, 3, 1, 12),
+            datetime.datetime(2014, 3, 1, 12, 0, 7, 1000)):
+            self.assertEqual(dates.format_date(value),
+                value.strftime(parse.DATETIME_FORMAT))
+        self.assertEqual(dates.formatted, {})
+
+
+class ParseQueryCacheTestCase(unittest.TestCase):
+    def build_key(self, cache, data, class_name=TEST_CLASS_NAME):
+        return cache.build_key(class_name, data,
+            {'X-Parse-Application-Id': 'app'})
+
+    def test_lru(self):
+        cache = QueryCache(max_bytes=1300, ttl=60)
+        keys = [self.build_key(cache, 'q=%d' % (i)) for i in range(3)]
+        for key in keys:
+            cache.set(key, 'x' * 200, 0)
+        cache.get(keys[0])
+        cache.set(self.build_key(cache, 'q=3'), 'x' * 200, 0)
+
+        self.assertEqual(cache.get(keys[0]), 'x' * 200)
+        self.assertIsNone(cache.get(keys[1]))
+        stats = cache.stats()
+        self.assertEqual((stats['hits'], stats['misses'],
+            stats['evictions'], stats['entries']), (2, 1, 1, 3))
+
+        master = cache.build_key(TEST_CLASS_NAME, 'q=0',
+            {'X-Parse-Application-Id': 'app', 'X-Parse-Master-Key': 'k'})
+        self.assertIsNone(cache.get(master))
+
+    def test_ttl_and_invalidation(self):
+        cache = QueryCache(ttl=60, ttls={'Other': 0.01, 'Never': 0})
+        key = self.build_key(cache, 'q')
+        other = self.build_key(cache, 'q', 'Other')
+        cache.set(key, 'a', 0)
+        cache.set(other, 'b', 0)
+        cache.set(self.build_key(cache, 'q', 'Never'), 'c', 0)
+        self.assertEqual(cache.stats()['entries'], 2)
+
+        time.sleep(0.02)
+        self.assertIsNone(cache.get(other))
+        self.assertEqual(cache.get(key), 'a')
+
+        generation = cache.generation(TEST_CLASS_NAME)
+        cache.invalidate(TEST_CLASS_NAME)
+        self.assertIsNone(cache.get(key))
+        cache.set(key, 'stale', generation)
+        self.assertIsNone(cache.get(key))
+        stats = cache.stats()
+        self.assertEqual((stats['expirations'], stats['invalidations'],
+            stats['bytes']), (1, 1, 0))
+
+
+class ParseAsyncResponseParserTestCase(unittest.TestCase):
+    def feed(self, parser, data, size=3):
+        for i in range(0, len(data), size):
+            parser.feed(data[i:i + size])
+
+    def test_content_length(self):
+        parser = AsyncResponseParser('GET')
+        self.feed(parser, 'HTTP/1.1 200 OK\r\nContent-Length: 5\r\n\r\nhello')
+        self.assertTrue(parser.complete)
+        self.assertEqual(parser.status, 200)
+        self.assertEqual(''.join(parser.body), 'hello')
+        self.assertFalse(parser.will_close)
+
+    def test_chunked(self):
+        parser = AsyncResponseParser('GET')
+        self.feed(parser, 'HTTP/1.1 200 OK\r\nTransfer-Encoding: chunked\r\n'
+            '\r\n5\r\nhello\r\n6;x=y\r\n world\r\n0\r\n\r\n')
+        self.assertTrue(parser.complete)
+        self.assertEqual(''.join(parser.body), 'hello world')
+
+    def test_read_until_close(self):
+        parser = AsyncResponseParser('GET')
+        self.feed(parser, 'HTTP/1.0 404 Not Found\r\n\r\n{}')
+        self.assertFalse(parser.complete)
+        parser.feed_eof()
+        self.assertTrue(parser.complete)
+        self.assertTrue(parser.will_close)
+        self.assertEqual(parser.reason, 'Not Found')
+
+    def test_truncated(self):
+        parser = AsyncResponseParser('GET')
+        parser.feed('HTTP/1.1 200 OK\r\nContent-Length: 5\r\n\r\nhel')
+        with self.assertRaises(httplib.IncompleteRead):
+            parser.feed_eof()
+
+
+class ParseRetryPolicyTestCase(unittest.TestCase):
+    def http_error(self, status, retry_after=None):
+        response = requests.Response()
+        response.status_code = status
+        response.headers = requests.CaseInsensitiveDict()
+        if retry_after is not None:
+            response.headers['Retry-After'] = retry_after
+        error = requests.HTTPError()
+        error.response = response
+        return error
+
+    def test_idempotent_methods(self):
+        policy = parse.RetryPolicy(backoff_factor=0)
+        error = self.http_error(503)
+        self.assertIsNotNone(policy.next_delay('GET', 0, error))
+        self.assertIsNotNone(policy.next_delay('PUT', 0, error))
+        self.assertIsNone(policy.next_delay('POST', 0, error))
+
+        policy = parse.RetryPolicy(methods=('GET', 'POST'))
+        self.assertIsNotNone(policy.next_delay('POST', 0, error))
+
+    def test_rules(self):
+        policy = parse.RetryPolicy(total=3, statuses={503: 1, 429: 3})
+        self.assertIsNotNone(policy.next_delay('GET', 0, self.http_error(503)))
+        self.assertIsNone(policy.next_delay('GET', 1, self.http_error(503)))
+        self.assertIsNotNone(policy.next_delay('GET', 2, self.http_error(429)))
+        self.assertIsNone(policy.next_delay('GET', 0, self.http_error(404)))
+        self.assertIsNone(policy.next_delay('GET', 0, requests.SSLError()))
+        self.assertIsNotNone(policy.next_delay('GET', 0,
+            requests.ConnectionError()))
+
+    def test_backoff(self):
+        policy = parse.RetryPolicy(backoff_factor=1, backoff_max=4)
+        for attempt in range(3):
+            delay = policy.next_delay('GET', attempt, requests.Timeout())
+            self.assertTrue(0 <= delay <= min(4, 2 ** attempt))
+
+    def test_retry_after(self):
+        policy = parse.RetryPolicy(backoff_max=10, retry_after_max=60)
+        self.assertEqual(policy.next_delay('GET', 0,
+            self.http_error(429, '2')), 2)
+        self.assertEqual(policy.next_delay('GET', 0,
+            self.http_error(503, '30')), 30)
+        self.assertIsNone(policy.next_delay('GET', 0,
+            self.http_error(429, '120')))
+
+    def test_budget(self):
+        budget = parse.RetryBudget(ratio=0, min_retries=2)
+        policy = parse.RetryPolicy(budget=budget)
+        error = self.http_error(500)
+        self.assertIsNotNone(policy.next_delay('GET', 0, error))
+        self.assertIsNotNone(policy.next_delay('GET', 0, error))
+        self.assertIsNone(policy.next_delay('GET', 0, error))
+
+
+class ParseTokenBucketTestCase(unittest.TestCase):
+    def test_burst(self):
+        bucket = TokenBucket(10, burst=3)
+        self.assertEqual([bucket.reserve() for _ in range(3)], [0, 0, 0])
+        self.assertAlmostEqual(bucket.reserve(), 0.1, places=2)
+        self.assertAlmostEqual(bucket.reserve(), 0.2, places=2)
+        self.assertEqual(bucket.stats()['throttled'], 2)
+
+    def test_refill(self):
+        bucket = TokenBucket(100, burst=1)
+        self.assertEqual(bucket.reserve(), 0)
+        time.sleep(0.02)
+        self.assertEqual(bucket.reserve(), 0)
+
+    def test_rate_limit(self):
+        parse.set_application('limited', 'a', 'b')
+        parse.set_rate_limit(5)
+        self.assertIn('limited', parse.rate_limit_stats())
+        parse.set_rate_limit(None)
+        self.assertNotIn('limited', parse.rate_limit_stats())
+        self.assertRaises(ValueError, parse.set_rate_limit, 5, name='none')
+
+
+class ParseConnectionSetupTestCase(unittest.TestCase):
+    def test_dns_cache(self):
+        cache = requests.DNSCache(ttl=60)
+        first = cache.resolve('localhost', 80)
+        self.assertEqual(cache.resolve('localhost', 80), first)
+        self.assertEqual(cache.stats()['hits'], 1)
+        cache.invalidate('localhost', 80)
+        cache.resolve('localhost', 80)
+        self.assertEqual(cache.stats()['misses'], 2)
+
+    def test_dns_cache_expiry(self):
+        cache = requests.DNSCache(ttl=0.01)
+        cache.resolve('localhost', 80)
+        time.sleep(0.02)
+        cache.resolve('localhost', 80)
+        self.assertEqual(cache.stats()['hits'], 0)
+
+    def test_async_address_fallback(self):
+        server = LocalServer().start()
+        host, port = server.host, server.port
+        closed = socket.socket()
+        closed.bind(('127.0.0.1', 0))
+        refused = (socket.AF_INET, socket.SOCK_STREAM, 0, '',
+            closed.getsockname())
+        closed.close()
+        try:
+            requests.DNS_CACHE.entries[(host, port)] = ([refused] +
+                socket.getaddrinfo(host, port, 0, socket.SOCK_STREAM),
+                time.time())
+            future = requests.async_request('GET', server.url + '/1/classes/'
+                + TEST_CLASS_NAME)
+            self.assertEqual(future.result(5).status_code, 200)
+
+            requests.DNS_CACHE.invalidate('localhost', port)
+            future = requests.async_request('GET', 'http://localhost:%d/1/'
+                'classes/%s' % (port, TEST_CLASS_NAME))
+            self.assertEqual(future.result(5).status_code, 200)
+        finally:
+            requests.DNS_CACHE.invalidate(host, port)
+            server.stop()
+
+    def test_async_pending_timeout(self):
+        server = LocalServer(latency=0.5).start()
+        loop = requests.EventLoop(max_connections=1)
+        session = requests.Session()
+        session.mount('http://', requests.AsyncAdapter(loop))
+        threads = []
+
+        def callback(response, error):
+            threads.append(threading.current_thread().name)
+            return requests.resolve_response(response, error)
+
+        try:
+            url = server.url + '/1/classes/' + TEST_CLASS_NAME
+            first = session.request('GET', url, callback=callback)
+            started = time.time()
+            second = session.request('GET', url, callback=callback,
+                timeout=0.2)
+            with self.assertRaises(requests.Timeout):
+                second.result(5)
+            self.assertLess(time.time() - started, 0.45)
+            self.assertEqual(first.result(5).status_code, 200)
+            self.assertNotIn('parse-event-loop', threads)
+        finally:
+            server.stop()
+
+    def test_ssl_context_reused(self):
+        self.assertIs(requests.get_ssl_context(),
+            requests.get_ssl_context())
+        self.assertIsNot(requests.get_ssl_context(verify=False),
+            requests.get_ssl_context())
+
+
+class ParseTimingTestCase(unittest.TestCase):
+    def test_phases(self):
+        timing = requests.Timing('POST', '/', u'data')
+        time.sleep(0.01)
+        timing.mark('wait')
+        timing.mark('receive')
+        self.assertTrue(timing.phases['wait'] >= 0.01)
+        self.assertTrue(timing.phases['receive'] < timing.phases['wait'])
+        self.assertEqual(timing.request_bytes, 4)
+
+    def test_hook(self):
+        records = []
+        parse.add_timing_hook(records.append)
+        try:
+            response = requests.Response()
+            response.status_code = 200
+            requests.Timing('GET', '/').finish(response)
+        finally:
+            parse.remove_timing_hook(records.append)
+
+        self.assertEqual(len(records), 1)
+        self.assertIs(response.timing, records[0])
+        self.assertAlmostEqual(response.elapsed.total_seconds(),
+            records[0].total, places=5)
+        self.assertEqual(records[0].as_dict()['status_code'], 200)
+
+
+class ParseTracingTestCase(unittest.TestCase):
+    def setUp(self):
+        self.exporter = parse.ChromeTraceExporter()
+        parse.add_tracer(self.exporter)
+
+    def tearDown(self):
+        parse.remove_tracer(self.exporter)
+
+    def test_nested_spans(self):
+        @tracing.traced('Test.find')
+        def find(query):
+            tracing.start_span('GET /', 'http').finish(status_code=200)
+            return [1, 2, 3]
+
+        find(parse.Query('TestObject'))
+        events = json.loads(self.exporter.to_json())['traceEvents']
+        operation = [e for e in events if e['cat'] == 'operation'][0]
+        http = [e for e in events if e['cat'] == 'http'][0]
+        self.assertEqual(operation['name'], 'Test.find')
+        self.assertEqual(operation['args']['class_name'], 'TestObject')
+        self.assertEqual(operation['args']['count'], 3)
+        self.assertEqual(http['args']['parent_id'],
+            operation['args']['span_id'])
+        self.assertEqual(operation['ph'], 'X')
+
+    def test_future_span(self):
+        future = requests.Future()
+
+        @tracing.traced('Test.find_in_background')
+        def find_in_background():
+            return future
+
+        find_in_background()
+        self.assertEqual(self.exporter.events, [])
+        future.set_exception(ValueError())
+        self.assertEqual(self.exporter.events[0]['args']['error'],
+            'ValueError')
+
+    def test_disabled(self):
+        parse.remove_tracer(self.exporter)
+        self.assertIs(tracing.start_span('GET /', 'http'), tracing.NULL_SPAN)
+
+
 if __name__ == '__main__':
     unittest.main()